@@ -1,11 +1,43 @@
-from Typing import Type, VarType, ProcType, SecurityLevel, CmdType, Int, Bool, TypeEnvironment, Array, Interface
+from Typing import Type, VarType, ProcType, SecurityLevel, CmdType, Int, Bool, TypeEnvironment, Array, Interface, INT, BOOL, MIN, MAX
 
-from Environment import Environment, Reference, Value
+from Environment import Environment, Reference, Local, Value
+from State import ContractState, Layout, Journal, Reverted, transfer
+from Diagnostics import Diagnostic, Diagnostics
+
+import operator
+
+# Where type errors are reported, the type checker sets it while checking.
+# Without one they are printed as they are found.
+diagnostics:Diagnostics = None
+
+# The line a top level declaration starts on, shared by the nodes below it so that
+# moving the declaration to another line moves all of them at once
+class LineBase:
+    def __init__(self, line) -> None:
+        self.line:int = line
 
 class Node:
+    # nodes with a line base keep their line relative to it
+    line_base:LineBase = None
+
     def __init__(self, pos) -> None:
-        self.pos:tuple[int, int] = pos
+        self._pos:tuple[int, int] = pos
         self.type_assignment = None
+
+    @property
+    def pos(self) -> tuple[int, int]:
+        base = self.line_base
+        if base is None:
+            return self._pos
+        return (self._pos[0] + base.line, self._pos[1])
+
+    @pos.setter
+    def pos(self, pos) -> None:
+        base = self.line_base
+        if base is None:
+            self._pos = pos
+        else:
+            self._pos = (pos[0] - base.line, pos[1])
     
     def type_check(self, type_env:TypeEnvironment):
         return NotImplemented
@@ -16,18 +48,129 @@ class Node:
     def evaluate(self, env:Environment):
         pass
     
-    def type_error(self, description):
-        print(f"Type error at line {self.pos[0] + 1} column {self.pos[1] + 1}: \n" + description)
+    def type_error(self, description, code = "type-error", located = False):
+        diagnostic = Diagnostic(self.pos, code, description, located=located)
+        if diagnostics != None:
+            diagnostics.report(diagnostic)
+        else:
+            print(diagnostic.format())
 
 class Expression(Node):
     def __init__(self, pos) -> None:
         super().__init__(pos)
-        self.type_assignment: Type = Type(Int(), SecurityLevel(0, min=True))
+        self.type_assignment: Type = Type.of(INT, MIN)
+
+    # evaluate returns a reference, which l-values and method arguments need.
+    # Where only the value is used, evaluate_value returns it without boxing it,
+    # expressions that compute new values override it to allocate nothing
+    def evaluate_value(self, env:Environment):
+        return self.evaluate(env).value
 
 class Statement(Node):
     def __init__(self, pos) -> None:
         super().__init__(pos)
-        self.type_assignment: CmdType = CmdType(SecurityLevel(0, max=True))
+        self.type_assignment: CmdType = CmdType.of(MAX)
+
+    # Statements containing other statements split type checking and evaluation
+    # into an enter and an exit step, so that type_check_block and evaluate_block
+    # can walk nested statements with an explicit stack instead of recursion.
+    # enter returns the nested statements, or None when there are none to run.
+    def type_check_enter(self, type_env:TypeEnvironment) -> list["Statement"]:
+        self.type_check(type_env)
+
+    def type_check_exit(self, type_env:TypeEnvironment):
+        pass
+
+    def evaluate_enter(self, env:Environment) -> list["Statement"]:
+        self.evaluate(env)
+
+    # returning statements from exit runs them again before exiting once more
+    def evaluate_exit(self, env:Environment) -> list["Statement"]:
+        pass
+
+
+def type_check_block(statements:list[Statement], type_env:TypeEnvironment):
+    stack = [(None, iter(statements))]
+    while stack:
+        parent, remaining = stack[-1]
+        statement = next(remaining, None)
+        if statement == None:
+            stack.pop()
+            if parent != None:
+                parent.type_check_exit(type_env)
+            continue
+        nested = statement.type_check_enter(type_env)
+        if nested != None:
+            stack.append((statement, iter(nested)))
+
+
+# Bind every VariableExpr in statements to the scope declaring it, as (depth, slot)
+# with depth counted outwards from the innermost scope. names are the locals of the method,
+# every var statement opens a scope of its own. Names declared outside the method
+# are left unbound, they are found by TypeEnvironment.lookup.
+def resolve_names(statements:list[Statement], names:list[str]):
+    stack = [(statements, ({name: slot for slot, name in enumerate(names)},))]
+    while stack:
+        node, scopes = stack.pop()
+        if isinstance(node, list):
+            for child in node:
+                stack.append((child, scopes))
+        elif isinstance(node, VariableExpr):
+            node.binding = None
+            for depth in range(len(scopes)):
+                scope = scopes[-1 - depth]
+                if node.name in scope:
+                    node.binding = (depth, scope[node.name])
+                    break
+        elif isinstance(node, BindStmt):
+            # the variable is already in scope in its own initializer
+            inner = scopes + ({node.name: 0},)
+            stack.append((node.expr, inner))
+            stack.append((node.stmts, inner))
+        elif isinstance(node, Node):
+            for name, value in vars(node).items():
+                if name != "type_assignment" and isinstance(value, (Node, list)):
+                    stack.append((value, scopes))
+
+
+# the names a method body is run with besides its parameters, see MethodCall.generate_env
+METHOD_NAMES = ("value", "caller", "this")
+# and the names a fallback body is run with, see MethodCall.fallback_function
+FALLBACK_NAMES = ("caller", "this", "cost", "id", "args")
+
+# names bound by the var statements in statements, at any depth
+def bind_names(statements:list[Statement]) -> set[str]:
+    names = set()
+    stack = list(statements)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, BindStmt):
+            names.add(node.name)
+            stack.extend(node.stmts)
+        elif isinstance(node, Statement):
+            for value in vars(node).values():
+                if isinstance(value, (Statement, list)):
+                    stack.append(value)
+    return names
+
+
+def evaluate_block(statements:list[Statement], env:Environment):
+    stack = [(None, iter(statements))]
+    while stack:
+        parent, remaining = stack[-1]
+        statement = next(remaining, None)
+        if statement == None:
+            stack.pop()
+            if parent != None:
+                again = parent.evaluate_exit(env)
+                if again != None:
+                    stack.append((parent, iter(again)))
+            continue
+        nested = statement.evaluate_enter(env)
+        if nested != None:
+            stack.append((statement, iter(nested)))
 
 class Blockchain(Node):
     def __init__(self, interfaces, contracts, transactions) -> None:
@@ -48,18 +191,25 @@ class Blockchain(Node):
             contract.pprint(indent)
 
     def evaluate(self, env: Environment):
-        for contract in self.contracts:
-            env.push({contract.name:Reference(contract)})
-        
-        for contract in self.contracts:
-            contract.evaluate(env)
-        
+        self.evaluate_stream(env, self.transactions)
 
-        for transaction in self.transactions:
-            transaction.evaluate(env)
+    # run transactions from any iterable, each one as soon as it is produced
+    def evaluate_stream(self, env: Environment, transactions):
+        states = [contract.deploy() for contract in self.contracts]
+        for state in states:
+            env.globals[state.name] = Reference(state)
 
-        for contract in self.contracts:
-            env.pop()
+        for contract, state in zip(self.contracts, states):
+            contract.initialize(state, env)
+
+        journal = env.journal = Journal()
+        if env.ledger != None:
+            transactions = env.ledger.replay(states, transactions)
+        for transaction in transactions:
+            journal.transaction(transaction.evaluate, env)
+
+        for state in states:
+            env.globals.pop(state.name, None)
 
 
 class Contract(Node):
@@ -70,6 +220,8 @@ class Contract(Node):
         self.fields:list[FieldDec] = fields
         self.methods:list[MethodDec] = methods
         self.fallback:MethodDec = None
+        # hash of the declaration and the strings in it, see Cache.structure
+        self.structure:tuple[str, list[str]] = None
 
     def pprint(self,indent, highlightpos = (), highlighted = False):
         string = "\t" * indent + f"contract {self.name}" + " {\n"
@@ -84,24 +236,35 @@ class Contract(Node):
         return string
 
     def type_check(self, type_env:TypeEnvironment):
-        obj = type_env.get_interface(self.type.obj)
-        self.type_assignment = Type(obj, self.type.sec)
-        type_env.push({self.name:self.type_assignment})
+        self.declare(type_env)
         type_env.push({"this":self.type_assignment})
-        
-        for field in self.fields:
-            field.type_check(type_env)
+
+        self.type_check_fields(type_env)
 
         type_env.pop()
 
         return self.type_assignment
+
+    # resolve the type of the contract and bring its name into scope
+    def declare(self, type_env:TypeEnvironment):
+        obj = type_env.get_interface(self.type.obj)
+        self.type_assignment = Type.of(obj, self.type.sec)
+        type_env.push({self.name:self.type_assignment})
+
+    # check the initial values of the fields, with this bound to the contract
+    def type_check_fields(self, type_env:TypeEnvironment):
+        for field in self.fields:
+            field.type_check(type_env)
     
-    def evaluate(self, env):
+    # the runtime state of the contract, the declaration itself is not changed by running it
+    def deploy(self) -> ContractState:
+        return ContractState(self, Layout([field.name for field in self.fields]))
+
+    def initialize(self, state:ContractState, env):
         # Initialize fields, needed for technical reasons
         # They should all techinally be decidable at compiletime
         # TODO: enforce compile-time decidability.
-        for field in self.fields:
-            field.evaluate(env)
+        state.initialize(field.evaluate(env) for field in self.fields)
     
     def get_method(self, name, env:Environment):
         # Clunky fallback special case
@@ -129,16 +292,16 @@ class FieldDec(Node):
         
         field = interface.get_field(self.name)
         if field == None:
-            self.type_error(f"{self.name} not included in interface {interface.name}")
+            self.type_error(f"{self.name} not included in interface {interface.name}", "unknown-field")
         self.type_assignment = field.type
         
         self.value.type_check(type_env)
         if not self.value.type_assignment < self.type_assignment:
-            self.type_error(f"Assigning {self.value.type_assignment} to field of type {self.type_assignment}")
+            self.type_error(f"Assigning {self.value.type_assignment} to field of type {self.type_assignment}", "field-type")
         
+    # the initial value, stored by ContractState.initialize
     def evaluate(self, env):
-        self.value = self.value.evaluate(env).value
-        return super().evaluate(env)
+        return self.value.evaluate_value(env)
 
 
         
@@ -149,6 +312,8 @@ class MethodDec(Node):
         self.name:str = name
         self.parameters:list[str] = parameters
         self.statements:list[Statement] = statements
+        # the locals the variables in statements were last resolved against
+        self.resolved_names:list[str] = None
     
     def pprint(self,indent, highlightpos = (), highlighted = False):
         string = "\t" * indent + f"{self.name}({', '.join(self.parameters)})" + " {\n" 
@@ -162,30 +327,35 @@ class MethodDec(Node):
         interface = type_env.lookup("this").obj
         method = interface.get_method(self.name)
         if method == None:
-            self.type_error(f"{self.name} not included in interface {interface.name}")
+            self.type_error(f"{self.name} not included in interface {interface.name}", "unknown-method")
         
 
         self.type_assignment = method.type
 
         local_variables = {
-            "sender":Type(type_env.get_interface("obj"), SecurityLevel(0, max=True)),
-            "value":Type(Int, self.type_assignment.cmd_level.level),
+            "sender":Type.of(type_env.get_interface("obj"), MAX),
+            "value":Type.of(INT, self.type_assignment.cmd_level.level),
         }
 
         for var in self.type_assignment.variables:
             local_variables[var] = self.type_assignment.variables[var]
 
-        type_env.push(local_variables)
+        names = list(local_variables)
+        if self.resolved_names != names:
+            resolve_names(self.statements, names)
+            self.resolved_names = names
+
+        type_env.push_frame(list(local_variables.values()))
 
-        cmd_level = CmdType(SecurityLevel(0, max=True))
+        cmd_level = CmdType.of(MAX)
         for statement in self.statements:
-            statement.type_check(type_env)
+            type_check_block([statement], type_env)
             cmd_level = cmd_level.join(statement.type_assignment)
 
             if cmd_level.level < self.type_assignment.cmd_level.level:
-                statement.type_error(f"Method of level {self.type_assignment.cmd_level.level} tries to access {cmd_level.level}")
+                statement.type_error(f"Method of level {self.type_assignment.cmd_level.level} tries to access {cmd_level.level}", "method-level")
 
-        type_env.pop()
+        type_env.pop_frame()
 
         return self.type_assignment
 
@@ -194,14 +364,14 @@ class ThrowStmt(Statement):
         super().__init__(pos)
 
     def type_check(self, type_env: TypeEnvironment):
-        self.type_assignment = CmdType(SecurityLevel(0, max=True))
+        self.type_assignment = CmdType.of(MAX)
         return self.type_assignment
         
     def pprint(self, indent, highlightpos=(), highlighted=False):
         return "\t" * indent + "throw"
 
     def evaluate(self, env: Environment):
-        raise Exception(f"Throws error at {self.pos}")
+        raise Reverted(f"Throws error at {self.pos}")
 
 class AssignmentStmt(Statement):
     def __init__(self, pos, lhs, rhs) -> None:
@@ -213,21 +383,29 @@ class AssignmentStmt(Statement):
         self.rhs.type_check(type_env)
         self.lhs.type_check(type_env)
         if not self.rhs.type_assignment < self.lhs.type_assignment:
-            self.type_error(f"Assigning type {self.rhs.type_assignment} to variable of type {self.lhs}")
+            self.type_error(f"Assigning type {self.rhs.type_assignment} to variable of type {self.lhs}", "assignment-type")
         
-        self.type_assignment = CmdType(self.lhs.type_assignment.sec)
+        self.type_assignment = CmdType.of(self.lhs.type_assignment.sec)
 
     def evaluate(self, env: Environment):
         l_value = self.lhs.evaluate(env)
-        l_value.value = self.rhs.evaluate(env).value
+        value = self.rhs.evaluate_value(env)
+        # parameters can alias fields, so the journal tells locals apart by their reference
+        env.journal.record(l_value)
+        l_value.value = value
 
 class VariableExpr(Expression):
     def __init__(self, pos, name) -> None:
         super().__init__(pos)
         self.name:str = name
+        # (depth, slot) of the local declaring the variable, set by resolve_names
+        self.binding:tuple[int, int] = None
 
     def type_check(self, type_env:TypeEnvironment):
-        self.type_assignment = type_env.lookup(self.name)
+        if self.binding == None:
+            self.type_assignment = type_env.lookup(self.name)
+        else:
+            self.type_assignment = type_env.frames[-1 - self.binding[0]][self.binding[1]]
         return self.type_assignment
     
     def pprint(self, indent, highlightpos=(), highlighted=False):
@@ -236,6 +414,9 @@ class VariableExpr(Expression):
     def evaluate(self, env: Environment):
         return env.lookup(self.name)
 
+    def evaluate_value(self, env: Environment):
+        return env.lookup(self.name).value
+
 
 
 class FieldExpr(Expression):
@@ -248,17 +429,20 @@ class FieldExpr(Expression):
         return f"{self.name.pprint(indent+1)}.{self.field}"
 
     def type_check(self, type_env:TypeEnvironment):
-        self.name.type_check(type_env)
+        return type_check_postfix(self, type_env)
+
+    def type_check_selection(self, type_env:TypeEnvironment):
         interface = self.name.type_assignment.obj
         self.type_assignment = interface.get_field(self.field).type
 
-        return self.type_assignment
-    
     def evaluate(self, env: Environment):
-        contract = self.name.evaluate(env).value
-        for field in contract.fields:
-            if field.name == self.field:
-                return field
+        name = self.name
+        if type(name) is FieldExpr or type(name) is ArrayAccess:
+            return evaluate_postfix(self, env)
+        return name.evaluate_value(env).field(self.field)
+
+    def select(self, value, env:Environment) -> Reference:
+        return value.field(self.field)
                 
         
 class SkipStmt(Statement):
@@ -269,7 +453,7 @@ class SkipStmt(Statement):
         return "\t"*indent + "skip"
 
     def type_check(self, type_env:TypeEnvironment):
-        self.type_assignment = CmdType(SecurityLevel(max=True))
+        self.type_assignment = CmdType.of(MAX)
         return self.type_assignment
         
 class IfStmt(Statement):
@@ -292,29 +476,32 @@ class IfStmt(Statement):
         return string
 
     def type_check(self, type_env:TypeEnvironment):
-        
-        cmd_lvl = CmdType(SecurityLevel(max=True))
-        
+        type_check_block([self], type_env)
+        return self.type_assignment
+
+    def type_check_enter(self, type_env:TypeEnvironment):
         self.cond.type_check(type_env)
+        return self.true_stmts + self.false_stmts
+
+    def type_check_exit(self, type_env:TypeEnvironment):
+        cmd_lvl = CmdType.of(MAX)
         for statement in self.true_stmts:
-            statement.type_check(type_env)
             cmd_lvl = cmd_lvl.join(statement.type_assignment)
         for statement in self.false_stmts:
-            statement.type_check(type_env)
             cmd_lvl = cmd_lvl.join(statement.type_assignment)
 
         if self.cond.type_assignment.sec > cmd_lvl.level:
-            self.type_error(f"Expression reads from higher than is written to at {self.pos}")
+            self.type_error(f"Expression reads from higher than is written to", "implicit-flow", located=True)
         
         self.type_assignment=cmd_lvl
     
     def evaluate(self, env: Environment):
-        if self.cond.evaluate(env).value:
-            for stmt in self.true_stmts:
-                stmt.evaluate(env)
-        else:
-            for stmt in self.false_stmts:
-                stmt.evaluate(env)
+        evaluate_block([self], env)
+
+    def evaluate_enter(self, env: Environment):
+        if self.cond.evaluate_value(env):
+            return self.true_stmts
+        return self.false_stmts
         
 
 
@@ -332,25 +519,33 @@ class WhileStmt(Statement):
         return string
 
     def type_check(self, type_env:TypeEnvironment):
+        type_check_block([self], type_env)
+        return self.type_assignment
 
-                
-        cmd_lvl = CmdType(SecurityLevel(max=True))
-        
+    def type_check_enter(self, type_env:TypeEnvironment):
         self.cond.type_check(type_env)
+        return self.stmts
+
+    def type_check_exit(self, type_env:TypeEnvironment):
+        cmd_lvl = CmdType.of(MAX)
         for statement in self.stmts:
-            statement.type_check(type_env)
             cmd_lvl = cmd_lvl.join(statement.type_assignment)
 
         if self.cond.type_assignment.sec > cmd_lvl.level:
-            self.type_error(f"Expression reads from {self.cond.type_assignment.sec} but writes to {cmd_lvl.level}")
+            self.type_error(f"Expression reads from {self.cond.type_assignment.sec} but writes to {cmd_lvl.level}", "implicit-flow")
 
 
         self.type_assignment = cmd_lvl
     
     def evaluate(self, env: Environment):
-        while self.cond.evaluate(env).value:
-            for stmt in self.stmts:
-                stmt.evaluate(env)
+        evaluate_block([self], env)
+
+    def evaluate_enter(self, env: Environment):
+        if self.cond.evaluate_value(env):
+            return self.stmts
+
+    def evaluate_exit(self, env: Environment):
+        return self.evaluate_enter(env)
 
 
 class BindStmt(Statement):
@@ -375,21 +570,32 @@ class BindStmt(Statement):
         return string
 
     def type_check(self, type_env:TypeEnvironment):
+        type_check_block([self], type_env)
+
+    def type_check_enter(self, type_env:TypeEnvironment):
         #TODO: finish typing
-        type_env.push({self.name:self.type})
+        type_env.push_frame([self.type])
         self.expr.type_check(type_env)
-        cmd_lvl = CmdType(SecurityLevel(max=True))
+        return self.stmts
+
+    def type_check_exit(self, type_env:TypeEnvironment):
+        cmd_lvl = CmdType.of(MAX)
         for statement in self.stmts:
-            statement.type_check(type_env)
             cmd_lvl = cmd_lvl.join(statement.type_assignment)
         
         if self.expr.type_assignment.sec > cmd_lvl.level:
-            self.type_error(f"Expression reads from higher than is written to")
+            self.type_error(f"Expression reads from higher than is written to", "implicit-flow")
+
+        type_env.pop_frame()
     
     def evaluate(self, env: Environment):
-        env.push({self.name:Reference(self.expr.evaluate(env).value)})
-        for statement in self.stmts:
-            statement.evaluate(env)
+        evaluate_block([self], env)
+
+    def evaluate_enter(self, env: Environment):
+        env.push({self.name:Local(self.expr.evaluate_value(env))})
+        return self.stmts
+
+    def evaluate_exit(self, env: Environment):
         env.pop()
     
 
@@ -402,12 +608,15 @@ class IntConstantExpr(Expression):
         return set(self.value)
 
     def type_check(self, type_env:TypeEnvironment):
-        self.type_assignment = Type(type_env.get_interface("int"), SecurityLevel(0,min=True))
+        self.type_assignment = Type.of(type_env.get_interface("int"), MIN)
         return self.type_assignment
     
     def evaluate(self, env: Environment):
         return Value(self.value)
 
+    def evaluate_value(self, env: Environment):
+        return self.value
+
         
 
 class BoolConstantExpr(Expression):
@@ -419,79 +628,122 @@ class BoolConstantExpr(Expression):
         return "T" if self.value else "F"
 
     def type_check(self, type_env:TypeEnvironment):
-        self.type_assignment = Type(type_env.get_interface("bool"), SecurityLevel(0,min=True))
+        self.type_assignment = Type.of(type_env.get_interface("bool"), MIN)
         return self.type_assignment
 
     def evaluate(self, env: Environment):
         return Value(self.value)
 
+    def evaluate_value(self, env: Environment):
+        return self.value
+
 
 
+def and_values(lhs, rhs):
+    return lhs and rhs
+
+def or_values(lhs, rhs):
+    return lhs or rhs
+
+# What each binary operator does, > adds and both sides of && and || are evaluated.
+# The functions are named at module level so code compiled to use them can be pickled
+BINARY_FUNCTIONS = {
+    "+": operator.add,
+    ">": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "&&": and_values,
+    "||": or_values,
+}
+
+# chains of operations longer than this are evaluated in a loop, shorter ones recursively
+RECURSIVE_CHAIN_LENGTH = 32
+
 class BinaryOp(Expression):
     def __init__(self, pos, op, lhs, rhs) -> None:
         super().__init__(pos)
         self.op:str = op
         self.lhs:Expression = lhs
         self.rhs:Expression = rhs
+        # operations leaning left from this one, itself included
+        self.chain_length = lhs.chain_length + 1 if type(lhs) is BinaryOp else 1
     
+    # a + b + c is parsed into operations leaning left as deep as the chain is long,
+    # so type checking, and evaluating long chains, walks down the left operands in a loop
+    def left_chain(self) -> tuple[list["BinaryOp"], Expression]:
+        chain = [self]
+        lhs = self.lhs
+        while type(lhs) is BinaryOp:
+            chain.append(lhs)
+            lhs = lhs.lhs
+        return chain, lhs
+
     def type_check(self, type_env:TypeEnvironment):
-        self.lhs.type_check(type_env)
-        self.rhs.type_check(type_env)
+        chain, lhs = self.left_chain()
+        lhs.type_check(type_env)
+        for node in reversed(chain):
+            node.rhs.type_check(type_env)
+            node.type_check_operator()
+        return self.type_assignment
 
+    # the type of the operation once both operands are checked
+    def type_check_operator(self):
         #operators on ints that give ints
         if self.op in ["+", "-", "*"]:
             if not isinstance(self.lhs.type_assignment.obj, Int):
-                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}")
+                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}", "expected-int")
             if not isinstance(self.rhs.type_assignment.obj, Int):
-                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}")
-            self.type_assignment = Type(Int(), self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
+                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}", "expected-int")
+            self.type_assignment = Type.of(INT, self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
         #operators on ints that give bools
         elif self.op in ["<",">",">=","<="]:
 
             if not isinstance(self.lhs.type_assignment.obj, Int):
-                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}")
+                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}", "expected-int")
             if not isinstance(self.rhs.type_assignment.obj, Int):
-                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}")
+                self.type_error(f"Expected int, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}", "expected-int")
 
-            self.type_assignment = Type(Bool(), self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
+            self.type_assignment = Type.of(BOOL, self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
         #operators on bool that give bools
         elif self.op in ["&&", "||"]:
             if not isinstance(self.lhs.type_assignment.obj, Bool):
-                self.type_error(f"Expected bool, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}")
+                self.type_error(f"Expected bool, but got {type(self.lhs.type_assignment.obj)} {self.lhs.type_assignment.obj}", "expected-bool")
             if not isinstance(self.rhs.type_assignment.obj, Bool):
-                self.type_error(f"Expected bool, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}")
-            self.type_assignment = Type(Bool(), self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
+                self.type_error(f"Expected bool, but got {type(self.lhs.type_assignment.obj)} {self.rhs.type_assignment.obj}", "expected-bool")
+            self.type_assignment = Type.of(BOOL, self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
         #operations on comparable types that give bools
         elif self.op == "==":
             if not type(self.lhs.type_assignment.obj) == type(self.rhs.type_assignment.obj):
-                self.type_error(f"Incomparable types {type(self.lhs.type_assignment.obj)} and {type(self.rhs.type_assignment.obj)}")
-            self.type_assignment = Type(Bool(), self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
-
+                self.type_error(f"Incomparable types {type(self.lhs.type_assignment.obj)} and {type(self.rhs.type_assignment.obj)}", "incomparable-types")
+            self.type_assignment = Type.of(BOOL, self.lhs.type_assignment.sec.join(self.rhs.type_assignment.sec))
 
-        return self.type_assignment
     def evaluate(self, env: Environment):
-        lhs = self.lhs.evaluate(env).value
-        rhs = self.rhs.evaluate(env).value
-        if self.op == "+":
-            return Value(lhs + rhs)
-        if self.op == "-":
-            return Value(lhs - rhs)
-        if self.op == "*":
-            return Value(lhs * rhs)
-        if self.op == "<":
-            return Value(lhs < rhs)
-        if self.op == ">":
-            return Value(lhs + rhs)
-        if self.op == ">=":
-            return Value(lhs >= rhs)
-        if self.op == "<=":
-            return Value(lhs <= rhs)
-        if self.op == "==":
-            return Value(lhs == rhs)
-        if self.op == "&&":
-            return Value(lhs and rhs)
-        if self.op == "||":
-            return Value(lhs or rhs)
+        return Value(self.evaluate_value(env))
+
+    def evaluate_value(self, env: Environment):
+        if self.chain_length > RECURSIVE_CHAIN_LENGTH:
+            return self.evaluate_chain(env)
+        lhs = self.lhs.evaluate_value(env)
+        rhs = self.rhs.evaluate_value(env)
+        function = BINARY_FUNCTIONS.get(self.op)
+        if function is None:
+            raise RuntimeError(f"Unknown operator {self.op} at {self.pos}")
+        return function(lhs, rhs)
+
+    def evaluate_chain(self, env: Environment):
+        chain, lhs = self.left_chain()
+        value = lhs.evaluate_value(env)
+        for node in reversed(chain):
+            rhs = node.rhs.evaluate_value(env)
+            function = BINARY_FUNCTIONS.get(node.op)
+            if function is None:
+                raise RuntimeError(f"Unknown operator {node.op} at {node.pos}")
+            value = function(value, rhs)
+        return value
 
 
 class UnaryOp(Expression):
@@ -504,11 +756,17 @@ class UnaryOp(Expression):
         return self.op + "(" + self.operand.pprint(indent+1) + ")"
 
     def type_check(self, type_env:TypeEnvironment):
-        self.type_assignment = self.operand.type_check(type_env)
+        self.operand.type_check(type_env)
+        self.type_assignment = self.operand.type_assignment
+        if not isinstance(self.type_assignment.obj, Int):
+            self.type_error(f"Expected int, but got {type(self.type_assignment.obj)} {self.type_assignment.obj}", "expected-int")
         return self.type_assignment
 
     def evaluate(self, env: Environment):
-        return - self.operand.evaluate(env)
+        return Value(self.evaluate_value(env))
+
+    def evaluate_value(self, env: Environment):
+        return - self.operand.evaluate_value(env)
     
 class MethodCall(Statement):
     def __init__(self, pos, name, method, vars, cost) -> None:
@@ -517,6 +775,8 @@ class MethodCall(Statement):
         self.method:str = method
         self.vars:list[Expression] = vars
         self.cost:Expression = cost
+        # (declaration, method, fallback) found for the last contract called
+        self.dispatch_cache:tuple = None
 
     def type_check_children(self, type_env: TypeEnvironment):
         self.name.type_check(type_env)
@@ -529,7 +789,7 @@ class MethodCall(Statement):
         method = interface.get_method(self.method)
 
         if method == None:
-            self.type_error(f"Trying to call nonexistant method")
+            self.type_error(f"Trying to call nonexistant method", "unknown-method")
         
         return method
 
@@ -539,7 +799,7 @@ class MethodCall(Statement):
         balance_level = interface.get_field("balance").type.sec
 
         if balance_level < self.type_assignment.level:
-            self.type_error(f"Implicit write to balance writing to {balance_level} with method level {self.type_assignment.level}")
+            self.type_error(f"Implicit write to balance writing to {balance_level} with method level {self.type_assignment.level}", "balance-level")
 
     def check_parameters(self, method, type_env:TypeEnvironment):
 
@@ -548,7 +808,7 @@ class MethodCall(Statement):
         for var in range(len(method.type.variables)):
             self.vars[var].type_check(type_env)
             if not self.vars[var].type_assignment < var_types[var][1]:
-                self.type_error(f"Invalid parameter, expected {var_types[var][1]} but got {self.vars[var].type_assignment}")
+                self.type_error(f"Invalid parameter, expected {var_types[var][1]} but got {self.vars[var].type_assignment}", "parameter-type")
 
     def type_check(self, type_env:TypeEnvironment):
         self.type_check_children(type_env)
@@ -565,18 +825,34 @@ class MethodCall(Statement):
     
     def get_magic_vars(self, env:Environment):
         caller = env.lookup("this").value
-        callee:Contract = self.name.evaluate(env).value
-        method = callee.get_method(self.method, env)
-        cost = self.cost.evaluate(env).value
-
-        return caller, callee, method, cost
+        callee:ContractState = self.name.evaluate_value(env)
+        method, fallback = self.find_method(callee, env)
+        cost = self.cost.evaluate_value(env)
+
+        return caller, callee, method, fallback, cost
+
+    # The method called on contract, and its fallback for when there is no such method.
+    # Each call site remembers what it found for the declaration of the last contract it called,
+    # calls to the same contract, or another one deployed from it, skip the search.
+    # The code of a declaration never changes once it is parsed, a changed program is parsed
+    # into new declarations, so what was found for one stays right.
+    def find_method(self, contract:ContractState, env) -> tuple["MethodDec", "MethodDec"]:
+        # the id special case depends on the environment, it is found again every time
+        if self.method == "id" or type(contract) is not ContractState:
+            return contract.get_method(self.method, env), contract.fallback
+
+        declaration = contract.contract
+        cache = self.dispatch_cache
+        if cache is None or cache[0] is not declaration:
+            cache = (declaration, declaration.get_method(self.method, env), declaration.fallback)
+            self.dispatch_cache = cache
+        return cache[1], cache[2]
 
     def evaluate_method(self, method, method_env, env):
 
         env.push(method_env)
 
-        for statement in method.statements:
-            statement.evaluate(env)
+        evaluate_block(method.statements, env)
 
         env.pop()
 
@@ -589,7 +865,7 @@ class MethodCall(Statement):
         # Clunky special case for fallback function unrolling
         # TODO: find elegant solution
         if len(self.vars) == 1 and isinstance(self.vars[0], VariableExpr) and self.vars[0].name == "args":
-            rolled = self.vars[0].evaluate(env).value
+            rolled = self.vars[0].evaluate_value(env)
             if isinstance(rolled, list):
                 for ind in range(len(self.vars)):
                     method_env[method.parameters[ind]] = rolled[ind]
@@ -598,36 +874,29 @@ class MethodCall(Statement):
             method_env[method.parameters[ind]] = self.vars[ind].evaluate(env)
         return method_env
 
-    def pay_balance(self, caller, callee, cost):
-        for field in caller.fields:
-            if field.name == "balance":
-                field.value -= cost
-
-        for field in callee.fields:
-            if field.name == "balance":
-                field.value += cost
+    def pay_balance(self, caller, callee, cost, env:Environment):
+        transfer(caller, callee, cost, env.journal)
 
+    # a throw reverts the writes of the call, including the payment, before unwinding further
     def evaluate(self, env: Environment):
-        caller, callee, method, cost = self.get_magic_vars(env)
+        caller, callee, method, fallback, cost = self.get_magic_vars(env)
         
         if method == None:
-            self.fallback_function(env)
+            self.fallback_function(env, caller, callee, fallback, cost)
             return
 
         method_env = self.generate_env(env, caller, callee, cost, method)
 
-        self.pay_balance(caller, callee, cost)
-
-        self.evaluate_method(method, method_env, env)
+        mark = env.journal.mark()
+        try:
+            self.pay_balance(caller, callee, cost, env)
 
-    def get_fallback_function(self, env)->MethodDec:
-        contract = self.name.evaluate(env).value
-        return contract.fallback
-
-    def fallback_function(self,env:Environment):
-        caller, callee, method, cost = self.get_magic_vars(env)
-        fallback = self.get_fallback_function(env)
+            self.evaluate_method(method, method_env, env)
+        except Reverted:
+            env.journal.rollback(mark)
+            raise
 
+    def fallback_function(self, env:Environment, caller, callee, fallback, cost):
         if fallback == None:
             raise RuntimeError(f"Calling nonexistant function at {self.pos}")
 
@@ -644,11 +913,14 @@ class MethodCall(Statement):
             "args":Reference(args)
         }
         
+        mark = env.journal.mark()
         env.push(method_env)
+        try:
+            evaluate_block(fallback.statements, env)
+        except Reverted:
+            env.journal.rollback(mark)
+            raise
 
-        for stmt in fallback.statements:
-            stmt.evaluate(env)
-        
         env.pop()
         
 
@@ -662,19 +934,19 @@ class DelegateCall(MethodCall):
         # but the callee must be a supertype of the caller
 
         if not type_env.lookup("this") < self.name.type_assignment:
-            self.type_error(f"Delegating call to non-superclass")
+            self.type_error(f"Delegating call to non-superclass", "delegate-supertype")
 
     def get_magic_vars(self, env):
         # most of the magic vars are passed through,
         # but you still need to look up the method being called.
         caller = env.lookup("caller").value
-        callee:Contract = env.lookup("this").value
+        callee:ContractState = env.lookup("this").value
 
-        delegatee:Contract = self.name.evaluate(env).value
-        method = delegatee.get_method(self.method, env)
-        cost = self.cost.evaluate(env).value
+        delegatee:ContractState = self.name.evaluate_value(env)
+        method, fallback = self.find_method(delegatee, env)
+        cost = self.cost.evaluate_value(env)
 
-        return caller, callee, method, cost
+        return caller, callee, method, fallback, cost
 
 class Transaction(MethodCall):
 
@@ -683,11 +955,11 @@ class Transaction(MethodCall):
         self.caller = caller
 
     def get_magic_vars(self, env):
-        caller = self.caller.evaluate(env).value
-        callee:Contract = self.name.evaluate(env).value
-        method = callee.get_method(self.method, env)
-        cost = self.cost.evaluate(env).value
-        return caller, callee, method, cost
+        caller = self.caller.evaluate_value(env)
+        callee:ContractState = self.name.evaluate_value(env)
+        method, fallback = self.find_method(callee, env)
+        cost = self.cost.evaluate_value(env)
+        return caller, callee, method, fallback, cost
 
 class PrintStmt(Statement):
     def __init__(self, pos, expression) -> None:
@@ -695,11 +967,11 @@ class PrintStmt(Statement):
         self.expression:Expression = expression
     
     def type_check(self, type_env: TypeEnvironment):
-        self.type_assignment = CmdType(SecurityLevel(max=True))
+        self.type_assignment = CmdType.of(MAX)
         return self.type_assignment
 
     def evaluate(self, env: Environment):
-        print(self.expression.evaluate(env).value)
+        print(self.expression.evaluate_value(env))
 
 
 class UnsafeStmt(Statement):
@@ -707,10 +979,13 @@ class UnsafeStmt(Statement):
         self.stmt = stmt
         super().__init__(pos)
     def evaluate(self, env):
-        return self.stmt.evaluate(env)
+        evaluate_block([self], env)
+
+    def evaluate_enter(self, env):
+        return [self.stmt]
     
     def type_check(self, type_env):
-        self.type_assignment = CmdType(SecurityLevel(max=True))
+        self.type_assignment = CmdType.of(MAX)
         return self.type_assignment
 
 class ArrayConstant(Expression):
@@ -723,16 +998,16 @@ class ArrayConstant(Expression):
         for index in self.indices:
             index.type_check(type_env)
         # TODO: finish implementing array type checking
-        self.type_assignment = self.indices[0].type_assignment
-        self.type_assignment.obj = Array(self.indices[0].type_assignment.obj)
+        first = self.indices[0].type_assignment
+        self.type_assignment = Type.of(Array.of(first.obj), first.sec)
 
     # weird consequence, they are passed by value, but the value is a python list
     # which is a reference
     def evaluate(self, env: Environment):
-        out = []
-        for index in self.indices:
-            out.append(Reference(index.evaluate(env)).value)
-        return Value(out)
+        return Value(self.evaluate_value(env))
+
+    def evaluate_value(self, env: Environment):
+        return [index.evaluate(env) for index in self.indices]
 
 class ArrayAccess(Expression):
     def __init__(self, pos, array, index):
@@ -741,17 +1016,54 @@ class ArrayAccess(Expression):
         self.index:Expression = index
     
     def type_check(self, type_env: TypeEnvironment):
-        self.array.type_check(type_env)
+        return type_check_postfix(self, type_env)
+
+    def type_check_selection(self, type_env:TypeEnvironment):
         self.index.type_check(type_env)
-        if not isinstance(self.index.type_assignment, Int):
-            self.type_error(f"Index must be int, not {self.index.type_assignment.obj}")
-        self.type_assignment = self.array.type_assignment
-        self.type_assignment.obj = self.type_assignment.obj.contained
-        self.type_assignment.sec = self.type_assignment.sec.join(self.index.type_assignment.sec)
-        return self.type_assignment
+        if not isinstance(self.index.type_assignment.obj, Int):
+            self.type_error(f"Index must be int, not {self.index.type_assignment.obj}", "index-type")
+        array = self.array.type_assignment
+        self.type_assignment = Type.of(array.obj.contained, array.sec.join(self.index.type_assignment.sec))
 
     def evaluate(self, env: Environment):
-        array = self.array.evaluate(env).value
-        index = self.index.evaluate(env).value
-        return array[index]
+        array = self.array
+        if type(array) is FieldExpr or type(array) is ArrayAccess:
+            return evaluate_postfix(self, env)
+        return array.evaluate_value(env)[self.index.evaluate_value(env)]
+
+    def select(self, value, env:Environment) -> Reference:
+        return value[self.index.evaluate_value(env)]
+
+
+# Field accesses and indexing such as a[i].f[j] are parsed leaning left, one level for
+# every selection, so they are walked in a loop from the innermost expression outwards.
+# The chain holds the selections, outermost first, the innermost expression is returned
+# after it.
+def postfix_chain(expression:Expression) -> tuple[list[Expression], Expression]:
+    chain = []
+    while True:
+        if type(expression) is FieldExpr:
+            chain.append(expression)
+            expression = expression.name
+        elif type(expression) is ArrayAccess:
+            chain.append(expression)
+            expression = expression.array
+        else:
+            return chain, expression
+
+def type_check_postfix(expression:Expression, type_env:TypeEnvironment):
+    chain, inner = postfix_chain(expression)
+    inner.type_check(type_env)
+    for node in reversed(chain):
+        node.type_check_selection(type_env)
+    return expression.type_assignment
+
+# the reference the outermost selection refers to
+def evaluate_postfix(expression:Expression, env:Environment) -> Reference:
+    chain, inner = postfix_chain(expression)
+    value = inner.evaluate_value(env)
+    for node in reversed(chain):
+        reference = node.select(value, env)
+        value = reference.value
+    return reference
 
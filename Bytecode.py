@@ -0,0 +1,641 @@
+from AST import (
+    Blockchain, Statement, Expression,
+    AssignmentStmt, SkipStmt, IfStmt, WhileStmt, BindStmt, ThrowStmt, PrintStmt, UnsafeStmt,
+    MethodCall, DelegateCall, Transaction,
+    VariableExpr, FieldExpr, IntConstantExpr, BoolConstantExpr, BinaryOp, UnaryOp, ArrayConstant, ArrayAccess,
+    bind_names, BINARY_FUNCTIONS, METHOD_NAMES, FALLBACK_NAMES,
+)
+from Environment import Environment, Reference, Local, Value
+from State import ContractState, Journal, Layout, Reverted, transfer
+import AST
+import Cache
+import State
+import lexer
+import parser
+
+import hashlib
+import pickle
+import sys
+
+# Opcodes of the stack machine, every instruction is an (opcode, argument) pair.
+# Values on the stack are plain python values, or references where an instruction
+# ending in _REF pushed one, for STORE to assign to or a call to pass on.
+
+# push the argument
+LOAD_CONST = 0
+# push a local, the argument is (scope index from the top of the environment, name)
+LOAD_LOCAL = 1
+LOAD_LOCAL_REF = 2
+# push a name that may be bound by any method on the call stack, found by Environment.lookup
+LOAD_NAME = 3
+LOAD_NAME_REF = 4
+# push a name no method binds, looked up once per run
+LOAD_GLOBAL = 5
+LOAD_GLOBAL_REF = 6
+# pop a contract, push its field named by the argument
+LOAD_FIELD = 7
+LOAD_FIELD_REF = 8
+# push a field of a local contract, (scope index, name, field), mostly this.field
+LOAD_LOCAL_FIELD = 9
+LOAD_LOCAL_FIELD_REF = 10
+# pop a value and store it in a field of a local contract, (scope index, name, field)
+STORE_LOCAL_FIELD = 11
+# pop an index and an array, push the element
+LOAD_INDEX = 12
+LOAD_INDEX_REF = 13
+# pop a value and push a new reference holding it
+BOX = 14
+# pop the argument number of references and push an array of them
+BUILD_ARRAY = 15
+# pop two values and push the argument function of them
+BINARY = 16
+# apply (function, constant) to the top value, as the right and the left operand
+BINARY_CONST = 17
+CONST_BINARY = 18
+NEGATE = 19
+# pop a value and a reference, and assign the value to it
+STORE = 20
+PRINT = 21
+# jump to the argument position, the conditional ones pop the condition
+JUMP = 22
+JUMP_IF_FALSE = 23
+JUMP_IF_TRUE = 24
+# pop a value and bind it to the argument name in a new scope, until UNBIND
+BIND = 25
+UNBIND = 26
+# raise the exception ThrowStmt raises, with the argument as message
+THROW = 27
+DUP = 28
+# Calls take caller, callee, the contract the method is looked for in, cost and the
+# arguments from the stack. The argument is (method name, number of arguments, position
+# of the call, whether the only argument is args). CALL binds the arguments in a new
+# scope, pays cost from caller to callee and runs the method, or runs the fallback of
+# the contract when it has no such method. A method named id is the one named by the id
+# of the running fallback, like in Contract.get_method, and args passed on alone to a
+# method are the arguments the fallback was called with. Calls do not recurse in python,
+# the code of the caller is resumed by the RETURN every method body ends with, which pops
+# the scope. A throw is reverted by the transaction it unwinds to, see State.Journal
+CALL = 29
+RETURN = 30
+
+# Fused instructions, for the most common expressions with a constant or a local as an
+# operand, see Compiler.binary. They take their operands without going through the stack.
+# push function(local, constant) and function(constant, local), the argument is
+# (scope index, name, function, constant)
+LOCAL_BINARY_CONST = 31
+CONST_BINARY_LOCAL = 32
+# the same for a field of a local, (scope index, name, field, function, constant)
+LOCAL_FIELD_BINARY_CONST = 33
+CONST_BINARY_LOCAL_FIELD = 34
+# apply function to the top value and a local or a field of a local, as the right operand,
+# the argument is (scope index, name, function) or (scope index, name, field, function)
+BINARY_LOCAL = 35
+BINARY_LOCAL_FIELD = 36
+# pop a value and assign it to a local, (scope index, name)
+STORE_LOCAL = 37
+# ends the code of a transaction or a field initializer, returning the top value if any
+STOP = 38
+
+OPCODE_NAMES = {value: name for name, value in vars(sys.modules[__name__]).items() if name.isupper() and isinstance(value, int)}
+
+class CompileError(Exception):
+    # raised by Compiler for a node it has no instructions for, a fault of the compiler
+    # and not of the program, which has been parsed and checked by then
+    pass
+
+
+class Code:
+    def __init__(self, instructions:list[tuple[int, object]]) -> None:
+        self.instructions = instructions
+
+    def disassemble(self) -> str:
+        return "\n".join(f"{position:>4} {OPCODE_NAMES[op]:<20} {'' if arg == None else arg}" for position, (op, arg) in enumerate(self.instructions))
+
+class Label:
+    # a position in the code being compiled, known once everything before it is emitted
+    def __init__(self) -> None:
+        self.position:int = None
+
+class ContractCode:
+    # Everything needed to deploy a contract, without its AST
+    def __init__(self, name, fields, methods, fallback) -> None:
+        self.name:str = name
+        # the name of each field and the code computing its initial value
+        self.fields:list[tuple[str, Code]] = fields
+        self.layout = Layout([name for name, _ in fields])
+        # parameters and code by method name
+        self.methods:dict[str, tuple[list[str], Code]] = methods
+        self.fallback:Code = fallback
+
+# Compiles method bodies, transactions and field initializers to Code.
+# Nested statements and expressions are compiled with an explicit stack of tasks,
+# so nesting depth is only limited by memory.
+class Compiler:
+    def __init__(self, local_names:set[str]) -> None:
+        # names that can be bound by a method, see compile_program
+        self.local_names = local_names
+
+    def body(self, statements:list[Statement], names) -> Code:
+        return self.assemble([("block", statements, ({*names},)), (RETURN, None)])
+
+    def transaction(self, transaction:Transaction) -> Code:
+        return self.assemble([("stmt", transaction, ()), (STOP, None)])
+
+    def initializer(self, expression:Expression) -> Code:
+        return self.assemble([("value", expression, ()), (STOP, None)])
+
+    # Tasks are instructions, labels, or nodes to compile, which expand into more tasks
+    def assemble(self, tasks) -> Code:
+        instructions = []
+        stack = list(reversed(tasks))
+        while stack:
+            task = stack.pop()
+            if isinstance(task, Label):
+                task.position = len(instructions)
+            elif isinstance(task[0], int):
+                instructions.append(task)
+            else:
+                stack.extend(reversed(self.expand(task)))
+        # jumps refer to labels until every position is known
+        return Code([(op, arg.position if isinstance(arg, Label) else arg) for op, arg in instructions])
+
+    def expand(self, task) -> list:
+        kind, node, scopes = task
+        match kind:
+            case "block":
+                return [("stmt", statement, scopes) for statement in node]
+            case "stmt":
+                return self.statement(node, scopes)
+            case "value":
+                return self.value(node, scopes)
+            case "ref":
+                return self.reference(node, scopes)
+
+    def statement(self, node:Statement, scopes) -> list:
+        match node:
+            case SkipStmt():
+                return []
+            case AssignmentStmt():
+                local = self.local_field(node.lhs, scopes)
+                if local != None:
+                    return [("value", node.rhs, scopes), (STORE_LOCAL_FIELD, local)]
+                target = self.reference(node.lhs, scopes)
+                if target[0][0] == LOAD_LOCAL_REF:
+                    return [("value", node.rhs, scopes), (STORE_LOCAL, target[0][1])]
+                return target + [("value", node.rhs, scopes), (STORE, None)]
+            case PrintStmt():
+                return [("value", node.expression, scopes), (PRINT, None)]
+            case ThrowStmt():
+                return [(THROW, f"Throws error at {node.pos}")]
+            case IfStmt():
+                otherwise = Label()
+                end = Label()
+                return [
+                    ("value", node.cond, scopes), (JUMP_IF_FALSE, otherwise),
+                    ("block", node.true_stmts, scopes), (JUMP, end),
+                    otherwise, ("block", node.false_stmts, scopes),
+                    end,
+                ]
+            case WhileStmt():
+                # the condition is tested at the bottom, one jump per iteration
+                body = Label()
+                test = Label()
+                return [
+                    (JUMP, test),
+                    body, ("block", node.stmts, scopes),
+                    test, ("value", node.cond, scopes), (JUMP_IF_TRUE, body),
+                ]
+            case BindStmt():
+                # the initializer is run before the variable is bound
+                return [
+                    ("value", node.expr, scopes), (BIND, node.name),
+                    ("block", node.stmts, scopes + ({node.name},)), (UNBIND, None),
+                ]
+            case UnsafeStmt():
+                return [("stmt", node.stmt, scopes)]
+            case MethodCall():
+                return self.call(node, scopes)
+        raise CompileError(f"Cannot compile {type(node).__name__} at {node.pos}")
+
+    # A call leaves caller, callee and the contract its method is found in on the stack,
+    # in the order MethodCall.get_magic_vars evaluates them
+    def call(self, node:MethodCall, scopes) -> list:
+        match node:
+            case Transaction():
+                tasks = [("value", node.caller, scopes), ("value", node.name, scopes), (DUP, None)]
+            case DelegateCall():
+                tasks = [self.load("caller", scopes, False), self.load("this", scopes, False), ("value", node.name, scopes)]
+            case _:
+                tasks = [self.load("this", scopes, False), ("value", node.name, scopes), (DUP, None)]
+        tasks.append(("value", node.cost, scopes))
+        tasks += [("ref", var, scopes) for var in node.vars]
+        passes_args = len(node.vars) == 1 and isinstance(node.vars[0], VariableExpr) and node.vars[0].name == "args"
+        return tasks + [(CALL, (node.method, len(node.vars), node.pos, passes_args))]
+
+    def value(self, node:Expression, scopes) -> list:
+        match node:
+            case IntConstantExpr() | BoolConstantExpr():
+                return [(LOAD_CONST, node.value)]
+            case VariableExpr():
+                return [self.load(node.name, scopes, False)]
+            case FieldExpr():
+                local = self.local_field(node, scopes)
+                if local != None:
+                    return [(LOAD_LOCAL_FIELD, local)]
+                return [("value", node.name, scopes), (LOAD_FIELD, node.field)]
+            case ArrayAccess():
+                return [("value", node.array, scopes), ("value", node.index, scopes), (LOAD_INDEX, None)]
+            case ArrayConstant():
+                # arrays hold the references their elements evaluated to
+                return [("ref", element, scopes) for element in node.indices] + [(BUILD_ARRAY, len(node.indices))]
+            case UnaryOp():
+                return [("value", node.operand, scopes), (NEGATE, None)]
+            case BinaryOp():
+                return self.binary(node, scopes)
+        raise CompileError(f"Cannot compile {type(node).__name__} at {node.pos}")
+
+    # An operand that is a constant, a local or a field of a local is taken by a fused
+    # instruction, and an operation on two constants is done while compiling
+    def binary(self, node:BinaryOp, scopes) -> list:
+        function = BINARY_FUNCTIONS.get(node.op)
+        if function == None:
+            raise CompileError(f"Cannot compile operator {node.op} at {node.pos}")
+        lhs_op, lhs = self.operand(node.lhs, scopes)
+        rhs_op, rhs = self.operand(node.rhs, scopes)
+        if rhs_op == LOAD_CONST:
+            if lhs_op == LOAD_CONST:
+                try:
+                    return [(LOAD_CONST, function(lhs, rhs))]
+                except Exception:
+                    # left for the program to fail on when it runs
+                    pass
+            elif lhs_op == LOAD_LOCAL:
+                return [(LOCAL_BINARY_CONST, lhs + (function, rhs))]
+            elif lhs_op == LOAD_LOCAL_FIELD:
+                return [(LOCAL_FIELD_BINARY_CONST, lhs + (function, rhs))]
+            return [("value", node.lhs, scopes), (BINARY_CONST, (function, rhs))]
+        if lhs_op == LOAD_CONST:
+            if rhs_op == LOAD_LOCAL:
+                return [(CONST_BINARY_LOCAL, rhs + (function, lhs))]
+            elif rhs_op == LOAD_LOCAL_FIELD:
+                return [(CONST_BINARY_LOCAL_FIELD, rhs + (function, lhs))]
+            return [("value", node.rhs, scopes), (CONST_BINARY, (function, lhs))]
+        if rhs_op == LOAD_LOCAL:
+            return [("value", node.lhs, scopes), (BINARY_LOCAL, rhs + (function,))]
+        if rhs_op == LOAD_LOCAL_FIELD:
+            return [("value", node.lhs, scopes), (BINARY_LOCAL_FIELD, rhs + (function,))]
+        return [("value", node.lhs, scopes), ("value", node.rhs, scopes), (BINARY, function)]
+
+    # the single instruction pushing a constant, a local or a field of a local, (None, None) for other expressions
+    def operand(self, node:Expression, scopes) -> tuple[int, object]:
+        match node:
+            case IntConstantExpr() | BoolConstantExpr():
+                return (LOAD_CONST, node.value)
+            case VariableExpr():
+                load = self.load(node.name, scopes, False)
+                if load[0] == LOAD_LOCAL:
+                    return load
+            case FieldExpr():
+                local = self.local_field(node, scopes)
+                if local != None:
+                    return (LOAD_LOCAL_FIELD, local)
+        return (None, None)
+
+    # what evaluate returns for an expression whose reference is needed
+    def reference(self, node:Expression, scopes) -> list:
+        match node:
+            case VariableExpr():
+                return [self.load(node.name, scopes, True)]
+            case FieldExpr():
+                local = self.local_field(node, scopes)
+                if local != None:
+                    return [(LOAD_LOCAL_FIELD_REF, local)]
+                return [("value", node.name, scopes), (LOAD_FIELD_REF, node.field)]
+            case ArrayAccess():
+                return [("value", node.array, scopes), ("value", node.index, scopes), (LOAD_INDEX_REF, None)]
+        # a new box every time, like evaluate, since what it is passed to may assign to it
+        return [("value", node, scopes), (BOX, None)]
+
+    def load(self, name, scopes, reference) -> tuple[int, object]:
+        for depth in range(len(scopes)):
+            if name in scopes[-1 - depth]:
+                return (LOAD_LOCAL_REF if reference else LOAD_LOCAL, (-1 - depth, name))
+        if name in self.local_names:
+            return (LOAD_NAME_REF if reference else LOAD_NAME, name)
+        return (LOAD_GLOBAL_REF if reference else LOAD_GLOBAL, name)
+
+    # (scope index, name, field) for a field of a local, None for any other expression
+    def local_field(self, node:Expression, scopes) -> tuple[int, str, str]:
+        if not isinstance(node, FieldExpr) or not isinstance(node.name, VariableExpr):
+            return None
+        for depth in range(len(scopes)):
+            if node.name.name in scopes[-1 - depth]:
+                return (-1 - depth, node.name.name, node.field)
+        return None
+
+
+# A compiled blockchain, it holds no AST and can be pickled, see ProgramCache.
+# Every run deploys the contracts afresh, so a program can be run again.
+class Program:
+    def __init__(self, contracts:list[ContractCode], transactions:list[Code], local_names:set[str]) -> None:
+        self.contracts = contracts
+        self.transactions = transactions
+        self.local_names = local_names
+
+    def evaluate(self, env:Environment):
+        self.run(env, self.transactions)
+
+    # like Blockchain.evaluate_stream, every transaction is compiled as it arrives
+    def evaluate_stream(self, env:Environment, transactions):
+        compiler = Compiler(self.local_names)
+        self.run(env, (compiler.transaction(transaction) for transaction in transactions))
+
+    def run(self, env:Environment, transactions):
+        machine = Machine()
+        states = [ContractState(contract, contract.layout) for contract in self.contracts]
+        for state in states:
+            env.globals[state.name] = Reference(state)
+
+        for contract, state in zip(self.contracts, states):
+            state.initialize(machine.execute(initializer, env) for _, initializer in contract.fields)
+
+        journal = env.journal = Journal()
+        if env.ledger != None:
+            transactions = env.ledger.replay(states, transactions)
+        for transaction in transactions:
+            journal.transaction(lambda env: machine.execute(transaction, env), env)
+
+        for state in states:
+            env.globals.pop(state.name, None)
+
+
+class Machine:
+    def __init__(self) -> None:
+        # references of the names no method binds, see LOAD_GLOBAL
+        self.globals:dict[str, Reference] = {}
+
+    # Runs code in env, returns what is left on top of the stack. The instructions are
+    # tested roughly in the order of how often they run.
+    def execute(self, code:Code, env:Environment):
+        instructions = code.instructions
+        values = env.values
+        # fields are always journaled, but only on their first write in a transaction
+        journal = env.journal
+        record = journal.record if journal != None else None
+        recorded = journal.recorded if journal != None else None
+        # the instructions, position and stack of each caller of the running method
+        frames = []
+        stack = []
+        pc = 0
+        while True:
+            op, arg = instructions[pc]
+            pc += 1
+
+            if op == LOAD_LOCAL:
+                index, name = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(reference.value)
+            elif op == STORE_LOCAL_FIELD:
+                index, name, field = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                reference = reference.value.fields[field]
+                if reference not in recorded:
+                    record(reference)
+                reference.value = stack.pop()
+            elif op == LOCAL_BINARY_CONST:
+                index, name, function, constant = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(function(reference.value, constant))
+            elif op == LOAD_LOCAL_FIELD:
+                index, name, field = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(reference.value.fields[field].value)
+            elif op == BINARY_LOCAL:
+                index, name, function = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack[-1] = function(stack[-1], reference.value)
+            elif op == JUMP_IF_TRUE:
+                if stack.pop():
+                    pc = arg
+            elif op == LOAD_CONST:
+                stack.append(arg)
+            elif op == CONST_BINARY_LOCAL_FIELD:
+                index, name, field, function, constant = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(function(constant, reference.value.fields[field].value))
+            elif op == LOCAL_FIELD_BINARY_CONST:
+                index, name, field, function, constant = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(function(reference.value.fields[field].value, constant))
+            elif op == BINARY:
+                rhs = stack.pop()
+                stack[-1] = arg(stack[-1], rhs)
+            elif op == STORE_LOCAL:
+                index, name = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                # a parameter can be bound to a field, a local made by var is not journaled
+                if type(reference) is not Local:
+                    record(reference)
+                reference.value = stack.pop()
+            elif op == BINARY_LOCAL_FIELD:
+                index, name, field, function = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack[-1] = function(stack[-1], reference.value.fields[field].value)
+            elif op == JUMP:
+                pc = arg
+            elif op == JUMP_IF_FALSE:
+                if not stack.pop():
+                    pc = arg
+            elif op == BINARY_CONST:
+                function, constant = arg
+                stack[-1] = function(stack[-1], constant)
+            elif op == CONST_BINARY:
+                function, constant = arg
+                stack[-1] = function(constant, stack[-1])
+            elif op == CONST_BINARY_LOCAL:
+                index, name, function, constant = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(function(constant, reference.value))
+            elif op == BOX:
+                stack[-1] = Value(stack[-1])
+            elif op == PRINT:
+                print(stack.pop())
+            elif op == CALL:
+                method, count, pos, passes_args = arg
+                arguments = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                cost = stack.pop()
+                contract = stack.pop()
+                callee = stack.pop()
+                caller = stack.pop()
+                if method == "id":
+                    name = env.lookup("id").value
+                    found = contract.contract.methods.get(name if isinstance(name, str) else "id")
+                else:
+                    found = contract.contract.methods.get(method)
+                if found != None:
+                    parameters, code = found
+                    if passes_args and isinstance(arguments[0].value, list):
+                        arguments = arguments[0].value[:1]
+                    method_env = {
+                        "value":Reference(cost),
+                        "caller":Reference(caller),
+                        "this":Reference(callee),
+                    }
+                    for index in range(len(arguments)):
+                        method_env[parameters[index]] = arguments[index]
+                    transfer(caller, callee, cost, journal)
+                else:
+                    code = contract.fallback
+                    if code == None:
+                        raise RuntimeError(f"Calling nonexistant function at {pos}")
+                    method_env = {
+                        "caller":Reference(caller),
+                        "this":Reference(callee),
+                        "cost":Reference(cost),
+                        "id":Reference(method),
+                        "args":Reference(arguments),
+                    }
+                env.push(method_env)
+                frames.append((instructions, pc, stack))
+                instructions = code.instructions
+                stack = []
+                pc = 0
+            elif op == RETURN:
+                env.pop()
+                instructions, pc, stack = frames.pop()
+            elif op == LOAD_GLOBAL or op == LOAD_GLOBAL_REF:
+                reference = self.globals.get(arg)
+                if reference is None:
+                    reference = env.lookup(arg)
+                    if reference is not None:
+                        self.globals[arg] = reference
+                stack.append(reference.value if op == LOAD_GLOBAL else reference)
+            elif op == DUP:
+                stack.append(stack[-1])
+            elif op == STORE:
+                value = stack.pop()
+                reference = stack.pop()
+                record(reference)
+                reference.value = value
+            elif op == LOAD_LOCAL_REF:
+                index, name = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(reference)
+            elif op == LOAD_LOCAL_FIELD_REF:
+                index, name, field = arg
+                reference = values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                stack.append(reference.value.fields[field])
+            elif op == BIND:
+                env.push({arg:Local(stack.pop())})
+            elif op == UNBIND:
+                env.pop()
+            elif op == LOAD_FIELD:
+                stack[-1] = stack[-1].field(arg).value
+            elif op == LOAD_FIELD_REF:
+                stack[-1] = stack[-1].field(arg)
+            elif op == LOAD_NAME:
+                stack.append(env.lookup(arg).value)
+            elif op == LOAD_NAME_REF:
+                stack.append(env.lookup(arg))
+            elif op == LOAD_INDEX:
+                index = stack.pop()
+                stack[-1] = stack[-1][index].value
+            elif op == LOAD_INDEX_REF:
+                index = stack.pop()
+                stack[-1] = stack[-1][index]
+            elif op == BUILD_ARRAY:
+                array = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                stack.append(array)
+            elif op == NEGATE:
+                stack[-1] = -stack[-1]
+            elif op == THROW:
+                raise Reverted(arg)
+            elif op == STOP:
+                if stack:
+                    return stack[-1]
+                return None
+            else:
+                raise RuntimeError(f"Unknown opcode {op} at {pc - 1}")
+
+
+def compile_program(ast:Blockchain) -> Program:
+    local_names = set(METHOD_NAMES) | set(FALLBACK_NAMES)
+    for contract in ast.contracts:
+        for method in contract.methods + ([contract.fallback] if contract.fallback != None else []):
+            local_names.update(method.parameters)
+            local_names.update(bind_names(method.statements))
+
+    compiler = Compiler(local_names)
+    contracts = []
+    for contract in ast.contracts:
+        fields = [(field.name, compiler.initializer(field.value)) for field in contract.fields]
+        methods = {}
+        for method in contract.methods:
+            if method.name not in methods:
+                methods[method.name] = (method.parameters, compiler.body(method.statements, METHOD_NAMES + tuple(method.parameters)))
+        fallback = None
+        if contract.fallback != None:
+            fallback = compiler.body(contract.fallback.statements, FALLBACK_NAMES)
+        contracts.append(ContractCode(contract.name, fields, methods, fallback))
+
+    transactions = [compiler.transaction(transaction) for transaction in ast.transactions]
+    return Program(contracts, transactions, local_names)
+
+
+# Modules whose source decides the compiled program
+COMPILER_MODULES = [lexer, parser, AST, sys.modules[Environment.__module__], State, sys.modules[__name__]]
+
+class ProgramCache(Cache.DiskCache):
+    # Compiled programs stored by a hash of their source and the compiler version,
+    # so a program found here is run without being parsed
+    def __init__(self, directory, max_size = Cache.DEFAULT_MAX_SIZE) -> None:
+        super().__init__(directory, max_size, ".bytecode")
+
+    def key(self, source:bytes) -> str:
+        digest = hashlib.sha256(Cache.source_version(COMPILER_MODULES).encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def load_program(self, source:bytes) -> Program:
+        data = self.load(self.key(source))
+        if data == None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # unreadable entries are compiled again and replaced
+            return None
+
+    # compile ast, parsed from source, or load what an earlier run compiled
+    def compile(self, source:bytes, ast:Blockchain) -> Program:
+        program = self.load_program(source)
+        if program == None:
+            program = compile_program(ast)
+            self.store(self.key(source), pickle.dumps(program, pickle.HIGHEST_PROTOCOL))
+        return program
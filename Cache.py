@@ -0,0 +1,226 @@
+import hashlib
+import hmac
+import os
+import pickle
+import sys
+import tempfile
+
+import lexer
+import parser
+import AST
+import Typing
+
+# 64 MiB
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Secret of the user running the program, cache entries are authenticated with it.
+# It is kept outside the cache directory, so whoever can write to a shared or copied
+# cache directory cannot make entries that are loaded, and so unpickled.
+KEY_FILE = os.path.join(os.path.expanduser("~"), ".tinysol-cache-key")
+KEY_SIZE = 32
+
+secret:bytes = None
+
+def secret_key() -> bytes:
+    global secret
+    if secret != None:
+        return secret
+    try:
+        with open(KEY_FILE, "rb") as file:
+            secret = file.read()
+        return secret
+    except FileNotFoundError:
+        pass
+
+    # written to a private temporary file and linked into place,
+    # so a process starting meanwhile never reads a partially written key
+    key = os.urandom(KEY_SIZE)
+    try:
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(KEY_FILE))
+        try:
+            with os.fdopen(handle, "wb") as file:
+                file.write(key)
+            os.link(temporary, KEY_FILE)
+            secret = key
+        except FileExistsError:
+            with open(KEY_FILE, "rb") as file:
+                secret = file.read()
+        finally:
+            os.unlink(temporary)
+    except OSError:
+        # no key can be kept, entries of this run are never loaded by another
+        secret = key
+    return secret
+
+MAC_SIZE = hashlib.sha256().digest_size
+
+class DiskCache:
+    # A directory of files named by their key.
+    # Writes are atomic and the least recently used files are evicted
+    # once the directory grows past max_size bytes.
+    # Every file starts with an HMAC of its name and contents keyed by secret_key,
+    # files without a valid one are not loaded, as if they were not there.
+    def __init__(self, directory, max_size = DEFAULT_MAX_SIZE, suffix = ".cache") -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def mac(self, key, data:bytes) -> bytes:
+        return hmac.new(secret_key(), (key + self.suffix).encode() + b"\0" + data, hashlib.sha256).digest()
+
+    def load(self, key) -> bytes:
+        try:
+            with open(self.path(key), "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        mac, data = data[:MAC_SIZE], data[MAC_SIZE:]
+        if not hmac.compare_digest(mac, self.mac(key, data)):
+            return None
+        # mark as recently used
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return data
+
+    def store(self, key, data:bytes) -> None:
+        # write to a temporary file in the same directory and move it into place,
+        # so readers never see a partially written entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                file.write(self.mac(key, data))
+                file.write(data)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                return
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Modules whose source decides the shape of a parsed AST, and the structure hashes kept in it
+PARSER_MODULES = [lexer, parser, AST, Typing, sys.modules[__name__]]
+
+source_version_hashes:dict[tuple[str, ...], str] = {}
+
+# Hash of the sources of modules, cached entries from other versions are never hit
+def source_version(modules) -> str:
+    names = tuple(module.__name__ for module in modules)
+    if names not in source_version_hashes:
+        digest = hashlib.sha256()
+        for module in modules:
+            with open(module.__file__, "rb") as file:
+                digest.update(file.read())
+        source_version_hashes[names] = digest.hexdigest()
+    return source_version_hashes[names]
+
+def parser_version() -> str:
+    return source_version(PARSER_MODULES)
+
+
+# attributes set from the rest of the AST, by the parser, the checker or running it
+DERIVED_ATTRIBUTES = ("_pos", "line_base", "type_assignment", "binding", "resolved_names", "dispatch_cache", "chain_length", "structure")
+
+# Feed the structure of a node to digest, with lines relative to line
+# so that moving the node does not change it, and return the strings found in it
+def hash_node(node, line, digest) -> list[str]:
+    strings = {}
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, (list, tuple)):
+            digest.update(f"[{len(current)}\n".encode())
+            stack.extend(reversed(current))
+        elif isinstance(current, dict):
+            digest.update(f"{{{' '.join(map(repr, current))}\n".encode())
+            stack.extend(reversed(list(current.values())))
+        elif isinstance(current, Typing.Interface):
+            digest.update(f"interface {current.name}\n".encode())
+        elif isinstance(current, (lexer.Token, lexer.StreamToken)):
+            digest.update(f"token {current.text!r} {current.type}\n".encode())
+            strings[current.text] = None
+        elif current is None or isinstance(current, (str, int, float)):
+            digest.update(f"{current!r}\n".encode())
+            if isinstance(current, str):
+                strings[current] = None
+        else:
+            # positions and the results of earlier checks are left out
+            attributes = {name: value for name, value in vars(current).items() if name not in DERIVED_ATTRIBUTES}
+            position = ""
+            if isinstance(current, AST.Node):
+                position = f" {current.pos[0] - line} {current.pos[1]}"
+            digest.update(f"<{type(current).__name__}{position} {' '.join(attributes)}\n".encode())
+            stack.extend(reversed(list(attributes.values())))
+    return list(strings)
+
+# The hash of the structure of a declaration and the strings found in it, see hash_node.
+# It is computed once and kept on the declaration, so it is stored with the AST it is in.
+def structure(node:AST.Node) -> tuple[str, list[str]]:
+    if node.structure == None:
+        digest = hashlib.sha256()
+        strings = hash_node(node, node.pos[0], digest)
+        node.structure = (digest.hexdigest(), strings)
+    return node.structure
+
+
+class ASTCache(DiskCache):
+    # Parsed programs stored by a hash of their source and the parser version
+    def __init__(self, directory, max_size = DEFAULT_MAX_SIZE) -> None:
+        super().__init__(directory, max_size, ".ast")
+
+    def key(self, source:bytes) -> str:
+        digest = hashlib.sha256(parser_version().encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    # parse source, or load the AST stored for it by an earlier run
+    def parse(self, source:bytes) -> AST.Blockchain:
+        key = self.key(source)
+
+        data = self.load(key)
+        if data != None:
+            try:
+                return pickle.loads(data)
+            except Exception:
+                # unreadable entries are replaced below
+                pass
+
+        ast = parser.parse_source(source)
+        # hashed before storing, so the type check cache keys of later runs are free
+        for contract in ast.contracts:
+            structure(contract)
+        try:
+            data = pickle.dumps(ast, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            # too deeply nested to serialize, just don't cache it
+            return ast
+        self.store(key, data)
+        return ast
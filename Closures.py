@@ -0,0 +1,469 @@
+from AST import (
+    Blockchain, Contract, MethodDec, Statement, Expression, evaluate_block,
+    AssignmentStmt, SkipStmt, IfStmt, WhileStmt, BindStmt, ThrowStmt, PrintStmt, UnsafeStmt,
+    MethodCall, DelegateCall, Transaction,
+    VariableExpr, FieldExpr, IntConstantExpr, BoolConstantExpr, BinaryOp, UnaryOp, ArrayConstant, ArrayAccess,
+    postfix_chain, bind_names, BINARY_FUNCTIONS, RECURSIVE_CHAIN_LENGTH, METHOD_NAMES, FALLBACK_NAMES,
+)
+from Environment import Environment, Reference, Local, Value
+from State import ContractState, Journal, Reverted, transfer
+
+import gc
+
+# Statements nested deeper than this are run by evaluate_block instead,
+# so running compiled code never recurses much deeper than evaluate would
+MAX_COMPILED_DEPTH = 64
+
+# the binary operators BinaryOp.evaluate knows, others are left to it
+BINARY_OPERATORS = list(BINARY_FUNCTIONS)
+
+def skip(env):
+    pass
+
+# Compiles a blockchain into nested closures once, which are then run instead of evaluate.
+# Operators are picked at compile time and expressions that are only read produce plain
+# python values, they are only boxed where a reference can escape, into a variable,
+# an array or a parameter. Running gives the same output as Blockchain.evaluate,
+# including the way parameters alias what was passed and names are found dynamically.
+class CompiledBlockchain:
+    def __init__(self, ast:Blockchain) -> None:
+        self.ast = ast
+
+        # Names that can be bound above the contracts while running, reading any other name
+        # always gives the same reference, so it is only looked up once per run
+        self.local_names:set[str] = set(METHOD_NAMES) | set(FALLBACK_NAMES)
+        for contract in ast.contracts:
+            for method in self.methods_of(contract):
+                self.local_names.update(method.parameters)
+                self.local_names.update(bind_names(method.statements))
+        self.globals:dict[str, Reference] = {}
+
+        # the methods of each contract by id, the first declaration wins like in Contract.get_method
+        self.methods:dict[int, dict[str, tuple[MethodDec, callable]]] = {}
+        self.bodies:dict[int, callable] = {}
+        self.fallbacks:dict[int, callable] = {}
+        for contract in ast.contracts:
+            methods = {}
+            for method in contract.methods:
+                if method.name not in methods:
+                    methods[method.name] = (method, self.body(method))
+            self.methods[id(contract)] = methods
+            if contract.fallback != None:
+                self.fallback_body(contract.fallback)
+
+        self.transactions = [self.compile_transaction(transaction) for transaction in ast.transactions]
+
+    def methods_of(self, contract:Contract) -> list[MethodDec]:
+        if contract.fallback == None:
+            return contract.methods
+        return contract.methods + [contract.fallback]
+
+    def evaluate(self, env:Environment):
+        self.run(env, self.transactions)
+
+    # like Blockchain.evaluate_stream, every transaction is compiled as it arrives
+    def evaluate_stream(self, env:Environment, transactions):
+        self.run(env, (self.compile_transaction(transaction) for transaction in transactions))
+
+    def run(self, env:Environment, transactions):
+        self.globals.clear()
+        states = [contract.deploy() for contract in self.ast.contracts]
+        for state in states:
+            env.globals[state.name] = Reference(state)
+
+        for contract, state in zip(self.ast.contracts, states):
+            contract.initialize(state, env)
+
+        journal = env.journal = Journal()
+        if env.ledger != None:
+            transactions = env.ledger.replay(states, transactions)
+        for transaction in transactions:
+            journal.transaction(transaction, env)
+
+        for state in states:
+            env.globals.pop(state.name, None)
+
+    def compile_transaction(self, transaction:Transaction):
+        try:
+            return self.statement(transaction, (), 0)
+        except RecursionError:
+            return transaction.evaluate
+
+    # the compiled body of a method, compiled the first time it is asked for
+    def body(self, method:MethodDec):
+        body = self.bodies.get(id(method))
+        if body == None:
+            body = self.method_body(method, METHOD_NAMES + tuple(method.parameters))
+            self.bodies[id(method)] = body
+        return body
+
+    def fallback_body(self, fallback:MethodDec):
+        body = self.fallbacks.get(id(fallback))
+        if body == None:
+            body = self.method_body(fallback, FALLBACK_NAMES)
+            self.fallbacks[id(fallback)] = body
+        return body
+
+    def method_body(self, method:MethodDec, names):
+        try:
+            return self.block(method.statements, ({*names},), 0)
+        except RecursionError:
+            statements = method.statements
+            return lambda env: evaluate_block(statements, env)
+
+    # Statements compile to functions of the environment, scopes holds the names
+    # bound by the method and the var statements around them, innermost last
+    def block(self, statements:list[Statement], scopes, depth):
+        compiled = []
+        for statement in statements:
+            statement = self.statement(statement, scopes, depth)
+            if statement != skip:
+                compiled.append(statement)
+        if compiled == []:
+            return skip
+        if len(compiled) == 1:
+            return compiled[0]
+        compiled = tuple(compiled)
+        def block(env):
+            for statement in compiled:
+                statement(env)
+        return block
+
+    def statement(self, node:Statement, scopes, depth):
+        if depth > MAX_COMPILED_DEPTH:
+            return lambda env: evaluate_block([node], env)
+
+        match node:
+            case SkipStmt():
+                return skip
+            case AssignmentStmt():
+                target = self.reference(node.lhs, scopes)
+                value = self.expression(node.rhs, scopes)
+                def assign(env):
+                    reference = target(env)
+                    result = value(env)
+                    env.journal.record(reference)
+                    reference.value = result
+                return assign
+            case PrintStmt():
+                value = self.expression(node.expression, scopes)
+                return lambda env: print(value(env))
+            case ThrowStmt():
+                message = f"Throws error at {node.pos}"
+                def throw(env):
+                    raise Reverted(message)
+                return throw
+            case IfStmt():
+                cond = self.expression(node.cond, scopes)
+                true_stmts = self.block(node.true_stmts, scopes, depth + 1)
+                false_stmts = self.block(node.false_stmts, scopes, depth + 1)
+                def if_stmt(env):
+                    if cond(env):
+                        true_stmts(env)
+                    else:
+                        false_stmts(env)
+                return if_stmt
+            case WhileStmt():
+                cond = self.expression(node.cond, scopes)
+                stmts = self.block(node.stmts, scopes, depth + 1)
+                def while_stmt(env):
+                    while cond(env):
+                        stmts(env)
+                return while_stmt
+            case BindStmt():
+                # the initializer is run before the variable is bound
+                expr = self.expression(node.expr, scopes)
+                stmts = self.block(node.stmts, scopes + ({node.name},), depth + 1)
+                name = node.name
+                def bind_stmt(env):
+                    env.push({name:Local(expr(env))})
+                    stmts(env)
+                    env.pop()
+                return bind_stmt
+            case UnsafeStmt():
+                return self.statement(node.stmt, scopes, depth + 1)
+            case MethodCall():
+                return self.call(node, scopes)
+        return lambda env: evaluate_block([node], env)
+
+    # Calls do what MethodCall.evaluate does, with the methods
+    # of the contracts looked up in the table built by __init__
+    def call(self, node:MethodCall, scopes):
+        target = self.expression(node.name, scopes)
+        cost = self.expression(node.cost, scopes)
+        arguments = [self.reference(var, scopes) for var in node.vars]
+        method_name = node.method
+
+        # caller, callee and the contract the method is found in, like get_magic_vars
+        match node:
+            case Transaction():
+                caller_expression = self.expression(node.caller, scopes)
+                def magic_vars(env):
+                    caller = caller_expression(env)
+                    callee = target(env)
+                    return caller, callee, callee
+            case DelegateCall():
+                caller_variable = self.variable("caller", scopes, value=True)
+                this = self.variable("this", scopes, value=True)
+                def magic_vars(env):
+                    caller = caller_variable(env)
+                    callee = this(env)
+                    return caller, callee, target(env)
+            case _:
+                this = self.variable("this", scopes, value=True)
+                def magic_vars(env):
+                    caller = this(env)
+                    callee = target(env)
+                    return caller, callee, callee
+
+        methods = self.methods
+        # the id special case of get_method is left to it
+        indexed = method_name != "id"
+
+        def find_method(contract, env):
+            entry = None
+            if indexed and type(contract) is ContractState:
+                entry = methods.get(id(contract.contract))
+            if entry == None:
+                method = contract.get_method(method_name, env)
+                if method == None:
+                    return None, None
+                return method, self.body(method)
+            return entry.get(method_name, (None, None))
+
+        # an argument list of just args passes on what the fallback was called with
+        unrolls = len(node.vars) == 1 and isinstance(node.vars[0], VariableExpr) and node.vars[0].name == "args"
+        unrolled = self.expression(node.vars[0], scopes) if unrolls else None
+
+        pos = node.pos
+        def fallback(env, caller, callee, contract, amount):
+            fallback = contract.fallback
+            if fallback == None:
+                raise RuntimeError(f"Calling nonexistant function at {pos}")
+            args = [argument(env) for argument in arguments]
+            body = self.fallback_body(fallback)
+            journal = env.journal
+            mark = journal.mark()
+            env.push({
+                "caller":Reference(caller),
+                "this":Reference(callee),
+                "cost":Reference(amount),
+                "id":Reference(method_name),
+                "args":Reference(args),
+            })
+            try:
+                body(env)
+            except Reverted:
+                journal.rollback(mark)
+                raise
+            env.pop()
+
+        def call(env):
+            caller, callee, contract = magic_vars(env)
+            method, body = find_method(contract, env)
+            amount = cost(env)
+
+            if method == None:
+                fallback(env, caller, callee, contract, amount)
+                return
+
+            method_env = {
+                "value":Reference(amount),
+                "caller":Reference(caller),
+                "this":Reference(callee),
+            }
+            parameters = method.parameters
+            rolled = unrolled(env) if unrolls else None
+            if isinstance(rolled, list):
+                method_env[parameters[0]] = rolled[0]
+            else:
+                for index in range(len(arguments)):
+                    reference = arguments[index](env)
+                    method_env[parameters[index]] = reference
+
+            journal = env.journal
+            mark = journal.mark()
+            try:
+                transfer(caller, callee, amount, journal)
+
+                env.push(method_env)
+                body(env)
+            except Reverted:
+                journal.rollback(mark)
+                raise
+            env.pop()
+        return call
+
+    # Expressions compile to functions of the environment giving plain values
+    def expression(self, node:Expression, scopes):
+        match node:
+            case IntConstantExpr() | BoolConstantExpr():
+                value = node.value
+                return lambda env: value
+            case VariableExpr():
+                return self.variable(node.name, scopes, value=True)
+            case FieldExpr() | ArrayAccess() if len(postfix_chain(node)[0]) > 1:
+                return self.selections(node, scopes, value=True)
+            case FieldExpr():
+                return self.field(node, scopes, value=True)
+            case ArrayAccess():
+                array = self.expression(node.array, scopes)
+                index = self.expression(node.index, scopes)
+                return lambda env: array(env)[index(env)].value
+            case ArrayConstant():
+                # arrays hold the references their elements evaluated to
+                elements = [self.reference(element, scopes) for element in node.indices]
+                return lambda env: [element(env) for element in elements]
+            case UnaryOp():
+                operand = self.expression(node.operand, scopes)
+                return lambda env: -operand(env)
+            case BinaryOp() if node.op in BINARY_OPERATORS:
+                return self.binary_op(node, scopes)
+        return lambda env: node.evaluate_value(env)
+
+    # Expressions whose reference is needed, to assign to it or pass it on,
+    # compile to functions giving what evaluate would
+    def reference(self, node:Expression, scopes):
+        match node:
+            case VariableExpr():
+                return self.variable(node.name, scopes)
+            case FieldExpr() | ArrayAccess() if len(postfix_chain(node)[0]) > 1:
+                return self.selections(node, scopes)
+            case FieldExpr():
+                return self.field(node, scopes)
+            case ArrayAccess():
+                array = self.expression(node.array, scopes)
+                index = self.expression(node.index, scopes)
+                return lambda env: array(env)[index(env)]
+            case IntConstantExpr() | BoolConstantExpr() | ArrayConstant() | UnaryOp():
+                # a new box every time, like evaluate, since what it is passed to may assign to it
+                value = self.expression(node, scopes)
+                return lambda env: Value(value(env))
+            case BinaryOp() if node.op in BINARY_OPERATORS:
+                value = self.expression(node, scopes)
+                return lambda env: Value(value(env))
+        return node.evaluate
+
+    def binary_op(self, node:BinaryOp, scopes):
+        if node.chain_length > RECURSIVE_CHAIN_LENGTH:
+            return self.binary_chain(node, scopes)
+
+        lhs = self.expression(node.lhs, scopes)
+        rhs = self.expression(node.rhs, scopes)
+
+        # a constant side is kept in the closure instead of being called for,
+        # both sides of && and || are always evaluated
+        function = BINARY_FUNCTIONS[node.op]
+        if isinstance(node.rhs, (IntConstantExpr, BoolConstantExpr)):
+            right = node.rhs.value
+            return lambda env: function(lhs(env), right)
+        if isinstance(node.lhs, (IntConstantExpr, BoolConstantExpr)):
+            left = node.lhs.value
+            return lambda env: function(left, rhs(env))
+        return lambda env: function(lhs(env), rhs(env))
+
+    # a + b + c leans left as deep as the chain is long, so long chains are compiled
+    # into a loop over the right operands instead of closures nested as deep
+    def binary_chain(self, node:BinaryOp, scopes):
+        chain, lhs = node.left_chain()
+        if any(link.op not in BINARY_FUNCTIONS for link in chain):
+            return lambda env: node.evaluate_value(env)
+
+        first = self.expression(lhs, scopes)
+        steps = tuple((BINARY_FUNCTIONS[link.op], self.expression(link.rhs, scopes)) for link in reversed(chain))
+        def binary_chain(env):
+            value = first(env)
+            for function, rhs in steps:
+                value = function(value, rhs(env))
+            return value
+        return binary_chain
+
+    # Selections such as a[i].f[j] lean left one level for every selection, so more than one
+    # is compiled into a loop over them, giving the reference the last one refers to or its value
+    def selections(self, node:Expression, scopes, value = False):
+        chain, inner = postfix_chain(node)
+        first = self.expression(inner, scopes)
+        # the field selected, or the index of the element
+        steps = tuple((link.field, None) if type(link) is FieldExpr else (None, self.expression(link.index, scopes)) for link in reversed(chain))
+        def selections(env):
+            current = first(env)
+            for field, index in steps:
+                if index is None:
+                    reference = current.field(field)
+                else:
+                    reference = current[index(env)]
+                current = reference.value
+            return current if value else reference
+        return selections
+
+    # The field a FieldExpr refers to, or its value. Fields of locals, this most of all,
+    # read the local themselves, saving a call on every access
+    def field(self, node:FieldExpr, scopes, value = False):
+        name = node.field
+        index = None
+        if isinstance(node.name, VariableExpr):
+            index = self.scope_index(node.name.name, scopes)
+        if index != None:
+            variable = node.name.name
+            def local_field(env):
+                reference = env.values[index].get(variable)
+                if reference is None:
+                    reference = env.lookup(variable)
+                field = reference.value.field(name)
+                return field.value if value else field
+            return local_field
+
+        contract_expression = self.expression(node.name, scopes)
+        def field(env):
+            field = contract_expression(env).field(name)
+            return field.value if value else field
+        return field
+
+    # the position from the top of the environment of the scope binding name,
+    # None when it is not bound in the method
+    def scope_index(self, name, scopes) -> int:
+        for depth in range(len(scopes)):
+            if name in scopes[-1 - depth]:
+                return -1 - depth
+        return None
+
+    # Reads a name, returning the reference evaluate would find, or its value.
+    # Locals are in a known scope counted from the top of the environment, unless
+    # a call passed fewer arguments than the method has parameters. Names that are
+    # never bound locally anywhere are looked up once per run.
+    def variable(self, name, scopes, value = False):
+        index = self.scope_index(name, scopes)
+        if index != None:
+            def local(env):
+                reference = env.values[index].get(name)
+                if reference is None:
+                    reference = env.lookup(name)
+                return reference.value if value else reference
+            return local
+
+        if name in self.local_names:
+            if value:
+                return lambda env: env.lookup(name).value
+            return lambda env: env.lookup(name)
+
+        references = self.globals
+        def global_variable(env):
+            reference = references.get(name)
+            if reference is None:
+                reference = env.lookup(name)
+                if reference != None:
+                    references[name] = reference
+            return reference.value if value else reference
+        return global_variable
+
+
+# Compiling makes many small closures and no reference cycles,
+# collecting garbage meanwhile would only walk the AST over and over
+def compile_blockchain(ast:Blockchain) -> CompiledBlockchain:
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return CompiledBlockchain(ast)
+    finally:
+        if collecting:
+            gc.enable()
@@ -0,0 +1,91 @@
+import json
+import sys
+
+class Diagnostic:
+    # A problem found in a program. pos is (line, column) counted from 0,
+    # code names the kind of problem so tools can filter on it.
+    # A located message ends with the position, which is added when it is shown,
+    # so it stays right when the diagnostic is moved
+    def __init__(self, pos, code, message, severity = "error", located = False) -> None:
+        self.pos:tuple[int, int] = pos
+        self.code:str = code
+        self.message:str = message
+        self.severity:str = severity
+        self.located:bool = located
+
+    # the same diagnostic, lines further down
+    def moved(self, lines) -> "Diagnostic":
+        return Diagnostic((self.pos[0] + lines, self.pos[1]), self.code, self.message, self.severity, self.located)
+
+    def text(self) -> str:
+        if self.located:
+            return f"{self.message} at {self.pos}"
+        return self.message
+
+    def format(self) -> str:
+        kind = "Type error" if self.severity == "error" else f"Type {self.severity}"
+        return f"{kind} at line {self.pos[0] + 1} column {self.pos[1] + 1}: \n" + self.text()
+
+    def to_json(self) -> dict:
+        return {
+            "line": self.pos[0] + 1,
+            "column": self.pos[1] + 1,
+            "code": self.code,
+            "severity": self.severity,
+            "message": self.text(),
+        }
+
+
+class DiagnosticLimit(Exception):
+    # raised by Diagnostics.report when no more errors are wanted, to stop checking
+    pass
+
+
+class Diagnostics:
+    # Collects diagnostics as they are found, they are only written out by flush or to_json.
+    # Reporting the error that reaches max_errors raises DiagnosticLimit.
+    def __init__(self, max_errors = None) -> None:
+        self.max_errors:int = max_errors
+        self.diagnostics:list[Diagnostic] = []
+        self.errors = 0
+        # set once the limit was reached, everything after it was never checked
+        self.stopped = False
+        # number of diagnostics already written by flush
+        self.flushed = 0
+
+    def report(self, diagnostic:Diagnostic) -> None:
+        self.diagnostics.append(diagnostic)
+        if diagnostic.severity != "error":
+            return
+        self.errors += 1
+        if self.max_errors != None and self.errors >= self.max_errors:
+            self.stopped = True
+            raise DiagnosticLimit(f"Stopped after {self.errors} errors")
+
+    # errors that can still be reported before the limit, None when there is no limit
+    def remaining(self) -> int:
+        if self.max_errors == None:
+            return None
+        return self.max_errors - self.errors
+
+    def clear(self) -> None:
+        self.diagnostics = []
+        self.errors = 0
+        self.stopped = False
+        self.flushed = 0
+
+    # write the diagnostics not written yet, all at once
+    def flush(self, file = None) -> None:
+        if file == None:
+            file = sys.stdout
+        pending = self.diagnostics[self.flushed:]
+        self.flushed = len(self.diagnostics)
+        if pending:
+            file.write("".join(diagnostic.format() + "\n" for diagnostic in pending))
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "errors": self.errors,
+            "stopped": self.stopped,
+            "diagnostics": [diagnostic.to_json() for diagnostic in self.diagnostics],
+        })
@@ -1,18 +1,46 @@
 class Environment:
+    # Scopes are pushed for every call and var statement, innermost last, and a lookup
+    # finds the innermost binding of a name, also one made by a caller since variables
+    # are scoped dynamically. Every name keeps the stack of references bound to it,
+    # so lookups take the same time however deep the calls are. Contracts are bound
+    # in a table of globals below all scopes.
     def __init__(self, values) -> None:
-        self.values:list[dict[str:Reference]] = [values]
+        self.values:list[dict[str:Reference]] = []
+        self.bindings:dict[str, list[Reference]] = {}
+        self.globals:dict[str, Reference] = {}
+        # undo log of the running blockchain, see State.Journal
+        self.journal = None
+        # where the state is checkpointed and resumed from, see Ledger.Ledger
+        self.ledger = None
+        self.push(values)
 
+    # the scope must not get other names while it is pushed
     def push(self,values):
         self.values.append(values)
+        bindings = self.bindings
+        for name in values:
+            stack = bindings.get(name)
+            if stack is None:
+                bindings[name] = [values[name]]
+            else:
+                stack.append(values[name])
 
     def pop(self):
-        self.values.pop()
+        bindings = self.bindings
+        for name in self.values.pop():
+            bindings[name].pop()
+
+    # pops scopes until depth are left, after a throw left them behind
+    def unwind(self, depth):
+        while len(self.values) > depth:
+            self.pop()
 
     def lookup(self, name) -> "Reference":
-        for i in range(len(self.values)-1,-1,-1):
-            if name in self.values[i]:
-                return self.values[i][name]
-    
+        stack = self.bindings.get(name)
+        if stack:
+            return stack[-1]
+        return self.globals.get(name)
+
     def assign(self,name,value):
         for i in range(len(self.values),0,-1):
             if name in self.values[i]:
@@ -22,6 +50,11 @@ class Reference:
     def __init__(self, value) -> None:
         self.value = value
 
+# The reference of a var statement, made while a transaction runs. Nothing older than the
+# transaction can reach it but through writes that are journaled, so writes to it are not, see State.Journal
+class Local(Reference):
+    pass
+
 class Value:
     def __init__(self, value):
-        self.value = value
\ No newline at end of file
+        self.value = value
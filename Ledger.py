@@ -0,0 +1,116 @@
+import hashlib
+import hmac
+import io
+import pickle
+import sqlite3
+import sys
+
+from State import ContractState
+import Cache
+
+# transactions run between checkpoints
+DEFAULT_BLOCK_SIZE = 1000
+
+# Contracts stored in a field are stored by name, and are the contracts
+# of the resumed run when the state is loaded again
+class StatePickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if type(obj) is ContractState:
+            return obj.name
+        return None
+
+class StateUnpickler(pickle.Unpickler):
+    def __init__(self, data:bytes, states:dict[str, ContractState]) -> None:
+        super().__init__(io.BytesIO(data))
+        self.states = states
+
+    def persistent_load(self, name):
+        return self.states[name]
+
+# Persistent state of a blockchain in an SQLite database. The slots of every contract
+# are written once a block of transactions has run, with the number of transactions
+# run so far, in one commit, so a replay that stops can be resumed from the last
+# committed block by running the same program again, and a longer transaction log
+# goes on from there. The state of a program is bounded by its field declarations,
+# so it is stored whole, and references shared between fields stay shared.
+# Loading the state unpickles it, so like cache entries it starts with an HMAC keyed by
+# Cache.secret_key, and a ledger written by anyone else or changed since is not loaded.
+class Ledger:
+    def __init__(self, path, block_size = DEFAULT_BLOCK_SIZE) -> None:
+        self.path = path
+        self.block_size = block_size
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            # a single row, the last checkpoint
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoint (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    layout TEXT NOT NULL,
+                    transactions INTEGER NOT NULL,
+                    state BLOB NOT NULL
+                )""")
+        self.states:list[ContractState] = None
+        # transactions run, including those of earlier runs
+        self.transactions = 0
+
+    def close(self):
+        self.connection.close()
+
+    # the contracts and their fields, a ledger is only resumed by a program with the same ones
+    def layout(self) -> str:
+        return repr([(state.name, sorted(state.layout.slots.items())) for state in self.states])
+
+    # of the layout, the number of transactions and the pickled state of a checkpoint
+    def mac(self, layout, transactions, data:bytes) -> bytes:
+        return hmac.new(Cache.secret_key(), f"{layout}\0{transactions}\0".encode() + data, hashlib.sha256).digest()
+
+    # Restores the state of the last checkpoint into the deployed states,
+    # returns how many transactions had run by then
+    def resume(self, states:list[ContractState]) -> int:
+        self.states = states
+        row = self.connection.execute("SELECT layout, transactions, state FROM checkpoint").fetchone()
+        if row == None:
+            return 0
+        layout, transactions, data = row
+        if layout != self.layout():
+            raise RuntimeError(f"Ledger {self.path} holds the state of other contracts")
+        mac, data = data[:Cache.MAC_SIZE], data[Cache.MAC_SIZE:]
+        if not hmac.compare_digest(mac, self.mac(layout, transactions, data)):
+            raise RuntimeError(f"Ledger {self.path} was not written by this user or was changed since")
+
+        values = StateUnpickler(data, {state.name: state for state in states}).load()
+        for state, slots in zip(states, values):
+            for reference, value in zip(state.slots, slots):
+                reference.value = value
+        self.transactions = transactions
+        return transactions
+
+    def checkpoint(self):
+        output = io.BytesIO()
+        StatePickler(output, pickle.HIGHEST_PROTOCOL).dump([[reference.value for reference in state.slots] for state in self.states])
+        layout = self.layout()
+        data = output.getvalue()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoint (id, layout, transactions, state) VALUES (0, ?, ?, ?)",
+                (layout, self.transactions, self.mac(layout, self.transactions, data) + data))
+
+    # Passes on the transactions not run before, checkpointing after every block.
+    # Asking for the next transaction means the previous one ran, so when running
+    # one fails nothing after the last checkpoint is committed
+    def replay(self, states:list[ContractState], transactions):
+        skip = self.resume(states)
+        if skip > 0:
+            print(f"Resuming {self.path} after {skip} transactions", file=sys.stderr)
+
+        transactions = iter(transactions)
+        for _ in range(skip):
+            if next(transactions, None) == None:
+                return
+
+        for transaction in transactions:
+            yield transaction
+            self.transactions += 1
+            if self.transactions % self.block_size == 0:
+                self.checkpoint()
+        self.checkpoint()
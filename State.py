@@ -0,0 +1,113 @@
+from Environment import Environment, Reference
+
+# Every contract keeps its balance in the first slot, so paying for a call needs no lookup
+BALANCE_SLOT = 0
+
+# Where the fields of a contract are stored, worked out once per contract declaration
+class Layout:
+    def __init__(self, names:list[str]) -> None:
+        # slot of each field name, the first declaration of a name wins like in FieldExpr.evaluate
+        self.slots:dict[str, int] = {}
+        # slot of each declared field in order, None for later declarations of the same name
+        self.declared:list[int] = []
+        # the balance slot is kept even when there is no balance field
+        self.size = 1
+        for name in names:
+            if name in self.slots:
+                self.declared.append(None)
+                continue
+            if name == "balance":
+                slot = BALANCE_SLOT
+            else:
+                slot = self.size
+                self.size += 1
+            self.slots[name] = slot
+            self.declared.append(slot)
+        self.has_balance = "balance" in self.slots
+
+# A deployed contract. Its fields are references in a fixed slot array, so they can be
+# passed on and assigned to, while the declaration it was deployed from is left alone.
+class ContractState:
+    def __init__(self, contract, layout:Layout) -> None:
+        # the declaration, an AST.Contract or whatever an engine compiled it to
+        self.contract = contract
+        self.name:str = contract.name
+        self.layout = layout
+        self.slots:list[Reference] = [Reference(None) for _ in range(layout.size)]
+        # the reference in the slot of each field name
+        self.fields:dict[str, Reference] = {name: self.slots[slot] for name, slot in layout.slots.items()}
+
+    # the reference of a field, None when the contract has no such field
+    def field(self, name) -> Reference:
+        return self.fields.get(name)
+
+    # the initial values of the declared fields in order
+    def initialize(self, values):
+        for slot, value in zip(self.layout.declared, values):
+            if slot != None:
+                self.slots[slot].value = value
+
+    def get_method(self, name, env):
+        return self.contract.get_method(name, env)
+
+    @property
+    def fallback(self):
+        return self.contract.fallback
+
+# moves amount from the balance of caller to that of callee, contracts without one are skipped
+def transfer(caller:ContractState, callee:ContractState, amount, journal:"Journal"):
+    if caller.layout.has_balance:
+        journal.record(caller.slots[BALANCE_SLOT])
+        caller.slots[BALANCE_SLOT].value -= amount
+    if callee.layout.has_balance:
+        journal.record(callee.slots[BALANCE_SLOT])
+        callee.slots[BALANCE_SLOT].value += amount
+
+
+# raised by throw, reverting the transaction it happens in
+class Reverted(Exception):
+    pass
+
+# Undo log of the writes made by the running transaction. Assignments and balance transfers
+# record the reference they write and the value it held when the transaction began, so each
+# reference is recorded once however often a loop writes it. Locals and boxed temporaries are
+# made during the transaction and are not recorded at all. Calls and transactions note where
+# their writes start, and a throw puts back the values recorded since then, newest first.
+# A throw always unwinds to its transaction, which puts back everything recorded in it.
+class Journal:
+    def __init__(self) -> None:
+        # references and the values they held, flattened into pairs
+        self.entries:list = []
+        # the references in entries
+        self.recorded:set[Reference] = set()
+
+    def record(self, reference:Reference):
+        if type(reference) is Reference and reference not in self.recorded:
+            self.recorded.add(reference)
+            self.entries += (reference, reference.value)
+
+    def mark(self) -> int:
+        return len(self.entries)
+
+    def rollback(self, mark:int):
+        entries = self.entries
+        while len(entries) > mark:
+            value = entries.pop()
+            reference = entries.pop()
+            reference.value = value
+            self.recorded.discard(reference)
+
+    # Runs a transaction, run(env) does the call. When it throws its writes are reverted,
+    # the scopes it left on env are popped and the replay goes on with the next transaction
+    def transaction(self, run, env:Environment):
+        mark = self.mark()
+        depth = len(env.values)
+        try:
+            run(env)
+        except Reverted as error:
+            self.rollback(mark)
+            env.unwind(depth)
+            print(f"Transaction reverted: {error}")
+        # nothing before the transaction can be reverted anymore
+        del self.entries[mark:]
+        self.recorded.clear()
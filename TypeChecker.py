@@ -1,46 +1,542 @@
 from parser import Parser
 
+import AST
+import Cache
 import Typing
+from Diagnostics import Diagnostic, Diagnostics, DiagnosticLimit
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import pickle
+import sys
 
 class TypeChecker:
-    def __init__(self) -> None:
-        # add more functionality or remove class
-        pass
+    def __init__(self, jobs = None, cache:"TypeCheckCache" = None, diagnostics:Diagnostics = None) -> None:
+        # kept after type_check, so streamed transactions can be checked later
+        self.type_environment:Typing.TypeEnvironment = None
+        # number of processes checking method bodies, None checks them in this process
+        self.jobs = jobs
+        # type errors of contracts checked by earlier runs, those contracts are not checked again
+        self.cache = cache
+        # the type errors found, nothing is printed while checking
+        self.diagnostics = diagnostics if diagnostics != None else Diagnostics()
 
+    # Checking stops early once diagnostics reaches its limit, diagnostics.stopped is set then
     def type_check(self, ast):
-        
-        interfaces = {
-            "int":Typing.Int(), 
-            "bool":Typing.Bool(), 
-            "obj":Typing.Interface(
-                "obj",
-                [
-                    Typing.Field("balance", Typing.Type(Typing.Int(), Typing.SecurityLevel(0,max=True)))
-                ],
-                [
-                    Typing.Method("send", {}, Typing.ProcType({}, Typing.CmdType(Typing.SecurityLevel(0,min=True))))
-                ]
-            )
-        }
-
-        for interface in ast.interfaces:
-            interfaces[interface.name] = interface
+        with reporting_to(self.diagnostics):
+            try:
+                self.type_check_program(ast)
+            except DiagnosticLimit:
+                pass
 
-
-        type_environment = Typing.TypeEnvironment({}, interfaces)
+    def type_check_program(self, ast):
+        type_environment = program_environment(ast)
 
         for interface in ast.interfaces:
             interface.type_check(type_environment)
 
         ast.type_check(type_environment)
 
+        self.type_check_methods(ast, type_environment)
+
+        self.type_environment = type_environment
+
+        for transaction in ast.transactions:
+            self.type_check_transaction(transaction)
+
+    # raises DiagnosticLimit when diagnostics reaches its limit
+    def type_check_transaction(self, transaction):
+        with reporting_to(self.diagnostics):
+            transaction.type_check(self.type_environment)
+
+    # The type errors of every method are reported in source order,
+    # whether they come from the cache, a worker process or are found here
+    def type_check_methods(self, ast, type_environment):
+        contracts = ast.contracts
+
+        stored = {}
+        if self.cache != None:
+            keys = self.cache.keys(contracts, type_environment)
+            for index in range(len(contracts)):
+                errors = self.cache.load_errors(keys[index])
+                if errors != None:
+                    stored[index] = errors
+
+        tasks = []
+        for contract_index in range(len(contracts)):
+            if contract_index not in stored:
+                for method_index in range(len(contracts[contract_index].methods)):
+                    tasks.append((contract_index, method_index))
+        results = self.method_results(contracts, type_environment, tasks)
+
+        try:
+            for index in range(len(contracts)):
+                contract = contracts[index]
+                if index in stored:
+                    for diagnostic in stored[index]:
+                        self.diagnostics.report(diagnostic.moved(contract.pos[0]))
+                    continue
+
+                errors = []
+                for _ in contract.methods:
+                    method_errors, error = next(results)
+                    for diagnostic in method_errors:
+                        self.diagnostics.report(diagnostic)
+                    if error != None:
+                        raise error
+                    errors.extend(method_errors)
+
+                if self.cache != None:
+                    self.cache.store_errors(keys[index], errors, contract.pos[0])
+        finally:
+            # stops the workers when checking ends early
+            results.close()
+
+    # the type errors and exception of each task, in the order of the tasks
+    def method_results(self, contracts, type_environment, tasks):
+        jobs = worker_count(self.jobs, tasks)
+        if jobs != None:
+            # Once interfaces and contracts are resolved method bodies are independent,
+            # so they are checked in a process pool, in batches of neighbouring methods.
+            # Type assignments made in the workers are not copied back to this AST.
+            # workers stop a method once it alone has used up what is left of the limit
+            try:
+                context, work = worker_batches(contracts, type_environment, tasks, jobs, self.diagnostics.remaining())
+            except RecursionError:
+                # too deeply nested to send to the workers
+                work = None
+            if work != None:
+                return parallel_results(context, work, jobs)
+
+        return serial_results(contracts, type_environment, tasks, self.diagnostics)
+
+# the type environment of a program, holding its interfaces and the builtin ones
+def program_environment(ast) -> Typing.TypeEnvironment:
+    interfaces = {
+        "int":Typing.INT,
+        "bool":Typing.BOOL,
+        "obj":Typing.OBJ,
+    }
+
+    for interface in ast.interfaces:
+        interfaces[interface.name] = interface
+
+    return Typing.TypeEnvironment({}, interfaces)
+
+# report type errors found by AST nodes to diagnostics
+@contextlib.contextmanager
+def reporting_to(diagnostics:Diagnostics):
+    previous = AST.diagnostics
+    AST.diagnostics = diagnostics
+    try:
+        yield diagnostics
+    finally:
+        AST.diagnostics = previous
+
+# Type check with check, such as the type_check of a method, returning its diagnostics
+# instead of reporting them, along with the exception that stopped the check if there was one
+def collect_type_errors(check, type_environment, max_errors = None):
+    diagnostics = Diagnostics(max_errors)
+    error = None
+    with reporting_to(diagnostics):
+        try:
+            check(type_environment)
+        except Exception as exception:
+            error = exception
+    return diagnostics.diagnostics, error
+
+def serial_results(contracts, type_environment, tasks, diagnostics:Diagnostics):
+    for contract_index, method_index in tasks:
+        contract = contracts[contract_index]
+        type_environment.push({"this":contract.type_assignment})
+        result = collect_type_errors(contract.methods[method_index].type_check, type_environment, diagnostics.remaining())
+        type_environment.pop()
+        yield result
+
+# Starting workers and sending them their batches costs more than checking fewer methods than this
+PARALLEL_THRESHOLD = 256
+
+# how many workers check tasks, None when they are checked in this process:
+# when there are too few to gain from workers or a single core to run them on
+def worker_count(jobs, tasks) -> int:
+    if jobs == None or len(tasks) < PARALLEL_THRESHOLD:
+        return None
+    jobs = min(jobs, os.cpu_count() or 1)
+    if jobs < 2:
+        return None
+    return jobs
+
+# The tasks split into batches for the workers, with the context workers are started in.
+# Forked workers start as a copy of this process, which holds the program, so a batch is
+# just its tasks. Otherwise each batch is sent the type environment, which holds the
+# interfaces, and only the contracts its methods are in, with its tasks renumbered to match.
+def worker_batches(contracts, type_environment, tasks, jobs, max_errors):
+    global worker_state
+    size = max(1, len(tasks) // (jobs * 4))
+    batches = [tasks[start:start + size] for start in range(0, len(tasks), size)]
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        worker_state = (type_environment, contracts, max_errors)
+        return multiprocessing.get_context("fork"), [(None, batch) for batch in batches]
+
+    work = []
+    for batch in batches:
+        first = batch[0][0]
+        last = batch[-1][0]
+        payload = pickle.dumps((type_environment, contracts[first:last + 1], max_errors), pickle.HIGHEST_PROTOCOL)
+        work.append((payload, [(contract_index - first, method_index) for contract_index, method_index in batch]))
+    return None, work
+
+def parallel_results(context, work, jobs):
+    global worker_state
+    executor = ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+    try:
+        for results in executor.map(type_check_batch, work):
+            yield from results
+    finally:
+        executor.shutdown(cancel_futures=True)
+        worker_state = None
+
+
+# environment and contracts of the program checked by forked workers
+worker_state = None
+
+def type_check_batch(work):
+    payload, batch = work
+    if payload != None:
+        type_environment, contracts, max_errors = pickle.loads(payload)
+    else:
+        type_environment, contracts, max_errors = worker_state
+
+    results = []
+    for contract_index, method_index in batch:
+        contract = contracts[contract_index]
+        type_environment.push({"this":contract.type_assignment})
+        results.append(collect_type_errors(contract.methods[method_index].type_check, type_environment, max_errors))
+        type_environment.pop()
+    return results
+
+
+# the name get_interface resolves to the interface
+def interface_key(interface:Typing.Interface) -> str:
+    if isinstance(interface, Typing.Array):
+        return interface_key(interface.contained) + "[]"
+    return interface.name
+
+def find_interface(type_environment:Typing.TypeEnvironment, key) -> Typing.Interface:
+    try:
+        return type_environment.get_interface(key)
+    except KeyError:
+        return None
+
+# Types are compared by the names of their interfaces, so that the answers
+# stay the same when an unchanged interface is parsed again
+def canonical_type(type:Typing.Type):
+    if type is None:
+        return None
+    return (interface_key(type.obj), type.sec.level, type.sec.extreme)
+
+def canonical_method(method:Typing.Method):
+    if method == None:
+        return None
+    variables = tuple((name, canonical_type(method.type.variables[name])) for name in method.type.variables)
+    level = method.type.cmd_level.level
+    return (variables, level.level, level.extreme)
+
+# the interface a key names, arrays are named after the interface they contain
+def interface_name(key) -> str:
+    while key[-2:] == "[]":
+        key = key[:-2]
+    return key
+
+# the names of the interfaces the members of interface have types of
+def referenced_names(interface:Typing.Interface) -> set[str]:
+    names = {interface_name(field.type_name) for field in interface.fields}
+    for method in interface.methods:
+        for name in method.variable_names.values():
+            names.add(interface_name(name))
+    return names
+
+
+class DependencyRecorder:
+    # Collects what a check asked about the rest of the program: the names it looked up
+    # outside of itself, as ("name", name), and the interfaces whose members or subtyping
+    # it used, as ("interface", name). Its result holds as long as none of them changed.
+    def __init__(self, depth) -> None:
+        # names bound below this depth of the type environment are outside the method
+        self.depth:int = depth
+        self.subjects:set[tuple[str, str]] = set()
+
+    def name(self, name, type):
+        self.subjects.add(("name", name))
+
+    def interface(self, name):
+        self.subjects.add(("interface", interface_name(name)))
+
+    def field(self, interface, name, field):
+        self.subjects.add(("interface", interface_name(interface_key(interface))))
+
+    def method(self, interface, name, method):
+        self.subjects.add(("interface", interface_name(interface_key(interface))))
+
+    def subtype(self, interface, other, subtype):
+        self.subjects.add(("interface", interface_name(interface_key(interface))))
+        self.subjects.add(("interface", interface_name(interface_key(other))))
+
+
+class RecordingTypeEnvironment(Typing.TypeEnvironment):
+    # shares the scopes of a type environment, telling the recorder
+    # about names and interfaces the method body looks up outside of itself
+    def __init__(self, type_environment:Typing.TypeEnvironment, recorder:DependencyRecorder) -> None:
+        super().__init__({}, type_environment.interfaces)
+        self.stack = type_environment.stack
+        self.frames = type_environment.frames
+        self.recorder = recorder
+
+    def lookup(self, name) -> Typing.Type:
+        ind = len(self.stack) - 1
+        while ind >= 0:
+            if name in self.stack[ind]:
+                if ind < self.recorder.depth:
+                    self.recorder.name(name, self.stack[ind][name])
+                return self.stack[ind][name]
+            ind -= 1
+        self.recorder.name(name, None)
+
+    def get_interface(self, name:str) -> Typing.Interface:
+        self.recorder.interface(name)
+        return super().get_interface(name)
+
+
+class MethodResult:
+    # The type errors found in a method body or in the fields of a contract,
+    # with lines relative to it, and what the check depended on
+    def __init__(self, line, subjects, errors) -> None:
+        self.subjects:set[tuple[str, str]] = subjects
+        self.errors = [diagnostic.moved(-line) for diagnostic in errors]
+
+    def report(self, node:AST.Node, diagnostics:Diagnostics):
+        for diagnostic in self.errors:
+            diagnostics.report(diagnostic.moved(node.pos[0]))
+
+
+class IncrementalTypeChecker(TypeChecker):
+    # Type checks successive versions of a program, as built by parser.IncrementalParser,
+    # which reuses the interfaces and contracts an edit did not touch. What changed is found
+    # once per check by comparing them with the last version: interfaces that are new,
+    # gone or use one that is, and the names of contracts that are new or gone.
+    # Only those interfaces are resolved again, and only the method bodies and contract fields
+    # that were parsed again or depend on one of them are checked again.
+    # Otherwise the type errors found last time are reported again.
+    def __init__(self, diagnostics:Diagnostics = None) -> None:
+        super().__init__(diagnostics=diagnostics)
+        self.forget()
+        # number of method bodies the last type_check had to check
+        self.rechecked = 0
+
+    # start over, the next check checks everything
+    def forget(self):
+        # results by method or, for its fields, by contract
+        self.results:dict[AST.Node, MethodResult] = {}
+        # the methods and contracts whose results depend on a subject
+        self.dependents:dict[tuple[str, str], set[AST.Node]] = {}
+        # what the last check resolved and declared
+        self.interfaces:set[Typing.Interface] = set()
+        self.contracts:set[AST.Contract] = set()
+        # the interfaces using an interface name, see referenced_names
+        self.users:dict[str, set[Typing.Interface]] = {}
+
+    # diagnostics only holds what was found in the latest version
+    def type_check(self, ast):
+        self.diagnostics.clear()
+        super().type_check(ast)
+
+    def type_check_program(self, ast):
+        type_environment = program_environment(ast)
+        self.rechecked = 0
+        try:
+            changed = self.resolve_interfaces(ast, type_environment)
+            contracts = set(ast.contracts)
+            for contract in contracts ^ self.contracts:
+                changed.add(("name", contract.name))
+            self.contracts = contracts
+
+            stale = set()
+            for subject in changed:
+                stale.update(self.dependents.get(subject, ()))
+            self.type_check_changes(ast, type_environment, stale)
+        except BaseException:
+            # the results are incomplete when checking stops early
+            self.forget()
+            raise
+
+        self.type_environment = type_environment
+
+        for transaction in ast.transactions:
+            self.type_check_transaction(transaction)
+
+    # Resolves the interfaces that are new or use one that is new or gone,
+    # returns them and the gone ones as changed subjects
+    def resolve_interfaces(self, ast, type_environment) -> set[tuple[str, str]]:
+        interfaces = set(ast.interfaces)
+        added = interfaces - self.interfaces
+        removed = self.interfaces - interfaces
+        changed = {("interface", interface.name) for interface in added | removed}
+
+        for interface in removed:
+            for name in referenced_names(interface):
+                self.users[name].discard(interface)
+        for interface in added:
+            for name in referenced_names(interface):
+                self.users.setdefault(name, set()).add(interface)
+
+        resolve = set(added)
+        for _, name in changed:
+            resolve.update(self.users.get(name, ()))
+
+        if resolve:
+            # in source order, so the first unknown interface fails like a full check would
+            for interface in ast.interfaces:
+                if interface in resolve:
+                    interface.type_check(type_environment)
+                    changed.add(("interface", interface.name))
+
+        self.interfaces = interfaces
+        return changed
+
+    def type_check_changes(self, ast, type_environment, stale):
+        results = {}
         for contract in ast.contracts:
+            contract.declare(type_environment)
             type_environment.push({"this":contract.type_assignment})
+            results[contract] = self.result(contract, contract.type_check_fields, type_environment, stale)
+            type_environment.pop()
 
+        for contract in ast.contracts:
+            type_environment.push({"this":contract.type_assignment})
             for method in contract.methods:
-                method.type_check(type_environment)
-
+                results[method] = self.result(method, method.type_check, type_environment, stale)
             type_environment.pop()
 
-        for transaction in ast.transactions:
-            transaction.type_check(type_environment)
\ No newline at end of file
+        # methods and contracts that are gone are forgotten
+        for node in self.results.keys() - results.keys():
+            self.forget_result(node, self.results[node])
+        self.results = results
+
+    # the result of checking node with check, from the last check if it still holds
+    def result(self, node:AST.Node, check, type_environment, stale) -> MethodResult:
+        result = self.results.get(node)
+        if result == None or node in stale:
+            if result != None:
+                self.forget_result(node, result)
+            result = self.type_check_node(node, check, type_environment)
+            for subject in result.subjects:
+                self.dependents.setdefault(subject, set()).add(node)
+            if isinstance(node, AST.MethodDec):
+                self.rechecked += 1
+        result.report(node, self.diagnostics)
+        return result
+
+    def forget_result(self, node:AST.Node, result:MethodResult):
+        for subject in result.subjects:
+            self.dependents[subject].discard(node)
+
+    def type_check_node(self, node:AST.Node, check, type_environment) -> MethodResult:
+        recorder = DependencyRecorder(len(type_environment.stack))
+        Typing.dependency_recorder = recorder
+        try:
+            errors, error = collect_type_errors(check, RecordingTypeEnvironment(type_environment, recorder), self.diagnostics.remaining())
+        finally:
+            Typing.dependency_recorder = None
+        if error != None:
+            # report what was found before the failure, as checking everything would
+            for diagnostic in errors:
+                self.diagnostics.report(diagnostic)
+            raise error
+        return MethodResult(node.pos[0], recorder.subjects, errors)
+
+
+# Modules whose source decides the result of type checking
+CHECKER_MODULES = [AST, Typing, Cache, sys.modules[Diagnostic.__module__], sys.modules[__name__]]
+
+def canonical_interface(interface:Typing.Interface):
+    if isinstance(interface, Typing.Array):
+        return ("array", interface_key(interface.contained))
+    fields = tuple((field.name, canonical_type(field.type)) for field in interface.fields)
+    methods = tuple((method.name, canonical_method(method)) for method in interface.methods)
+    return (type(interface).__name__, interface.name, fields, methods)
+
+# the interfaces named by keys, and every interface their members use,
+# by the name they are reached by, adding to those already reached
+def reachable_interfaces(type_environment:Typing.TypeEnvironment, keys, reached = {}) -> dict[str, Typing.Interface]:
+    reached = dict(reached)
+    stack = list(keys)
+    while stack:
+        key = stack.pop()
+        if key in reached:
+            continue
+        interface = find_interface(type_environment, key)
+        if interface == None:
+            continue
+        reached[key] = interface
+
+        if isinstance(interface, Typing.Array):
+            stack.append(interface_key(interface.contained))
+        for field in interface.fields:
+            stack.append(interface_key(field.type.obj))
+        for method in interface.methods:
+            for variable in method.type.variables:
+                stack.append(interface_key(method.type.variables[variable].obj))
+    return reached
+
+
+class TypeCheckCache(Cache.DiskCache):
+    # The type errors of the methods of each contract, stored by a hash of the contract
+    # and of everything its methods can see: the names in scope, and every interface
+    # reachable from them or named in the contract.
+    # Errors are stored with lines relative to the contract, so moving it keeps the entry.
+    def __init__(self, directory, max_size = Cache.DEFAULT_MAX_SIZE) -> None:
+        super().__init__(directory, max_size, ".check")
+
+    # The keys of contracts, the environment is the one their methods are checked in, without "this".
+    # What they share is hashed once, the structure of each contract is hashed once per parse.
+    def keys(self, contracts:list[AST.Contract], type_environment:Typing.TypeEnvironment) -> list[str]:
+        digest = hashlib.sha256(Cache.source_version(CHECKER_MODULES).encode())
+        names = ["int", "bool", "obj"]
+        for scope in type_environment.stack:
+            for name in scope:
+                digest.update(f"{name} {canonical_type(scope[name])}\n".encode())
+                names.append(interface_key(scope[name].obj))
+        shared = reachable_interfaces(type_environment, names)
+
+        canonical = {}
+        keys = []
+        for contract in contracts:
+            structure, strings = Cache.structure(contract)
+            key = digest.copy()
+            key.update(f"{structure}\nthis {canonical_type(contract.type_assignment)}\n".encode())
+
+            reached = reachable_interfaces(type_environment, [interface_key(contract.type_assignment.obj), *strings], shared)
+            for name in sorted(reached):
+                if name not in canonical:
+                    canonical[name] = f"{canonical_interface(reached[name])}\n".encode()
+                key.update(canonical[name])
+            keys.append(key.hexdigest())
+        return keys
+
+    def load_errors(self, key) -> list[Diagnostic]:
+        data = self.load(key)
+        if data == None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # unreadable entries are checked again and replaced
+            return None
+
+    def store_errors(self, key, errors, line) -> None:
+        errors = [diagnostic.moved(-line) for diagnostic in errors]
+        self.store(key, pickle.dumps(errors, pickle.HIGHEST_PROTOCOL))
@@ -1,10 +1,35 @@
+import weakref
+
+# Set while a method body is checked incrementally, it is told every answer about
+# interface members and subtyping the check relies on, see TypeChecker.DependencyRecorder
+dependency_recorder = None
+
 class Interface:
     def __init__(self, name, fields, methods) -> None:
         self.name = name
         self.fields:list[Field] = fields
         self.methods:list[Method] = methods
+
+        # members by name, the first declaration wins like a linear search would
+        self.field_index:dict[str, Field] = {}
+        for field in fields:
+            self.field_index.setdefault(field.name, field)
+        self.method_index:dict[str, Method] = {}
+        for method in methods:
+            self.method_index.setdefault(method.name, method)
+
+        # Results of self < other, stored with the version of other they were computed for.
+        # The version changes every time an interface is resolved by type_check,
+        # so results about earlier definitions are never reused.
+        self.version = 0
+        # the shared array interface containing this one, see Array.of
+        self.array:Array = None
+        self.subtype_cache:weakref.WeakKeyDictionary[Interface, tuple[int, bool]] = weakref.WeakKeyDictionary()
     
     def type_check(self, type_env:"TypeEnvironment") -> None:
+        self.version += 1
+        self.subtype_cache.clear()
+
         for field in self.fields:
             field.type_check(type_env)
         
@@ -15,27 +40,56 @@ class Interface:
 
         type_env.pop()
 
+    # The builtin interfaces are unpickled as the shared instances, e.g. in worker processes.
+    # Subtyping results are not pickled, they are recomputed where they are needed.
+    def __reduce__(self):
+        if BUILTIN_INTERFACES.get(self.name) is self:
+            return (builtin_interface, (self.name,))
+        return super().__reduce__()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["subtype_cache"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.subtype_cache = weakref.WeakKeyDictionary()
+
     def get_method(self, name) -> "Method":
-        for method in self.methods:
-            if method.name == name:
-                return method
+        method = self.method_index.get(name)
+        if dependency_recorder != None:
+            dependency_recorder.method(self, name, method)
+        return method
 
     def get_field(self, name) -> "Field":
-        for field in self.fields:
-            if field.name == name:
-                return field
+        field = self.field_index.get(name)
+        if dependency_recorder != None:
+            dependency_recorder.field(self, name, field)
+        return field
     
     def __lt__(self, other:"Interface") -> bool:
-        
+        if self is other:
+            return True
+        cached = self.subtype_cache.get(other)
+        if cached != None and cached[0] == other.version:
+            return cached[1]
+
+        result = self.is_subtype(other)
+        self.subtype_cache[other] = (other.version, result)
+        return result
+
+    def is_subtype(self, other:"Interface") -> bool:
+        # the indexes are used directly, the result is recorded as a whole by Type.__lt__
         for field in other.fields:
-            corresponds = self.get_field(field.name)
+            corresponds = self.field_index.get(field.name)
             if corresponds == None:
                 return False
             if not corresponds == field:
                 return False
         
         for method in other.methods:
-            corresponds = self.get_method(method.name)
+            corresponds = self.method_index.get(method.name)
             if corresponds == None:
                 return False
             if not corresponds == method:
@@ -61,14 +115,24 @@ class Array(Interface):
         super().__init__(f"array<{contained.name}>", [
         ], [
         ])
+        self.contained:Interface = contained
+
+    # one array interface per contained interface
+    @classmethod
+    def of(cls, contained) -> "Array":
+        if contained.array == None:
+            contained.array = cls(contained)
+        return contained.array
         
 class Field:
     def __init__(self, name, type) -> None:
         self.name:str = name
         self.type:VarType = type
+        # keep the declared name, so the field can be resolved again
+        self.type_name = type.obj
     
     def type_check(self, type_env:"TypeEnvironment"):
-        self.type.obj = type_env.get_interface(self.type.obj)
+        self.type = Type.of(type_env.get_interface(self.type_name), self.type.sec)
     
     def __lt__(self, other:"Field") -> bool:
         return self.type < other.type
@@ -85,30 +149,60 @@ class Method:
         self.name:str = name
         self.vars:dict[str:Type] = vars
         self.type:ProcType = type
+        # keep the declared names, so the method can be resolved again
+        self.variable_names = {variable: type.variables[variable].obj for variable in type.variables}
+        self.level_name = type.cmd_level
     
     def type_check(self, type_env:"TypeEnvironment"):
         for variable in self.type.variables:
-            self.type.variables[variable].obj = type_env.get_interface(self.type.variables[variable].obj)
-        self.type.cmd_level = CmdType(SecurityLevel(int(self.type.cmd_level)))
+            self.type.variables[variable] = Type.of(type_env.get_interface(self.variable_names[variable]), self.type.variables[variable].sec)
+        self.type.cmd_level = CmdType.of(SecurityLevel.of(int(self.level_name)))
     
     def __eq__(self, other):
         if other == None:
             return False
         return self.type == other.type
 
+# Types, command types and security levels are never changed once created,
+# so equal ones are shared and comparisons can stop at identity.
+# Use the of() constructors to get the shared instance.
+
 class Type:
     def __init__(self, obj, sec) -> None:
         self.obj:Interface = obj
         self.sec:SecurityLevel = sec
+
+    @classmethod
+    def of(cls, obj, sec:"SecurityLevel") -> "Type":
+        # the type keeps obj alive, so its id is not reused while the entry exists
+        key = (id(obj), sec.level, sec.extreme)
+        type = TYPES.get(key)
+        if type is None:
+            type = cls(obj, SecurityLevel.of(sec.level, sec.extreme == -1, sec.extreme == 1))
+            TYPES[key] = type
+        return type
     
+    # shared instances stay shared when unpickled, e.g. in worker processes
+    def __reduce__(self):
+        return (Type.of, (self.obj, self.sec))
+
     def __repr__(self) -> str:
         return f"({self.obj.name}, {self.sec})"
 
     def __lt__(self, other:"Type") -> bool:
+        if self is other:
+            return True
         #TODO: figure out proper interface subtyping
-        return self.sec <= other.sec and self.obj < other.obj
+        if not self.sec <= other.sec:
+            return False
+        subtype = self.obj < other.obj
+        if dependency_recorder != None:
+            dependency_recorder.subtype(self.obj, other.obj, subtype)
+        return subtype
 
     def __eq__(self, value):
+        if self is value:
+            return True
         return self.obj == value.obj and self.sec == value.sec
 
 class VarType:
@@ -124,11 +218,25 @@ class CmdType:
     def __init__(self, level) -> None:
         self.level:SecurityLevel = level
 
+    @classmethod
+    def of(cls, level:"SecurityLevel") -> "CmdType":
+        key = (level.level, level.extreme)
+        cmd_type = CMD_TYPES.get(key)
+        if cmd_type is None:
+            cmd_type = cls(SecurityLevel.of(level.level, level.extreme == -1, level.extreme == 1))
+            CMD_TYPES[key] = cmd_type
+        return cmd_type
+
+    def __reduce__(self):
+        return (CmdType.of, (self.level,))
+
     def join(self,other:"CmdType") -> "CmdType":
         if self.level<other.level:
             return self
         return other
     def __eq__(self, value):
+        if self is value:
+            return True
         return self.level == value.level
 
 
@@ -158,12 +266,26 @@ class SecurityLevel:
         elif max:
             self.extreme = 1
 
+    @classmethod
+    def of(cls, level=0, min=False, max=False) -> "SecurityLevel":
+        key = (level, -1 if min else 1 if max else 0)
+        security_level = SECURITY_LEVELS.get(key)
+        if security_level is None:
+            security_level = cls(level, min, max)
+            SECURITY_LEVELS[key] = security_level
+        return security_level
+
+    def __reduce__(self):
+        return (SecurityLevel.of, (self.level, self.extreme == -1, self.extreme == 1))
+
     def __lt__(self, other) -> bool:
         if self.extreme != other.extreme:
             return self.extreme < other.extreme
         return self.level < other.level
 
     def __le__(self, other) -> bool:
+        if self is other:
+            return True
         if self.extreme < other.extreme:
             return True
         if self.extreme > other.extreme:
@@ -172,6 +294,8 @@ class SecurityLevel:
             return self.level <= other.level
 
     def __eq__(self, other) -> bool:
+        if self is other:
+            return True
         if self.extreme == other.extreme:
             return self.level == other.level
         return self.level == other.level
@@ -192,10 +316,41 @@ class SecurityLevel:
             return "min"
 
 
+# Tables of shared instances, security levels are few so they are kept forever,
+# the rest go away with the interfaces they refer to
+SECURITY_LEVELS:dict[tuple[int, int], SecurityLevel] = {}
+CMD_TYPES:dict[tuple[int, int], CmdType] = {}
+TYPES:weakref.WeakValueDictionary[tuple[int, int, int], Type] = weakref.WeakValueDictionary()
+
+MIN = SecurityLevel.of(min=True)
+MAX = SecurityLevel.of(max=True)
+
+INT = Int()
+BOOL = Bool()
+OBJ = Interface(
+    "obj",
+    [
+        Field("balance", Type.of(INT, MAX))
+    ],
+    [
+        Method("send", {}, ProcType({}, CmdType.of(MIN)))
+    ]
+)
+
+
+BUILTIN_INTERFACES:dict[str, Interface] = {"int": INT, "bool": BOOL, "obj": OBJ}
+
+def builtin_interface(name) -> Interface:
+    return BUILTIN_INTERFACES[name]
+
+
 class TypeEnvironment:
     def __init__(self, globals, interfaces) -> None:
         self.stack:list[dict[str,Type]] = [globals]
         self.interfaces:dict[str,Interface] = interfaces
+        # Scopes inside methods, holding the types of their locals by slot.
+        # Variables are bound to a slot before checking, see AST.resolve_names
+        self.frames:list[list[Type]] = []
 
     def push(self, binding:dict[str:Type]) -> None:
         self.stack.append(binding)
@@ -203,6 +358,12 @@ class TypeEnvironment:
     def pop(self) -> None:
         self.stack.pop()
 
+    def push_frame(self, types:list[Type]) -> None:
+        self.frames.append(types)
+
+    def pop_frame(self) -> None:
+        self.frames.pop()
+
     def lookup(self, name)-> Type:
         ind = len(self.stack) - 1
         while ind >= 0:
@@ -213,5 +374,5 @@ class TypeEnvironment:
     def get_interface(self, name:str) -> Interface:
         # TODO: elegantly handle arrays
         if name[-2:] == "[]":
-            return Array(self.get_interface(name[:-2]))
+            return Array.of(self.get_interface(name[:-2]))
         return self.interfaces[name]
@@ -0,0 +1,394 @@
+from lexer import Lexer, TokenType
+from parser import Parser
+from TypeChecker import TypeChecker
+from Environment import Environment
+from generator import Shape, generate
+import Closures
+import Bytecode
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import gc
+import io
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+USAGE = "Usage is benchmark.py [--repeat N] [--sizes name,...] [--save FILE] [--baseline FILE] [--tolerance FRACTION] [--absolute]"
+
+# Programs the phases are timed on, each scales one dimension of the program up from small
+SIZES = {
+    "small": Shape(interfaces=4, width=4, contracts=8, methods=4, statements=8, depth=2),
+    "medium": Shape(interfaces=8, width=8, contracts=32, methods=4, statements=8, depth=2),
+    "large": Shape(interfaces=16, width=8, contracts=128, methods=4, statements=8, depth=2),
+    "wide": Shape(interfaces=4, width=64, contracts=8, methods=32, statements=8, depth=2),
+    "long": Shape(interfaces=4, width=4, contracts=8, methods=4, statements=128, depth=2),
+    "deep": Shape(interfaces=4, width=4, contracts=8, methods=4, statements=8, depth=8),
+    "ill-typed": Shape(interfaces=8, width=8, contracts=32, methods=4, statements=8, depth=2, errors=0.1),
+}
+
+# lex and parse read tokens one at a time with Lexer.next_token, as main.py does,
+# tokenize and parse-stream time the TokenStream path on its own
+PHASES = ["lex", "parse", "tokenize", "parse-stream", "check"]
+
+# One long transaction looping over fields
+LOOP = """
+interface counter {
+    field balance : (int, 0);
+    field count : (int, 0);
+    field total : (int, 0);
+    method run : ((int, 0) n):0;
+}
+
+contract loop: (counter, 0) {
+    field balance := 0;
+    field count := 0;
+    field total := 0;
+    run (n) {
+        while (this.count < n) do {
+            set this.count := this.count + 1;
+            set this.total := this.total + (this.count * 2);
+        };
+        print this.total;
+    }
+}
+
+loop->loop.run(20000):0;
+"""
+
+# Programs run by every engine, the loop and many short transactions calling each other
+RUNS = {
+    "loop": LOOP,
+    "replay": Shape(interfaces=4, width=4, contracts=8, methods=4, statements=8, depth=2, transactions=3000),
+}
+
+# running a checked program with the tree walker, and with the engines of main.py --engine
+RUN_PHASES = ["run", "run-closure", "run-vm"]
+
+# Programs checked in this process and by one worker per core, as main.py --check-jobs does,
+# with enough methods to be checked by workers, see TypeChecker.PARALLEL_THRESHOLD
+CHECKS = {
+    "methods": Shape(interfaces=8, width=8, contracts=64, methods=8, statements=12, depth=2),
+}
+
+CHECK_PHASES = ["check", "check-parallel"]
+
+# the peak memory of a phase is the lowest of this many runs, see measure
+PEAK_RUNS = 3
+
+# how many times all sizes are measured again when regressions are found, before they are reported
+CONFIRM_RUNS = 2
+
+# a phase is timed on as many inputs one by one as it takes to last at least this long
+MIN_RUN_SECONDS = 0.5
+
+# the size whose time per line the others are compared with to catch scaling regressions
+REFERENCE_SIZE = "small"
+
+# iterations of the calibration loop
+CALIBRATION_SIZE = 20000
+
+# A fixed piece of interpreter work, hashing strings into a table of tuples
+# much like the lexer and parser do, to measure how fast this machine runs Python.
+# Phases are reported in units of it as well, which cancels most of the speed of the
+# machine and the object sizes of the interpreter, so they can be compared with a
+# baseline made elsewhere
+def calibration_work():
+    table = {}
+    for i in range(CALIBRATION_SIZE):
+        key = str(i & 4095)
+        table[key] = (i, key)
+    return table
+
+# the lowest peak memory of PEAK_RUNS runs of the calibration loop
+def calibration_peak() -> int:
+    lowest = None
+    for _ in range(PEAK_RUNS):
+        gc.collect()
+        tracemalloc.start()
+        calibration_work()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if lowest == None or peak < lowest:
+            lowest = peak
+    return lowest
+
+# Each phase works on a fresh copy of the output of the one before it,
+# made by the prepare step, which is not timed
+def prepare(phase, source):
+    match phase:
+        case "lex" | "parse" | "tokenize":
+            return source
+        case "parse-stream":
+            return Lexer(source=source).tokenize()
+        case "check" | "check-parallel":
+            return Parser(Lexer(source=source)).parse()
+        case "run" | "run-closure" | "run-vm":
+            ast = Parser(Lexer(source=source)).parse()
+            TypeChecker().type_check(ast)
+            if phase == "run-closure":
+                return Closures.compile_blockchain(ast)
+            if phase == "run-vm":
+                return Bytecode.compile_program(ast)
+            return ast
+
+def run_phase(phase, data):
+    match phase:
+        case "lex":
+            lexer = Lexer(source=data)
+            while lexer.next_token().type != TokenType.EOF:
+                pass
+        case "parse":
+            Parser(Lexer(source=data)).parse()
+        case "tokenize":
+            Lexer(source=data).tokenize()
+        case "parse-stream":
+            Parser(data).parse()
+        case "check":
+            TypeChecker().type_check(data)
+        case "check-parallel":
+            TypeChecker(jobs=os.cpu_count()).type_check(data)
+        case "run" | "run-closure" | "run-vm":
+            with contextlib.redirect_stdout(io.StringIO()):
+                data.evaluate(Environment({}))
+
+# the phases measured on a size, the engines on the programs of RUNS and both ways of checking on CHECKS
+def phases_of(name) -> list[str]:
+    if name in RUNS:
+        return RUN_PHASES
+    if name in CHECKS:
+        return CHECK_PHASES
+    return PHASES
+
+# Best time of a phase, and the lowest peak memory allocated by PEAK_RUNS runs,
+# each started after collecting garbage, so neither depends on what ran before.
+# Now and then a run also rebuilds the interpreter's table of interned strings,
+# which the lexer adds short-lived names to, that is left out by taking the lowest peak.
+# An untimed run first fills the caches of the interpreter, so a single run is not cold,
+# and its time decides how many inputs are timed, so the best time of a short phase
+# is taken over enough tries to leave out the moments the machine was busy elsewhere.
+# The calibration loop is timed right before every input and its best time is returned
+# as well, so the machine getting faster or slower meanwhile affects both the same way.
+def measure(phase, source):
+    data = prepare(phase, source)
+    start = time.perf_counter()
+    run_phase(phase, data)
+    batch = max(1, math.ceil(MIN_RUN_SECONDS / (time.perf_counter() - start)))
+
+    best = None
+    calibration = None
+    for _ in range(batch):
+        data = prepare(phase, source)
+        gc.collect()
+        start = time.perf_counter()
+        calibration_work()
+        elapsed = time.perf_counter() - start
+        if calibration == None or elapsed < calibration:
+            calibration = elapsed
+
+        gc.collect()
+        start = time.perf_counter()
+        run_phase(phase, data)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    lowest = None
+    for _ in range(PEAK_RUNS):
+        data = prepare(phase, source)
+        gc.collect()
+        tracemalloc.start()
+        run_phase(phase, data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if lowest == None or peak < lowest:
+            lowest = peak
+    return best, calibration, lowest
+
+def benchmark_size(name, calibration_bytes) -> dict:
+    shape = {**SIZES, **RUNS, **CHECKS}[name]
+    source = shape if isinstance(shape, str) else generate(shape, seed=0)
+    lines = source.count("\n")
+    result = {"lines": lines, "bytes": len(source)}
+    for phase in phases_of(name):
+        seconds, calibration_seconds, peak = measure(phase, source)
+        result[phase] = {
+            "seconds": seconds,
+            "lines_per_second": lines / seconds,
+            "peak_bytes": peak,
+            "calibration_seconds": calibration_seconds,
+            # lines per run of the calibration loop, and peak memory in units of its peak
+            "lines_per_calibration": lines / seconds * calibration_seconds,
+            "relative_peak": peak / calibration_bytes,
+        }
+    return result
+
+# Each size is measured in a fresh process, one after the other, like main.py checks a file.
+# What one size leaves behind, memory the allocator holds on to and names interned,
+# would otherwise make the sizes after it faster than when they are measured on their own.
+# The processes hash strings the same way, so sets and dicts of names are laid out alike
+# and the time of checking does not change from one run of the benchmark to the next.
+# All sizes are measured repeat times over, keeping the best of each phase, see keep_best.
+def benchmark(sizes, repeat) -> dict:
+    calibration_bytes = calibration_peak()
+    os.environ["PYTHONHASHSEED"] = "0"
+    results = None
+    for _ in range(repeat):
+        measured = {}
+        with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+            for name in sizes:
+                measured[name] = executor.submit(benchmark_size, name, calibration_bytes).result()
+        measured = {"calibration_peak_bytes": calibration_bytes, "sizes": measured}
+        if results == None:
+            results = measured
+        else:
+            keep_best(results, measured)
+    return results
+
+def print_results(results):
+    sizes = [name for name in results if name in SIZES]
+    if sizes:
+        widths = [max(12, len(phase)) + 8 for phase in PHASES]
+        print(f"{'size':<10} {'lines':>7} " + " ".join(f"{phase + ' lines/s':>{width}} {'peak KiB':>9}" for phase, width in zip(PHASES, widths)))
+        for name in sizes:
+            result = results[name]
+            row = f"{name:<10} {result['lines']:>7} "
+            row += " ".join(f"{result[phase]['lines_per_second']:>{width},.0f} {result[phase]['peak_bytes'] / 1024:>9,.0f}" for phase, width in zip(PHASES, widths))
+            print(row)
+
+    # each engine with its speedup over the tree walker, and checking by workers over checking here
+    for programs, phases in ((RUNS, RUN_PHASES), (CHECKS, CHECK_PHASES)):
+        names = [name for name in results if name in programs]
+        if not names:
+            continue
+        print(f"{'program':<10} {'lines':>7} " + " ".join(f"{phase + ' s':>15} {'speedup':>8}" for phase in phases))
+        for name in names:
+            result = results[name]
+            row = f"{name:<10} {result['lines']:>7} "
+            row += " ".join(f"{result[phase]['seconds']:>15.3f} {result[phases[0]]['seconds'] / result[phase]['seconds']:>7.2f}x" for phase in phases)
+            print(row)
+
+# Keep the faster time and the lower peak of each phase in results, of those measured again.
+# Timing on a busy machine only ever comes out slower, so the best of several runs is the closest
+def keep_best(results, again):
+    for name in again["sizes"]:
+        for phase in phases_of(name):
+            current = results["sizes"][name][phase]
+            other = again["sizes"][name][phase]
+            if other["lines_per_calibration"] > current["lines_per_calibration"]:
+                for key in ("seconds", "lines_per_second", "calibration_seconds", "lines_per_calibration"):
+                    current[key] = other[key]
+            if other["peak_bytes"] < current["peak_bytes"]:
+                current["peak_bytes"] = other["peak_bytes"]
+                current["relative_peak"] = other["relative_peak"]
+
+# time per line relative to the reference size, growing ratios mean a phase scales worse than linearly
+def scaling(results, name, phase) -> float:
+    if REFERENCE_SIZE not in results or phase not in results[REFERENCE_SIZE]:
+        return None
+    reference = results[REFERENCE_SIZE][phase]["lines_per_calibration"]
+    return reference / results[name][phase]["lines_per_calibration"]
+
+# Compares with a baseline, returns the regressions found.
+# By default only numbers that hold across machines are compared: throughput and peak memory
+# in units of the calibration loop, and how much slower per line each size is than the reference.
+# With absolute, lines per second and peak bytes are compared as well, which only makes sense
+# against a baseline saved on the same machine.
+def compare(results, baseline, tolerance, absolute = False) -> list[str]:
+    results = results["sizes"]
+    baseline = baseline["sizes"]
+    regressions = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for phase in phases_of(name):
+            if phase not in baseline[name]:
+                continue
+            current = results[name][phase]
+            previous = baseline[name][phase]
+            if current["lines_per_calibration"] < previous["lines_per_calibration"] / (1 + tolerance):
+                regressions.append(f"{name} {phase}: {current['lines_per_calibration']:,.0f} lines per calibration run, was {previous['lines_per_calibration']:,.0f}")
+            if current["relative_peak"] > previous["relative_peak"] * (1 + tolerance):
+                regressions.append(f"{name} {phase}: peak {current['relative_peak']:.2f} times the calibration peak, was {previous['relative_peak']:.2f}")
+            if absolute:
+                if current["lines_per_second"] < previous["lines_per_second"] / (1 + tolerance):
+                    regressions.append(f"{name} {phase}: {current['lines_per_second']:,.0f} lines/s, was {previous['lines_per_second']:,.0f}")
+                if current["peak_bytes"] > previous["peak_bytes"] * (1 + tolerance):
+                    regressions.append(f"{name} {phase}: peak {current['peak_bytes']:,} bytes, was {previous['peak_bytes']:,}")
+
+            ratio = scaling(results, name, phase)
+            previous_ratio = scaling(baseline, name, phase)
+            if ratio != None and previous_ratio != None and ratio > previous_ratio * (1 + tolerance):
+                regressions.append(f"{name} {phase}: {ratio:.2f} times slower per line than {REFERENCE_SIZE}, was {previous_ratio:.2f}")
+    return regressions
+
+def main():
+    repeat = 3
+    sizes = [*SIZES, *RUNS, *CHECKS]
+    save = None
+    baseline_file = None
+    tolerance = 0.25
+    absolute = False
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "--absolute":
+            absolute = True
+            i += 1
+            continue
+        if i + 1 >= len(sys.argv):
+            print(f"Missing value for {sys.argv[i]}")
+            print(USAGE)
+            exit()
+        match sys.argv[i]:
+            case "--repeat":
+                repeat = int(sys.argv[i + 1])
+            case "--sizes":
+                sizes = sys.argv[i + 1].split(",")
+            case "--save":
+                save = sys.argv[i + 1]
+            case "--baseline":
+                baseline_file = sys.argv[i + 1]
+            case "--tolerance":
+                tolerance = float(sys.argv[i + 1])
+            case _:
+                print(f"Invalid argument {sys.argv[i]}")
+                print(USAGE)
+                exit()
+        i += 2
+
+    for name in sizes:
+        if name not in SIZES and name not in RUNS and name not in CHECKS:
+            print(f"Unknown size {name}, the sizes are " + ", ".join([*SIZES, *RUNS, *CHECKS]))
+            exit()
+
+    results = benchmark(sizes, repeat)
+    print_results(results["sizes"])
+
+    if save != None:
+        with open(save, "w") as file:
+            json.dump(results, file, indent=4)
+            file.write("\n")
+
+    if baseline_file == None:
+        return
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, tolerance, absolute)
+    for _ in range(CONFIRM_RUNS):
+        if not regressions:
+            break
+        print(f"Measuring again to confirm {len(regressions)} regressions")
+        keep_best(results, benchmark(sizes, 1))
+        regressions = compare(results, baseline, tolerance, absolute)
+    for regression in regressions:
+        print("Regression: " + regression)
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions against {baseline_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import random
+import sys
+
+USAGE = "Usage is generator.py [--seed N] [--interfaces N] [--width N] [--contracts N] [--methods N] [--statements N] [--depth N] [--transactions N] [--errors RATE]"
+
+# How large a generated program is
+class Shape:
+    def __init__(self, interfaces = 4, width = 4, contracts = 8, methods = 4, statements = 8, depth = 2, transactions = 8, errors = 0.0) -> None:
+        self.interfaces = interfaces
+        # fields of every interface, besides balance and the loop counters
+        self.width = width
+        self.contracts = contracts
+        # methods of every interface, all contracts implement all of them
+        self.methods = methods
+        # statements at the top of every method body
+        self.statements = statements
+        # how deep if, while and var statements are nested
+        self.depth = depth
+        self.transactions = transactions
+        # chance of a statement being ill-typed, 0 generates well-typed programs
+        self.errors = errors
+
+
+# Generates TinySol programs from a seed, the same seed and shape always give the same program.
+# Well-typed programs check without errors and terminate when run:
+# loops count down a counter field of their own nesting depth, and methods only call
+# contracts declared after their own, at most once and outside of loops.
+class Generator:
+    def __init__(self, shape:Shape, seed = 0) -> None:
+        self.shape = shape
+        self.random = random.Random(seed)
+        self.lines:list[str] = []
+        self.variables = 0
+
+    def generate(self) -> str:
+        self.lines = []
+        for index in range(self.shape.interfaces):
+            self.interface(index)
+        for index in range(self.shape.contracts):
+            self.contract(index)
+        for _ in range(self.shape.transactions):
+            self.transaction()
+        return "\n".join(self.lines) + "\n"
+
+    def emit(self, indent, text):
+        self.lines.append("    " * indent + text)
+
+    def interface(self, index):
+        self.emit(0, f"interface I{index} {{")
+        self.emit(1, "field balance : (int, 1);")
+        self.emit(1, "field low : (int, 0);")
+        for field in range(self.shape.width):
+            self.emit(1, f"field f{field} : (int, 1);")
+        for depth in range(self.shape.depth + 1):
+            self.emit(1, f"field c{depth} : (int, 1);")
+        for method in range(self.shape.methods):
+            self.emit(1, f"method m{method} : ((int, 1) a, (bool, 1) b):1;")
+        self.emit(0, "}")
+        self.emit(0, "")
+
+    def contract(self, index):
+        self.emit(0, f"contract C{index} : (I{index % self.shape.interfaces}, 1) {{")
+        self.emit(1, "field balance := 100;")
+        self.emit(1, "field low := 0;")
+        for field in range(self.shape.width):
+            self.emit(1, f"field f{field} := {self.random.randint(0, 9)};")
+        for depth in range(self.shape.depth + 1):
+            self.emit(1, f"field c{depth} := 0;")
+        for method in range(self.shape.methods):
+            self.method(index, method)
+        self.emit(0, "}")
+        self.emit(0, "")
+
+    def method(self, contract, method):
+        self.emit(1, f"m{method} (a, b) {{")
+        # one call to a later contract, so running a transaction always ends
+        call = -1
+        if contract + 1 < self.shape.contracts:
+            call = self.random.randrange(self.shape.statements)
+        for statement in range(self.shape.statements):
+            if statement == call:
+                target = self.random.randrange(contract + 1, self.shape.contracts)
+                self.emit(2, f"call C{target}.m{self.random.randrange(self.shape.methods)}({self.int_expression(2)}, {self.bool_expression(2)});")
+            else:
+                self.statement(2, 0)
+                self.lines[-1] += ";"
+        self.emit(1, "}")
+
+    def transaction(self):
+        contract = self.random.randrange(self.shape.contracts)
+        method = self.random.randrange(self.shape.methods)
+        argument = self.random.randint(0, 9)
+        boolean = self.random.choice(["T", "F"])
+        self.emit(0, f"C{contract} -> C{contract}.m{method}({argument}, {boolean}):0;")
+
+    # statement at nesting depth, the caller adds the semicolon after the last line
+    def statement(self, indent, depth):
+        if self.random.random() < self.shape.errors:
+            self.ill_typed_statement(indent)
+            return
+
+        kinds = ["set", "set", "set", "skip", "print"]
+        if depth < self.shape.depth:
+            kinds += ["if", "while", "var"]
+        match self.random.choice(kinds):
+            case "set":
+                self.emit(indent, f"set this.f{self.random.randrange(self.shape.width)} := {self.int_expression(2)}")
+            case "skip":
+                self.emit(indent, "skip")
+            case "print":
+                self.emit(indent, f"print {self.int_expression(1)}")
+            case "if":
+                self.emit(indent, f"if ({self.bool_expression(2)}) then {{")
+                self.block(indent + 1, depth + 1)
+                self.emit(indent, "} else {")
+                self.block(indent + 1, depth + 1)
+                self.emit(indent, "}")
+            case "while":
+                # counters of enclosing loops are never written inside them
+                counter = f"this.c{depth}"
+                self.emit(indent, f"set {counter} := {self.random.randint(1, 3)};")
+                self.emit(indent, f"while (0 < {counter}) do {{")
+                self.emit(indent + 1, f"set {counter} := {counter} - 1;")
+                self.block(indent + 1, depth + 1)
+                self.emit(indent, "}")
+            case "var":
+                self.variables += 1
+                self.emit(indent, f"var v{self.variables} : 1 := {self.int_expression(2)} in")
+                self.statement(indent + 1, depth + 1)
+
+    def block(self, indent, depth):
+        for _ in range(self.random.randint(1, 2)):
+            self.statement(indent, depth)
+            self.lines[-1] += ";"
+
+    # statements with exactly one type error
+    def ill_typed_statement(self, indent):
+        field = f"this.f{self.random.randrange(self.shape.width)}"
+        match self.random.randrange(3):
+            case 0:
+                self.emit(indent, f"set {field} := {self.bool_expression(1)}")
+            case 1:
+                self.emit(indent, f"set {field} := b + {self.int_expression(1)}")
+            case 2:
+                # writes below the level of the method
+                self.emit(indent, f"set this.low := {self.random.randint(0, 9)}")
+
+    def int_expression(self, depth) -> str:
+        if depth == 0 or self.random.random() < 0.4:
+            match self.random.randrange(4):
+                case 0:
+                    return str(self.random.randint(0, 9))
+                case 1:
+                    return "a"
+                case 2:
+                    return "value"
+                case 3:
+                    return f"this.f{self.random.randrange(self.shape.width)}"
+        op = self.random.choice(["+", "-", "*"])
+        return f"({self.int_expression(depth - 1)} {op} {self.int_expression(depth - 1)})"
+
+    def bool_expression(self, depth) -> str:
+        if depth == 0 or self.random.random() < 0.3:
+            return self.random.choice(["b", "T", "F"])
+        match self.random.randrange(3):
+            case 0:
+                op = self.random.choice(["<", "<=", ">=", "=="])
+                return f"({self.int_expression(depth - 1)} {op} {self.int_expression(depth - 1)})"
+            case 1:
+                op = self.random.choice(["&&", "||"])
+                return f"({self.bool_expression(depth - 1)} {op} {self.bool_expression(depth - 1)})"
+            case 2:
+                return f"({self.bool_expression(depth - 1)} == {self.bool_expression(depth - 1)})"
+
+
+def generate(shape:Shape, seed = 0) -> str:
+    return Generator(shape, seed).generate()
+
+
+def main():
+    shape = Shape()
+    seed = 0
+    integer_options = ["--interfaces", "--width", "--contracts", "--methods", "--statements", "--depth", "--transactions"]
+    i = 1
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            print(f"Missing value for {sys.argv[i]}")
+            print(USAGE)
+            exit()
+        if sys.argv[i] == "--seed":
+            seed = int(sys.argv[i + 1])
+        elif sys.argv[i] == "--errors":
+            shape.errors = float(sys.argv[i + 1])
+        elif sys.argv[i] in integer_options:
+            setattr(shape, sys.argv[i][2:], int(sys.argv[i + 1]))
+        else:
+            print(f"Invalid argument {sys.argv[i]}")
+            print(USAGE)
+            exit()
+        i += 2
+    print(generate(shape, seed), end="")
+
+
+if __name__ == "__main__":
+    main()
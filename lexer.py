@@ -1,12 +1,16 @@
+import re
+import sys
+from array import array
+from bisect import bisect_right
 from enum import Enum, auto
 
-WHITESPACE = [
+WHITESPACE = {
     " ",
     "\t",
     "\n",
-]
+}
 
-CONTROL = [
+CONTROL = {
     "(",
     ")",
     "+",
@@ -29,14 +33,14 @@ CONTROL = [
     "[",
     "]",
     "\""
-]
+}
 
-BOOL_CONSTANTS= [
+BOOL_CONSTANTS= {
     "T",
     "F",
-]
+}
 
-KEYWORDS = [
+KEYWORDS = {
     "contract",
     "interface",
     "field",
@@ -53,6 +57,17 @@ KEYWORDS = [
     "print",
     "unsafe",
     "dcall"
+}
+
+# two character control sequences, these take priority over single characters
+COMPOUND_CONTROL = [
+    "||",
+    "&&",
+    "->",
+    ":=",
+    "==",
+    "<=",
+    ">=",
 ]
 
 COMMENT = "#"
@@ -68,6 +83,29 @@ class TokenType(Enum):
 
 
 
+# Whitespace and comments between tokens
+SKIP_PATTERN = re.compile(
+    "(?:[" + re.escape("".join(WHITESPACE)) + "]|" + re.escape(COMMENT) + "[^\n]*)+"
+)
+
+# One alternative per kind of token, tried in order at the cursor.
+# Quotes always start a string, so they are not part of the control alternative.
+TOKEN_PATTERN = re.compile(
+    "(?P<number>\\d+)"
+    + "|\"(?P<string>[^\"]*)\""
+    + "|(?P<name>[^\\W\\d]\\w*)"
+    + "|(?P<control>"
+    + "|".join(re.escape(control) for control in COMPOUND_CONTROL)
+    + "|[" + re.escape("".join(sorted(CONTROL - {"\""}))) + "])"
+)
+
+TOKEN_KINDS = {
+    "number": TokenType.CONSTANT,
+    # TODO: handle escaping characters
+    "string": TokenType.KEYWORD,
+    "control": TokenType.CONTROL,
+}
+
 class Token:
     def __init__(self, _text, _type, _pos) -> None:
         self.text = _text
@@ -76,27 +114,21 @@ class Token:
     def __str__(self) -> str:
         return f"({self.text}, {self.type})"
 
-class Lexer:
-    def __init__(self, filename) -> None:
-        self.ch:str = 'k'
-        self.file = open(filename, "r")
-        self.line = 0
-        self.char = 0
-        self.next_character()
-        self.lookahead_buffer = None
-    #return the location of the current character
-    def tell(self):
-        return (self.line, self.char)
-    
-    def next_character(self) -> str:
-        out = self.ch
-        self.char += 1
-        if out == "\n":
-            self.char = 0
-            self.line += 1
-        self.ch = self.file.read(1)
-        return out
+# Turn an in-memory source into program text.
+# Accepts str, bytes-like objects holding utf-8 and open text streams,
+# newlines are translated the same way as when reading a file in text mode.
+def read_source(source) -> str:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = str(source, "utf-8")
+    elif not isinstance(source, str):
+        source = source.read()
+    if "\r" in source:
+        source = source.replace("\r\n", "\n").replace("\r", "\n")
+    return source
 
+class TokenReader:
+    # The forward-only token interface the parser reads from, next_token, lookahead and expect.
+    # Subclasses provide next_token and start with lookahead_buffer set to None
 
     # return the next token that will be generated, can only look one token ahead
     def lookahead(self) -> Token:
@@ -114,76 +146,302 @@ class Lexer:
             raise SyntaxError(f"Expected {text} but got {out.text} at {out.pos}")
         return out
 
+
+class SourceScanner(TokenReader):
+    # Lexes the text in source forwards from cursor, keeping track of lines.
+    # Lexer holds the whole source, ChunkedLexer only the part not lexed yet
+    def __init__(self, source:str) -> None:
+        self.source:str = source
+        self.cursor = 0
+        self.line = 0
+        # index of the first character of the current line,
+        # -1 so that positions on the first line match the old column count
+        self.line_start = -1
+        self.lookahead_buffer = None
+
+    #return the location of the current character
+    def tell(self):
+        return (self.line, self.cursor - self.line_start)
+
+    # move the cursor to end, keeping track of the lines passed
+    def advance(self, end) -> None:
+        newlines = self.source.count("\n", self.cursor, end)
+        if newlines:
+            self.line += newlines
+            self.line_start = self.source.rindex("\n", self.cursor, end) + 1
+        self.cursor = end
+
+    # move past whitespace and comments
+    def skip(self) -> None:
+        skipped = SKIP_PATTERN.match(self.source, self.cursor)
+        if skipped:
+            self.advance(skipped.end())
+
     def next_token(self) -> Token:
         if self.lookahead_buffer != None:
             out = self.lookahead_buffer
             self.lookahead_buffer = None
             return out
 
-        while self.ch in WHITESPACE or self.ch == COMMENT:
-            if self.ch == COMMENT:
-                while self.ch != "\n":
-                    self.next_character()
+        self.skip()
+
+        if self.cursor >= len(self.source):
+            return Token("EOF", TokenType.EOF, self.tell())
+
+        match = TOKEN_PATTERN.match(self.source, self.cursor)
+        if match == None:
+            if self.source[self.cursor] == "\"":
+                raise SyntaxError(f"Unterminated string at {self.tell()}")
+            raise SyntaxError(f"Unexpected character {self.source[self.cursor]!r} at {self.tell()}")
+        self.advance(match.end())
+
+        kind = match.lastgroup
+        text = match.group(kind)
+
+        if kind == "name":
+            if text in KEYWORDS:
+                return Token(text, TokenType.KEYWORD, self.tell())
+            if text in BOOL_CONSTANTS:
+                return Token(text, TokenType.CONSTANT, self.tell())
+            return Token(text, TokenType.IDENTIFIER, self.tell())
+
+        return Token(text, TOKEN_KINDS[kind], self.tell())
+
+
+class Lexer(SourceScanner):
+    def __init__(self, filename = None, source = None) -> None:
+        # The whole source is read once and scanned with a cursor,
+        # instead of pulling single characters from the file.
+        if source != None:
+            source = read_source(source)
+        else:
+            with open(filename, "r") as file:
+                source = file.read()
+        super().__init__(source)
+
+    # continue lexing from offset, as if everything before it had been read,
+    # lines are counted from an earlier offset start known to be on line
+    def seek(self, offset, start = 0, line = 0) -> None:
+        newline = self.source.rfind("\n", 0, start)
+        self.cursor = start
+        self.line = line
+        self.line_start = newline + 1 if newline != -1 else -1
+        self.lookahead_buffer = None
+        self.advance(offset)
+
+    # offset where the next token starts, only valid when nothing is buffered
+    def token_start(self) -> int:
+        skipped = SKIP_PATTERN.match(self.source, self.cursor)
+        if skipped:
+            return skipped.end()
+        return self.cursor
+
+    # tokenize the rest of the source into a compact TokenStream, starting at the cursor
+    # with the same positions next_token would give. A token already looked ahead has
+    # no start offset to begin the stream from, so tokenize is refused then
+    def tokenize(self) -> "TokenStream":
+        if self.lookahead_buffer != None:
+            raise RuntimeError(f"Cannot tokenize after looking ahead at {self.lookahead_buffer.pos}")
+        return TokenStream(self.source, self.cursor)
+
+
+class ChunkedLexer(SourceScanner):
+    # Reads the source a chunk at a time and forgets what has been lexed,
+    # so arbitrarily long inputs such as transaction logs use constant memory.
+    # The buffer only ever holds whole lines, since no token except strings spans a line.
+    def __init__(self, filename = None, stream = None, chunk_size = 1 << 16) -> None:
+        if stream == None:
+            stream = open(filename, "r")
+        super().__init__("")
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.exhausted = False
+        # start of a line that has not been fully read yet
+        self.partial = ""
+
+    # the next whole lines of the stream, or the rest of it once it is exhausted
+    def read_chunk(self) -> str:
+        chunk = self.stream.read(self.chunk_size)
+        if chunk == "":
+            self.exhausted = True
+            self.stream.close()
+            chunk = self.partial
+            self.partial = ""
+            return chunk
+        chunk = self.partial + chunk
+        end = chunk.rfind("\n") + 1
+        self.partial = chunk[end:]
+        return chunk[:end]
+
+    # drop the text before the cursor, offsets are relative to the buffer so they move with it
+    def discard(self) -> None:
+        self.source = self.source[self.cursor:]
+        self.line_start -= self.cursor
+        self.cursor = 0
+
+    def skip(self) -> None:
+        if self.cursor >= self.chunk_size:
+            self.discard()
+
+        super().skip()
+        while not self.exhausted and self.cursor >= len(self.source):
+            # everything read has been lexed, so the buffer is emptied before adding to it
+            self.discard()
+            self.source = self.read_chunk()
+            super().skip()
+
+        # strings may span lines, read until they are closed. Only the new chunks
+        # are searched for the closing quote, and they are joined once it is found
+        if (not self.exhausted and self.cursor < len(self.source)
+                and self.source[self.cursor] == "\"" and self.source.find("\"", self.cursor + 1) == -1):
+            chunks = [self.source]
+            while not self.exhausted:
+                chunk = self.read_chunk()
+                chunks.append(chunk)
+                if "\"" in chunk:
+                    break
+            self.source = "".join(chunks)
+
+
+# Kind codes stored in TokenStream.kinds, strings get their own code
+# since their text does not include the quotes around them
+STREAM_KINDS = [
+    TokenType.EOF,
+    TokenType.IDENTIFIER,
+    TokenType.KEYWORD,
+    TokenType.CONSTANT,
+    TokenType.CONTROL,
+    TokenType.KEYWORD,
+]
+STRING_KIND = 5
+
+STREAM_KIND_CODES = {
+    "number": 3,
+    "string": STRING_KIND,
+    "control": 4,
+}
+
+
+class TokenStream:
+    # Tokens of a whole source, stored as parallel columns of kind, start and end offsets.
+    # Text is sliced from the source and positions are computed only when asked for,
+    # so the same stream can be parsed many times for a fraction of the memory of Tokens.
+    # Lexing starts at offset start, positions are counted from the start of source.
+    def __init__(self, source:str, start = 0) -> None:
+        self.source = source
+        self.kinds = array("B")
+        self.starts = array("q")
+        self.ends = array("q")
+
+        self.line_starts = array("q", [0])
+        newline = source.find("\n")
+        while newline != -1:
+            self.line_starts.append(newline + 1)
+            newline = source.find("\n", newline + 1)
+
+        cursor = start
+        while True:
+            skipped = SKIP_PATTERN.match(source, cursor)
+            if skipped:
+                cursor = skipped.end()
+
+            if cursor >= len(source):
+                self.append(0, cursor, cursor)
+                return
+
+            match = TOKEN_PATTERN.match(source, cursor)
+            if match == None:
+                if source[cursor] == "\"":
+                    raise SyntaxError(f"Unterminated string at {self.offset_pos(cursor)}")
+                raise SyntaxError(f"Unexpected character {source[cursor]!r} at {self.offset_pos(cursor)}")
+            cursor = match.end()
+
+            kind = match.lastgroup
+            start, end = match.span(kind)
+            if kind == "name":
+                text = match.group(kind)
+                if text in KEYWORDS:
+                    self.append(2, start, end)
+                elif text in BOOL_CONSTANTS:
+                    self.append(3, start, end)
+                else:
+                    self.append(1, start, end)
             else:
-                self.next_character()
+                self.append(STREAM_KIND_CODES[kind], start, end)
 
-        
-        if self.ch == COMMENT:
-            while self.ch != "\n":
-                self.next_character()
+    def append(self, kind, start, end) -> None:
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
 
-        if self.ch == "":
-            return Token("EOF", TokenType.EOF, self.tell())
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, index) -> "StreamToken":
+        return StreamToken(self, index)
+
+    def type(self, index) -> TokenType:
+        return STREAM_KINDS[self.kinds[index]]
+
+    def text(self, index) -> str:
+        if self.kinds[index] == 0:
+            return "EOF"
+        return sys.intern(self.source[self.starts[index]:self.ends[index]])
+
+    # position of a token, following Lexer.tell right after the token has been read
+    def pos(self, index) -> tuple[int, int]:
+        end = self.ends[index]
+        if self.kinds[index] == STRING_KIND:
+            end += 1
+        return self.offset_pos(end)
 
-        if self.ch.isdigit():
-            num = ""
-            while self.ch.isdigit():
-                num += self.next_character()
-            return Token(num, TokenType.CONSTANT, self.tell())
-
-
-        # TODO: handle escaping characters
-        if self.ch == "\"":
-            self.next_character()
-            word = ""
-            while self.ch != "\"":
-                word += self.next_character()
-            self.next_character()
-            return Token(word, TokenType.KEYWORD, self.tell()) 
-
-        if self.ch.isalpha() or self.ch == "_":
-            name = ""
-            while self.ch.isalnum() or self.ch == "_":
-                name += self.next_character()
-            if name in KEYWORDS:
-                return Token(name, TokenType.KEYWORD, self.tell())
-        
-            if name in BOOL_CONSTANTS:
-                return Token(name, TokenType.CONSTANT, self.tell())
-
-            return Token(name, TokenType.IDENTIFIER, self.tell())
-
-        if self.ch in CONTROL:
-            first = self.next_character()
-            if first == "|" and self.ch == "|":
-                self.next_character()
-                return Token("||", TokenType.CONTROL, self.tell())
-            if first == "&" and self.ch == "&":
-                self.next_character()
-                return Token("&&", TokenType.CONTROL, self.tell())
-            if first == "-" and self.ch == ">":
-                self.next_character()
-                return Token("->", TokenType.CONTROL, self.tell())
-            if first == ":" and self.ch == "=":
-                self.next_character()
-                return Token(":=", TokenType.CONTROL, self.tell())
-            if first == "=" and self.ch == "=":
-                self.next_character()
-                return Token("==", TokenType.CONTROL, self.tell())
-            if first == "<" and self.ch == "=":
-                self.next_character()
-                return Token("<=", TokenType.CONTROL, self.tell())
-            if first == ">" and self.ch == "=":
-                self.next_character()
-                return Token(">=", TokenType.CONTROL, self.tell())
-            return Token(first, TokenType.CONTROL, self.tell())
+    def offset_pos(self, offset) -> tuple[int, int]:
+        line = bisect_right(self.line_starts, offset) - 1
+        if line == 0:
+            return (0, offset + 1)
+        return (line, offset - self.line_starts[line])
+
+
+class StreamToken:
+    # view of a single token in a TokenStream, with the same attributes as Token
+    __slots__ = ("stream", "index")
+
+    def __init__(self, stream:TokenStream, index:int) -> None:
+        self.stream = stream
+        self.index = index
+
+    @property
+    def text(self) -> str:
+        return self.stream.text(self.index)
+
+    @property
+    def type(self) -> TokenType:
+        return self.stream.type(self.index)
+
+    @property
+    def pos(self) -> tuple[int, int]:
+        return self.stream.pos(self.index)
+
+    def __str__(self) -> str:
+        return f"({self.text}, {self.type})"
+
+
+class TokenCursor(TokenReader):
+    # Reads tokens from a TokenStream with the token interface of Lexer.
+    # It has no source to seek in, create a new cursor to parse the same stream again
+    def __init__(self, stream:TokenStream) -> None:
+        self.stream = stream
+        self.index = 0
+        self.lookahead_buffer = None
+
+    def next_token(self) -> StreamToken:
+        if self.lookahead_buffer != None:
+            out = self.lookahead_buffer
+            self.lookahead_buffer = None
+            return out
+
+        out = StreamToken(self.stream, self.index)
+        # the final EOF token is repeated once the stream is exhausted
+        if self.index < len(self.stream) - 1:
+            self.index += 1
+        return out
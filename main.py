@@ -1,53 +1,327 @@
-
-from lexer import Lexer
+from lexer import Lexer, ChunkedLexer
 from parser import Parser
-from TypeChecker import TypeChecker
+from TypeChecker import TypeChecker, TypeCheckCache
 from Environment import Environment
+from Cache import ASTCache, DEFAULT_MAX_SIZE
+from Diagnostics import Diagnostics, DiagnosticLimit
+from Ledger import Ledger, DEFAULT_BLOCK_SIZE
+import Closures
+import Bytecode
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import glob
+import io
 import sys
+import time
+
+USAGE = "Usage is main.py filename... [options]"
+
+# ways of running a checked program, tree walks the AST with evaluate
+ENGINES = ["tree", "closure", "vm"]
+
+# seconds between progress reports when streaming
+PROGRESS_INTERVAL = 1.0
+
+class Options:
+    def __init__(self) -> None:
+        self.filenames = []
+        self.jobs = None
+        self.type_check = True
+        self.run = True
+        self.cache_dir = None
+        self.cache_size = DEFAULT_MAX_SIZE
+        self.stream = False
+        self.check_jobs = None
+        # type checking stops after this many errors, None checks everything
+        self.max_errors = None
+        self.json = False
+        # how programs are run, see ENGINES
+        self.engine = "tree"
+        # database the state is checkpointed to and resumed from, see Ledger
+        self.ledger = None
+        self.block_size = DEFAULT_BLOCK_SIZE
+
+# options that take a value, read from the following argument
+def option_value(i):
+    if i + 1 >= len(sys.argv):
+        print(f"Missing value for {sys.argv[i]}")
+        print(USAGE)
+        exit()
+    return sys.argv[i + 1]
 
 def parse_command_line():
-    run = True
-    type_check = True
-    filename = None
+    options = Options()
     i = 1
     while i < len(sys.argv):
         if sys.argv[i] == "--no-check":
-            type_check = False
+            options.type_check = False
         elif sys.argv[i] == "--no-run":
-            run = False
-        else:
-            if filename == None:
-                filename = sys.argv[i]
-            else:
-                print(f"Invalid argument {sys.argv[i]}, duplicate file name?")
-                print("Usage is main.py filename [options]")
+            options.run = False
+        elif sys.argv[i] == "--cache-dir":
+            options.cache_dir = option_value(i)
+            i += 1
+        elif sys.argv[i] == "--cache-size":
+            options.cache_size = int(option_value(i))
+            i += 1
+        elif sys.argv[i] == "--stream":
+            options.stream = True
+        elif sys.argv[i] == "--check-jobs":
+            options.check_jobs = int(option_value(i))
+            i += 1
+        elif sys.argv[i] == "--max-errors":
+            options.max_errors = int(option_value(i))
+            i += 1
+        elif sys.argv[i] == "--fail-fast":
+            options.max_errors = 1
+        elif sys.argv[i] == "--json":
+            options.json = True
+        elif sys.argv[i] == "--engine":
+            options.engine = option_value(i)
+            if options.engine not in ENGINES:
+                print(f"Unknown engine {options.engine}, the engines are " + ", ".join(ENGINES))
                 exit()
+            i += 1
+        elif sys.argv[i] == "--ledger":
+            options.ledger = option_value(i)
+            i += 1
+        elif sys.argv[i] == "--block-size":
+            options.block_size = int(option_value(i))
+            i += 1
+        elif sys.argv[i] == "--jobs":
+            options.jobs = int(option_value(i))
+            i += 1
+        elif sys.argv[i].startswith("--"):
+            print(f"Invalid argument {sys.argv[i]}")
+            print(USAGE)
+            exit()
+        else:
+            options.filenames.append(sys.argv[i])
         i += 1
-    if filename == None:
-        print("Usage is main.py filename [options]")
+    if options.filenames == []:
+        print(USAGE)
         exit()
-    return (filename, type_check, run)
+    return options
 
-def main():
+# expand glob patterns, names that match nothing are kept so they get reported
+def expand_filenames(patterns):
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if matches:
+            filenames.extend(matches)
+        else:
+            filenames.append(pattern)
+    return filenames
+
+def read_source(filename) -> bytes:
+    with open(filename, "rb") as file:
+        return file.read()
+
+def parse(filename, options, source = None):
+    if options.cache_dir == None:
+        return Parser(Lexer(filename)).parse()
+
+    if source == None:
+        source = read_source(filename)
+    return ASTCache(options.cache_dir, options.cache_size).parse(source)
+
+def type_checker_for(options) -> TypeChecker:
+    cache = None
+    if options.cache_dir != None:
+        cache = TypeCheckCache(options.cache_dir, options.cache_size)
+    return TypeChecker(options.check_jobs, cache, Diagnostics(options.max_errors))
+
+# what runs the program, the AST itself or the program compiled for the chosen engine,
+# compiled bytecode is cached with the source it was compiled from when it is given
+def executable(ast, options, source = None):
+    match options.engine:
+        case "closure":
+            return Closures.compile_blockchain(ast)
+        case "vm":
+            if options.cache_dir == None or source == None:
+                return Bytecode.compile_program(ast)
+            return Bytecode.ProgramCache(options.cache_dir, options.cache_size).compile(source, ast)
+    return ast
+
+# runs what executable returned, all of its transactions or those given,
+# resuming from and checkpointing to the ledger when there is one
+def run(program, options, transactions = None):
+    env = Environment({})
+    if options.ledger != None:
+        env.ledger = Ledger(options.ledger, options.block_size)
+    try:
+        if transactions == None:
+            program.evaluate(env)
+        else:
+            program.evaluate_stream(env, transactions)
+    finally:
+        if env.ledger != None:
+            env.ledger.close()
 
-    
-    filename, type_check, run = parse_command_line()
+# print what type checking found, returns whether the program may be run
+def report_diagnostics(diagnostics, options) -> bool:
+    if options.json:
+        print(diagnostics.to_json())
+    else:
+        diagnostics.flush()
+        if diagnostics.stopped:
+            print(f"Type checking stopped after {diagnostics.errors} errors")
+        else:
+            print("Type checking complete")
+    return not diagnostics.stopped
+
+# returns the diagnostics of type checking, None when it was skipped
+def check(filename, options) -> Diagnostics:
+    if options.stream:
+        return check_stream(filename, options)
+
+    source = None
+    if options.engine == "vm" and options.cache_dir != None:
+        source = read_source(filename)
+        # without type checking a program compiled by an earlier run is run without parsing it
+        if not options.type_check:
+            program = Bytecode.ProgramCache(options.cache_dir, options.cache_size).load_program(source)
+            if program != None:
+                if options.run:
+                    run(program, options)
+                return None
 
-    lexer = Lexer(sys.argv[1])
+    ast = parse(filename, options, source)
 
-    parser = Parser(lexer)
+    diagnostics = None
+    if options.type_check:
+        type_checker = type_checker_for(options)
 
-    ast = parser.parse()
+        diagnostics = type_checker.diagnostics
+        try:
+            type_checker.type_check(ast)
+        except Exception:
+            # show what was found before the checker failed
+            if not options.json:
+                diagnostics.flush()
+            raise
+        if not report_diagnostics(diagnostics, options):
+            return diagnostics
 
-    if type_check:
-        type_checker = TypeChecker()
+    if options.run:
+        run(executable(ast, options, source), options)
+    return diagnostics
 
+# Transactions are parsed, checked and run one at a time,
+# so memory does not grow with the length of the transaction log
+def check_stream(filename, options) -> Diagnostics:
+    parser = Parser(ChunkedLexer(filename))
+    ast = parser.parse_declarations()
+
+    type_checker = type_checker_for(options)
+    diagnostics = type_checker.diagnostics
+    if options.type_check:
         type_checker.type_check(ast)
-        print("Type checking complete")
+        # in JSON mode everything is printed at once, after the last transaction
+        if not options.json and not report_diagnostics(diagnostics, options):
+            return diagnostics
+
+    if not diagnostics.stopped:
+        transactions = report_progress(parser.transactions())
+        if options.type_check:
+            transactions = checked_transactions(transactions, type_checker, options)
+
+        try:
+            if options.run:
+                run(executable(ast, options), options, transactions)
+            else:
+                for _ in transactions:
+                    pass
+        except DiagnosticLimit:
+            if not options.json:
+                diagnostics.flush()
+                print(f"Type checking stopped after {diagnostics.errors} errors")
+
+    if not options.type_check:
+        return None
+    if options.json:
+        print(diagnostics.to_json())
+    return diagnostics
+
+def checked_transactions(transactions, type_checker, options):
+    for transaction in transactions:
+        type_checker.type_check_transaction(transaction)
+        if not options.json:
+            type_checker.diagnostics.flush()
+        yield transaction
+
+# pass transactions through, reporting how many have been handled on stderr
+def report_progress(transactions):
+    start = time.monotonic()
+    last_report = start
+    count = 0
+    for transaction in transactions:
+        yield transaction
+        count += 1
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            print(f"{count} transactions, {count / (now - start):.0f} per second", file=sys.stderr)
+            last_report = now
+
+    elapsed = time.monotonic() - start
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f"Processed {count} transactions in {elapsed:.2f} seconds, {rate:.0f} per second", file=sys.stderr)
+
+# Runs in the worker processes of batch mode, the output of a file is collected
+# and returned with its status instead of being printed
+def check_file(filename, options):
+    output = io.StringIO()
+    status = "ok"
+    diagnostics = None
+    with contextlib.redirect_stdout(output):
+        try:
+            diagnostics = check(filename, options)
+        except SyntaxError as error:
+            status = "syntax error"
+            print(error)
+        except Exception as error:
+            status = "failed"
+            print(f"{type(error).__name__}: {error}")
+    if status == "ok" and diagnostics != None and diagnostics.errors > 0:
+        status = "type errors"
+    return filename, status, output.getvalue()
+
+def batch(filenames, options):
+    # files are already checked in parallel, the workers check each file on their own
+    options.check_jobs = None
+    counts = {"ok": 0, "type errors": 0, "syntax error": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        futures = [executor.submit(check_file, filename, options) for filename in filenames]
+        # results are printed as soon as each file is done
+        for future in as_completed(futures):
+            filename, status, output = future.result()
+            counts[status] += 1
+            print(f"== {filename}: {status}")
+            print(output, end="")
+
+    print(f"Checked {len(filenames)} files: " + ", ".join(f"{counts[status]} {status}" for status in counts))
+    if counts["ok"] != len(filenames):
+        sys.exit(1)
+
+def main():
+
+
+    options = parse_command_line()
+
+    filenames = expand_filenames(options.filenames)
 
-    if run:
-        ast.evaluate(Environment({}))
+    # several files, or asking for workers, checks everything in a process pool
+    if len(filenames) > 1 or options.jobs != None or filenames != options.filenames:
+        if options.ledger != None:
+            print("A ledger holds the state of a single program, --ledger takes one file")
+            sys.exit(1)
+        batch(filenames, options)
+    else:
+        diagnostics = check(filenames[0], options)
+        # checking was stopped by --max-errors or --fail-fast
+        if diagnostics != None and diagnostics.stopped:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,56 @@
-from lexer import Lexer, TokenType
+from bisect import bisect_left, bisect_right
+
+from lexer import Lexer, TokenReader, TokenType, TokenStream, TokenCursor, read_source
 import AST
 import Typing
 
 
+LEFT = "left"
+RIGHT = "right"
+
+# Binary operators with their precedence and associativity, higher precedence binds tighter
+BINARY_OPERATORS = {
+    "||": (1, LEFT),
+    "&&": (1, LEFT),
+    "==": (2, LEFT),
+    "<": (2, LEFT),
+    ">": (2, LEFT),
+    "<=": (2, LEFT),
+    ">=": (2, LEFT),
+    "*": (3, LEFT),
+    "//": (3, LEFT),
+    "+": (4, LEFT),
+    "-": (4, LEFT),
+}
+
+# Prefix operators bind tighter than every binary operator
+PREFIX_OPERATORS = {
+    "-": 5,
+}
+
+
+# Parse a program held in memory, see lexer.read_source for accepted sources
+def parse_source(source) -> AST.Blockchain:
+    return Parser(source).parse()
+
+
 class Parser:
     def __init__(self, lexer) -> None:
+        # Anything that is not already a lexer is the program itself,
+        # a str is the program text and not a filename.
+        if isinstance(lexer, TokenStream):
+            lexer = TokenCursor(lexer)
+        elif not isinstance(lexer, TokenReader):
+            lexer = Lexer(source=lexer)
         self.lexer:Lexer = lexer
 
     def parse(self) -> AST.Blockchain:
+        blockchain = self.parse_declarations()
+        blockchain.transactions = list(self.transactions())
+        return blockchain
+
+    # parse the interfaces and contracts, leaving the transactions to be read
+    def parse_declarations(self) -> AST.Blockchain:
         interfaces = []
         while self.lexer.lookahead().text == "interface":
             interfaces.append(self.interface())
@@ -16,12 +59,13 @@ class Parser:
         contracts = []
         while self.lexer.lookahead().text == "contract":
             contracts.append(self.contract())
-        
-        transactions = []
-        while self.lexer.lookahead().type == TokenType.IDENTIFIER:
-            transactions.append(self.transaction())
 
-        return AST.Blockchain(interfaces, contracts, transactions)
+        return AST.Blockchain(interfaces, contracts, [])
+
+    # yield the transactions one at a time as they are parsed
+    def transactions(self):
+        while self.lexer.lookahead().type == TokenType.IDENTIFIER:
+            yield self.transaction()
 
     def interface(self):
         self.lexer.expect(text="interface")
@@ -124,14 +168,83 @@ class Parser:
     
 
     def statements(self):
-        statements= []
-        while self.lexer.lookahead().text != "}":
-            statements.append(self.statement())
-            self.lexer.expect(";")
-        
-        return statements
+        return self.nested_statements(["block", []])
 
     def statement(self):
+        return self.nested_statements(["result"])
+
+    # Parses statements with an explicit stack of the constructs that are still open,
+    # so the nesting depth is only limited by memory and not by the recursion limit.
+    # Frames are lists starting with the kind of construct, "block" collects statements
+    # until its closing brace, "result" returns the first finished statement.
+    def nested_statements(self, root):
+        stack = [root]
+        while True:
+            top = stack[-1]
+            if top[0] == "block" and self.lexer.lookahead().text == "}":
+                # the outermost closing brace belongs to the caller
+                if len(stack) == 1:
+                    return top[1]
+                self.lexer.expect(text="}")
+                stack.pop()
+                stmt = self.close_block(stack, top[1])
+            else:
+                stmt = self.open_statement(stack)
+
+            # hand finished statements to the constructs waiting for them
+            while stmt != None:
+                top = stack[-1]
+                match top[0]:
+                    case "block":
+                        top[1].append(stmt)
+                        self.lexer.expect(";")
+                        stmt = None
+                    case "result":
+                        return stmt
+                    case "var":
+                        stack.pop()
+                        stmt = AST.BindStmt(top[1].pos, top[1].text, top[2], top[3], [stmt])
+                    case "unsafe":
+                        stack.pop()
+                        stmt = AST.UnsafeStmt(stmt.pos, stmt)
+
+    # start parsing the next statement, compound statements push their frames
+    # on the stack and return None, other statements are returned directly
+    def open_statement(self, stack):
+        first = self.lexer.lookahead()
+
+        match first.text:
+            case "var":
+                stack.append(self.bind_stmt())
+            case "if":
+                stack.append(self.if_stmt())
+                stack.append(["block", []])
+            case "while":
+                stack.append(self.while_stmt())
+                stack.append(["block", []])
+            case "unsafe":
+                self.lexer.expect("unsafe")
+                stack.append(["unsafe"])
+            case _:
+                return self.simple_statement()
+
+    # a block has been closed, either finish its statement or start the next block
+    def close_block(self, stack, statements):
+        top = stack[-1]
+        match top[0]:
+            case "if":
+                self.lexer.expect(text="else")
+                self.lexer.expect(text="{")
+                stack[-1] = ["else", top[1], top[2], statements]
+                stack.append(["block", []])
+            case "else":
+                stack.pop()
+                return AST.IfStmt(top[1].pos, top[2], top[3], statements)
+            case "while":
+                stack.pop()
+                return AST.WhileStmt(top[1].pos, top[2], statements)
+
+    def simple_statement(self):
         first = self.lexer.lookahead()
 
         match first.text:
@@ -141,12 +254,6 @@ class Parser:
             case "throw":
                 self.lexer.expect(text="throw")
                 return AST.ThrowStmt(first.pos)
-            case "var":
-                return self.bind_stmt()
-            case "if":
-                return self.if_stmt()
-            case "while":
-                return self.while_stmt()
             case "call":
                 return self.method_call()
             case "set":
@@ -157,11 +264,8 @@ class Parser:
                 return AST.PrintStmt(expr.pos, expr)
             case "dcall":
                 return self.delegate_call()
-            case "unsafe":
-                self.lexer.expect("unsafe")
-                stmt = self.statement()
-                return AST.UnsafeStmt(stmt.pos, stmt)
-            
+        raise SyntaxError(f"Expected statement but got {first.text} at {first.pos}")
+
     def assignment_stmt(self):
         first = self.lexer.expect("set")
         var = self.l_value()
@@ -246,26 +350,25 @@ class Parser:
         
         return AST.MethodCall(first.pos, field.name, field.field, vars, cost)
 
+    # The parsers for compound statements only read up to their body,
+    # returning the frame that nested_statements finishes.
     def bind_stmt(self):
-            self.lexer.expect(text="var")
-            name = self.lexer.expect(type=TokenType.IDENTIFIER)
-            self.lexer.expect(":")
-            # TODO: better type evaluation, not just feeding the token
-            level = self.lexer.next_token()
-            self.lexer.expect(text=":=")
-            expr = self.expression()
-            self.lexer.expect(text="in")
-            statements = self.statement()
-            return AST.BindStmt(name.pos, name.text,level, expr, statements)
+        self.lexer.expect(text="var")
+        name = self.lexer.expect(type=TokenType.IDENTIFIER)
+        self.lexer.expect(":")
+        # TODO: better type evaluation, not just feeding the token
+        level = self.lexer.next_token()
+        self.lexer.expect(text=":=")
+        expr = self.expression()
+        self.lexer.expect(text="in")
+        return ["var", name, level, expr]
 
     def while_stmt(self):
-            first = self.lexer.expect(text="while")
-            cond = self.expression()
-            self.lexer.expect(text="do")
-            self.lexer.expect(text="{")
-            stmts = self.statements()
-            self.lexer.expect(text="}")
-            return AST.WhileStmt(first.pos, cond, stmts)
+        first = self.lexer.expect(text="while")
+        cond = self.expression()
+        self.lexer.expect(text="do")
+        self.lexer.expect(text="{")
+        return ["while", first, cond]
 
     def if_stmt(self):
         first = self.lexer.expect(text="if")
@@ -273,47 +376,30 @@ class Parser:
 
         self.lexer.expect(text="then")
         self.lexer.expect(text="{")
-        true_stmts = self.statements()
-        self.lexer.expect(text="}")
-        
-        self.lexer.expect(text="else")
-        self.lexer.expect(text="{")
-        false_stmts = self.statements()
-        self.lexer.expect(text="}")
-        
-        return AST.IfStmt(first.pos, cond, true_stmts, false_stmts)
-
-    def expression(self):
-        first = self.comparison()
-        while self.lexer.lookahead().text in ["||", "&&"]:
-            op = self.lexer.expect(type=TokenType.CONTROL)
-            rhs = self.comparison()
-            first = AST.BinaryOp(op.pos, op.text, first, rhs)
-        return first
-
-    def comparison(self):
-        first = self.multiplication()
-        while self.lexer.lookahead().text in ["==", "<", ">", "<=", ">="]:
-            op = self.lexer.expect(type=TokenType.CONTROL)
-            rhs = self.multiplication()
-            first = AST.BinaryOp(op.pos, op.text, first, rhs)
-        return first
-
-    def multiplication(self):
-        first = self.addition()
-        while self.lexer.lookahead().text in ["*", "//"]:
+        return ["if", first, cond]
+
+    def expression(self, min_precedence = 1):
+        first = self.prefix()
+        # precedence climbing, operators of lower precedence are left to the caller
+        while True:
+            operator = BINARY_OPERATORS.get(self.lexer.lookahead().text)
+            if operator == None or operator[0] < min_precedence:
+                return first
+            precedence, associativity = operator
             op = self.lexer.expect(type=TokenType.CONTROL)
-            rhs = self.addition()
+            if associativity == LEFT:
+                rhs = self.expression(precedence + 1)
+            else:
+                rhs = self.expression(precedence)
             first = AST.BinaryOp(op.pos, op.text, first, rhs)
-        return first
 
-    def addition(self):
-        first = self.unary()
-        while self.lexer.lookahead().text in ["+", "-"]:
-            op = self.lexer.expect(type=TokenType.CONTROL)
-            rhs = self.unary()
-            first = AST.BinaryOp(op.pos, op.text, first, rhs)
-        return first
+    def prefix(self):
+        first = self.lexer.lookahead()
+        if first.type == TokenType.CONTROL and first.text in PREFIX_OPERATORS:
+            self.lexer.next_token()
+            operand = self.expression(PREFIX_OPERATORS[first.text])
+            return AST.UnaryOp(first.pos, first.text, operand)
+        return self.unary()
 
     def unary(self):
         first = self.lexer.lookahead()
@@ -348,29 +434,29 @@ class Parser:
     def type(self):
         self.lexer.expect("(")
 
-        base = self.lexer.expect(type=TokenType.IDENTIFIER)
+        base = self.lexer.expect(type=TokenType.IDENTIFIER).text
 
 
         # TODO: elegant implementation for arrays
         if self.lexer.lookahead().text == "[":
             self.lexer.expect("[")
             self.lexer.expect("]")
-            base.text += "[]"
+            base += "[]"
 
         self.lexer.expect(",")
         level = self.lexer.next_token()
         self.lexer.expect(")")
 
         if level.text == "min":
-            level = Typing.SecurityLevel(0, min=True)
+            level = Typing.MIN
         elif level.text == "max":
-            level = Typing.SecurityLevel(0, max=True)
+            level = Typing.MAX
         else:
-            level = Typing.SecurityLevel(int(level.text))
+            level = Typing.SecurityLevel.of(int(level.text))
             
 
 
-        return Typing.Type(base.text, level)
+        return Typing.Type(base, level)
         
     def transaction(self):
         caller = self.expression()
@@ -417,4 +503,210 @@ class Parser:
                 self.lexer.next_token()
                 indices.append(self.expression())
             self.lexer.expect("]")
-            return AST.ArrayConstant(first.pos, indices)
\ No newline at end of file
+            return AST.ArrayConstant(first.pos, indices)
+
+        raise SyntaxError(f"Expected expression but got {first.text} at {first.pos}")
+
+
+class Declaration:
+    # a top level interface or contract, with the offsets of its first
+    # character and the character after its closing brace, and the line it starts on
+    def __init__(self, start, end, node, base:AST.LineBase) -> None:
+        self.start:int = start
+        self.end:int = end
+        self.node = node
+        self.base = base
+
+
+class SyntaxFallback(Exception):
+    # raised when an edited region can not be parsed on its own
+    pass
+
+
+class IncrementalParser:
+    # Keeps the declarations of the last parsed source, so that after an edit only
+    # the interfaces and contracts the edit touches are lexed and parsed again.
+    # Everything else is reused, the nodes of a declaration have their lines relative
+    # to its line base, so moving a declaration to another line does not visit them.
+    # The returned ASTs share nodes, so they should be type checked but not evaluated.
+    def __init__(self, source) -> None:
+        self.source:str = ""
+        self.declarations:list[Declaration] = None
+        self.transactions = []
+        self.tail_start = 0
+        # line base of the transactions
+        self.tail_base = AST.LineBase(0)
+        self.ast:AST.Blockchain = None
+        self.update(source)
+
+    # replace the source and return its AST
+    def update(self, source) -> AST.Blockchain:
+        source = read_source(source)
+        old = self.source
+
+        # the edit is what is left after the common prefix and suffix
+        prefix = common_prefix(old, source)
+        suffix = common_suffix(old, source, min(len(old), len(source)) - prefix)
+        return self.edit(prefix, len(old) - suffix, source[prefix:len(source) - suffix])
+
+    # replace source[start:end] with text and return the new AST
+    def edit(self, start, end, text) -> AST.Blockchain:
+        old = self.source
+        source = old[:start] + text + old[end:]
+        self.source = source
+
+        if self.declarations == None:
+            return self.parse_all()
+
+        declarations = self.declarations
+        ends = [declaration.end for declaration in declarations]
+        delta = len(text) - (end - start)
+        lines = text.count("\n") - old.count("\n", start, end)
+
+        # every declaration owns the gap before it, the transactions own the rest of the file
+        first = bisect_left(ends, start)
+        last = bisect_right(ends, end)
+
+        # declarations starting on the line the edit ends on would have their columns moved,
+        # so they are parsed again as well
+        while last < len(declarations):
+            if last + 1 < len(declarations):
+                next_start = declarations[last + 1].start
+            else:
+                next_start = self.tail_start
+            if old.find("\n", end, next_start) != -1:
+                break
+            last += 1
+
+        tail = last == len(declarations)
+        region_end = len(source) if tail else ends[last] + delta
+        try:
+            if first > 0:
+                # lines are counted from the start of the declaration before the edit
+                before = declarations[first - 1]
+                parsed, transactions, tail_start = self.parse_region(before.end, region_end, tail, before.start, before.base.line)
+            else:
+                parsed, transactions, tail_start = self.parse_region(0, region_end, tail)
+        except (SyntaxError, SyntaxFallback):
+            return self.parse_all()
+
+        after = declarations[last + 1:] if not tail else []
+        for declaration in after:
+            declaration.start += delta
+            declaration.end += delta
+            declaration.base.line += lines
+
+        if tail:
+            self.transactions = transactions
+            self.tail_start = tail_start
+        else:
+            self.tail_start += delta
+            self.tail_base.line += lines
+
+        self.declarations = declarations[:first] + parsed + after
+        return self.build()
+
+    def parse_all(self) -> AST.Blockchain:
+        self.declarations = None
+        try:
+            declarations, self.transactions, self.tail_start = self.parse_region(0, len(self.source), True)
+        except SyntaxError:
+            # Parser.parse ignores everything after a declaration out of order,
+            # leave it to decide whether the error counts
+            self.ast = Parser(self.source).parse()
+            return self.ast
+        self.declarations = declarations
+        return self.build()
+
+    # Parse the declarations between start and end, and the transactions after them if tail is set.
+    # Lines are counted from line_offset, which is on line
+    def parse_region(self, start, end, tail, line_offset = 0, line = 0):
+        lexer = Lexer(source=self.source)
+        lexer.seek(start, line_offset, line)
+        parser = Parser(lexer)
+
+        declarations = []
+        while True:
+            offset = lexer.token_start()
+            if offset >= end and not tail:
+                break
+            tail_start = offset
+            token = lexer.lookahead()
+            match token.text:
+                case "interface":
+                    node = parser.interface()
+                case "contract":
+                    node = parser.contract()
+                case _:
+                    if not tail:
+                        raise SyntaxFallback()
+                    break
+            # the declaration runs into the ones that are reused
+            if lexer.cursor > end:
+                raise SyntaxFallback()
+            base = AST.LineBase(token.pos[0])
+            set_line_base(node, base)
+            declarations.append(Declaration(offset, lexer.cursor, node, base))
+
+        transactions = []
+        if tail:
+            self.tail_base = AST.LineBase(lexer.lookahead().pos[0])
+            while lexer.lookahead().type == TokenType.IDENTIFIER:
+                transactions.append(parser.transaction())
+            set_line_base(transactions, self.tail_base)
+
+        return declarations, transactions, tail_start
+
+    def build(self) -> AST.Blockchain:
+        interfaces = []
+        contracts = []
+        ordered = True
+        for declaration in self.declarations:
+            if isinstance(declaration.node, Typing.Interface):
+                ordered = ordered and not contracts
+                interfaces.append(declaration.node)
+            else:
+                contracts.append(declaration.node)
+
+        # Parser.parse stops at an interface following a contract,
+        # leave such sources to it instead of reusing declarations
+        if not ordered:
+            self.declarations = None
+            self.ast = Parser(self.source).parse()
+            return self.ast
+
+        self.ast = AST.Blockchain(interfaces, contracts, self.transactions)
+        return self.ast
+
+
+# make the lines of node and everything below it relative to base
+def set_line_base(node, base:AST.LineBase):
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, list):
+            stack.extend(current)
+        elif isinstance(current, AST.Node):
+            pos = current.pos
+            current.line_base = base
+            current.pos = pos
+            stack.extend(vars(current).values())
+
+
+# Length of the common prefix of a and b. Blocks are compared before single characters,
+# so only the part before the first difference is read, without copying the rest.
+def common_prefix(a:str, b:str) -> int:
+    length = min(len(a), len(b))
+    matched = 0
+    for size in (4096, 64, 1):
+        while matched + size <= length and a[matched:matched + size] == b[matched:matched + size]:
+            matched += size
+    return matched
+
+# length of the common suffix of a and b, at most limit
+def common_suffix(a:str, b:str, limit) -> int:
+    matched = 0
+    for size in (4096, 64, 1):
+        while matched + size <= limit and a[len(a) - matched - size:len(a) - matched] == b[len(b) - matched - size:len(b) - matched]:
+            matched += size
+    return matched
@@ -0,0 +1,233 @@
+# The faster paths added for performance must behave exactly like the ones they replace.
+# Each test runs both over the example programs and a few generated ones.
+from lexer import Lexer, ChunkedLexer, TokenType
+from parser import parse_source, IncrementalParser
+from TypeChecker import TypeChecker, IncrementalTypeChecker
+from Cache import DERIVED_ATTRIBUTES
+from Environment import Environment, Reference, Local
+from State import Journal
+from generator import Shape, generate
+import Typing
+import Closures
+import Bytecode
+
+import contextlib
+import glob
+import io
+import os
+import random
+import re
+
+import pytest
+
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "programs", "*.txt")))
+SEEDS = [1, 2, 3, 4]
+SHAPE = Shape(interfaces=3, width=3, contracts=4, methods=3, statements=6, depth=3, transactions=6)
+
+def read_program(filename) -> str:
+    with open(filename) as file:
+        return file.read()
+
+SOURCES = [pytest.param(read_program(filename), id=os.path.basename(filename)) for filename in PROGRAMS]
+SOURCES += [pytest.param(generate(SHAPE, seed), id=f"seed-{seed}") for seed in SEEDS]
+# generated programs with type errors, for the checker
+ILL_TYPED = [pytest.param(generate(Shape(**{**vars(SHAPE), "errors": 0.2}), seed), id=f"ill-typed-{seed}") for seed in SEEDS]
+
+def tokens(lexer) -> list[tuple]:
+    out = []
+    while True:
+        token = lexer.next_token()
+        out.append((token.text, token.type, token.pos))
+        if token.type == TokenType.EOF:
+            return out
+
+# what running a type checked program prints, including the error that stopped it
+def run_output(source, compile = None) -> str:
+    ast = parse_source(source)
+    TypeChecker().type_check(ast)
+    program = ast if compile == None else compile(ast)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            program.evaluate(Environment({}))
+        except Exception as error:
+            print(f"{type(error).__name__}: {error}")
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_token_stream_matches_lexer(source):
+    stream = Lexer(source=source).tokenize()
+    assert [(stream.text(i), stream.type(i), stream.pos(i)) for i in range(len(stream))] == tokens(Lexer(source=source))
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_chunked_lexer_matches_lexer(source, chunk_size):
+    assert tokens(ChunkedLexer(stream=io.StringIO(source), chunk_size=chunk_size)) == tokens(Lexer(source=source))
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_token_stream_parses_like_lexer(source):
+    assert run_output(Lexer(source=source).tokenize()) == run_output(source)
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_closures_match_tree_walker(source):
+    assert run_output(source, Closures.compile_blockchain) == run_output(source)
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_bytecode_matches_tree_walker(source):
+    assert run_output(source, Bytecode.compile_program) == run_output(source)
+
+def test_long_operator_chain():
+    terms = 5000
+    source = (
+        "interface i {\n    field balance : (int, 0);\n    method main : ():0;\n}\n"
+        "contract cont: (i, 0) {\n    field balance := 0;\n"
+        f"    main () {{\n        print {' + '.join(['1'] * terms)};\n    }}\n}}\n"
+        "cont->cont.main():0;\n"
+    )
+    assert run_output(source) == f"{terms}\n"
+    assert run_output(source, Closures.compile_blockchain) == f"{terms}\n"
+    assert run_output(source, Bytecode.compile_program) == f"{terms}\n"
+
+# a throw after a loop of writes and calls, through a parameter bound to a field,
+# puts back what the transaction wrote and nothing before it
+REVERTING = """
+interface i {
+    field balance : (int, 0);
+    field total : (int, 0);
+    field count : (int, 0);
+    method run : ((int, 0) n, (bool, 0) fail):0;
+    method bump : ((int, 0) x, (bool, 0) fail):0;
+    method show : ():0;
+}
+
+contract cont: (i, 0) {
+    field balance := 50;
+    field total := 0;
+    field count := 0;
+    run (n, fail) {
+        while (this.count < n) do {
+            set this.total := this.total + this.count;
+            call this.bump(this.count, F):1;
+        };
+        print this.total;
+        call this.bump(this.total, fail):2;
+    }
+    bump (x, fail) {
+        set x := x + 1;
+        if (fail) then { throw; } else { skip; };
+    }
+    show () {
+        print this.total;
+        print this.count;
+        print this.balance;
+    }
+}
+
+cont->cont.run(5, F):0;
+cont->cont.show():0;
+cont->cont.run(7, T):0;
+cont->cont.show():0;
+cont->cont.run(3, F):0;
+cont->cont.show():0;
+"""
+
+@pytest.mark.parametrize("compile", [None, Closures.compile_blockchain, Bytecode.compile_program])
+def test_throw_reverts_transaction(compile):
+    assert run_output(REVERTING, compile) == (
+        "10\n11\n5\n50\n"
+        "22\nTransaction reverted: Throws error at (24, 30)\n11\n5\n50\n"
+        "11\n12\n5\n50\n"
+    )
+
+def test_journal_records_each_reference_once():
+    journal = Journal()
+    field = Reference(1)
+    local = Local(1)
+    for value in range(100):
+        journal.record(field)
+        field.value = value
+        journal.record(local)
+        local.value = value
+    assert journal.entries == [field, 1]
+    journal.rollback(0)
+    assert field.value == 1
+
+
+# The nodes of node with their positions, leaving out what checking and running add
+def structure(node):
+    if isinstance(node, (list, tuple)):
+        return [structure(child) for child in node]
+    if isinstance(node, dict):
+        return {name: structure(node[name]) for name in node}
+    if node is None or isinstance(node, (str, int, float, bool)):
+        return node
+    if hasattr(node, "text") and hasattr(node, "type"):
+        return (node.text, node.type)
+    if isinstance(node, Typing.Interface):
+        return ("interface", node.name)
+    if not hasattr(node, "__dict__"):
+        return repr(node)
+    attributes = {name: structure(value) for name, value in vars(node).items() if name not in DERIVED_ATTRIBUTES}
+    if hasattr(node, "pos"):
+        attributes["pos"] = node.pos
+    return (type(node).__name__, attributes)
+
+# the diagnostics of checking ast, or the error checking stopped with
+# some messages print AST nodes, so object addresses are left out
+def check_outcome(type_checker, ast) -> list[str]:
+    try:
+        type_checker.type_check(ast)
+    except Exception as error:
+        return [f"{type(error).__name__}: {error}"]
+    return [re.sub(" at 0x[0-9a-f]+", "", diagnostic.format()) for diagnostic in type_checker.diagnostics.diagnostics]
+
+# a line of source deleted, repeated, swapped with the next or with a digit changed
+def edited(source, rng) -> str:
+    lines = source.split("\n")
+    line = rng.randrange(len(lines))
+    match rng.choice(["delete", "repeat", "swap", "digit", "digit"]):
+        case "delete":
+            del lines[line]
+        case "repeat":
+            lines.insert(line, lines[line])
+        case "swap" if line + 1 < len(lines):
+            lines[line], lines[line + 1] = lines[line + 1], lines[line]
+        case _:
+            digits = [i for i, char in enumerate(source) if char.isdigit()]
+            if digits:
+                i = rng.choice(digits)
+                return source[:i] + str((int(source[i]) + 1) % 10) + source[i + 1:]
+    return "\n".join(lines)
+
+@pytest.mark.parametrize("source", SOURCES + ILL_TYPED)
+def test_incremental_matches_full(source):
+    rng = random.Random(source)
+    parser = IncrementalParser(source)
+    checker = IncrementalTypeChecker()
+    checker.type_check(parser.ast)
+    for _ in range(12):
+        changed = edited(source, rng)
+        try:
+            full = parse_source(changed)
+        except SyntaxError:
+            # the incremental parser fails as well, the next edit is made to the last program
+            with pytest.raises(SyntaxError):
+                parser.update(changed)
+            continue
+        source = changed
+
+        ast = parser.update(source)
+        assert structure(ast) == structure(full)
+
+        assert check_outcome(checker, ast) == check_outcome(TypeChecker(), full)
+
+# Workers are used however few methods and cores there are,
+# forked, or sent their batches when fork is not available
+@pytest.mark.parametrize("start_methods", [["fork", "spawn"], ["spawn"]], ids=["fork", "spawn"])
+@pytest.mark.parametrize("source", SOURCES + ILL_TYPED)
+def test_parallel_check_matches_serial(source, start_methods, monkeypatch):
+    monkeypatch.setattr("TypeChecker.PARALLEL_THRESHOLD", 0)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+    monkeypatch.setattr("multiprocessing.get_all_start_methods", lambda: start_methods)
+    assert check_outcome(TypeChecker(jobs=2), parse_source(source)) == check_outcome(TypeChecker(), parse_source(source))